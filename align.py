@@ -1,9 +1,18 @@
-from concurrent.futures import ProcessPoolExecutor
-import multiprocessing
-import os
+import asyncio
+import heapq
+import importlib.util
 import json
-import random
-import subprocess
+import os
+import shutil
+import time
+
+from build_manifest import BuildManifest
+from chunked_alignment import (covers_transcript, misfit_edges, plan_windows, split_sentences, stitch_timelines,
+                               widen_window, write_windows)
+from dedup_index import DedupIndex, index_filename
+from metrics import Metrics
+from echogarden_client import CliAligner, EchogardenServer, ServerAligner, timeline_to_srt
+from wav_io import MappedWav, wav_duration
 
 
 import argparse
@@ -30,6 +39,95 @@ parser.add_argument(
     default="dtw-ra",
     help="The engine to use for processing. Choices: dtw, dtw-ra, whisper (default: dtw-ra).",
 )
+parser.add_argument(
+    "--devices",
+    type=str,
+    default="0,1",
+    help="Comma separated GPU ids to run echogarden on (default: 0,1).",
+)
+parser.add_argument(
+    "--slots_per_device",
+    type=int,
+    default=1,
+    help="Number of echogarden jobs to run at the same time on every device (default: 1).",
+)
+parser.add_argument(
+    "--backend",
+    type=str,
+    choices=["server", "cli"],
+    default="server",
+    help="server keeps one `echogarden serve` process per device loaded, cli spawns "
+    "`echogarden align` per file. Falls back to cli when a server cannot be started (default: server).",
+)
+parser.add_argument(
+    "--server_urls",
+    type=str,
+    default=None,
+    help="Comma separated URLs of already running echogarden servers (e.g. echogarden_stub.py), "
+    "used instead of starting one per device.",
+)
+
+parser.add_argument(
+    "--timeout_base",
+    type=float,
+    default=300,
+    help="Fixed part of the per-file timeout in seconds (default: 300).",
+)
+parser.add_argument(
+    "--timeout_factor",
+    type=float,
+    default=2.0,
+    help="Seconds of timeout added per second of audio (default: 2.0).",
+)
+parser.add_argument(
+    "--retries",
+    type=int,
+    default=2,
+    help="Number of times a failed or timed out file is retried (default: 2).",
+)
+parser.add_argument(
+    "--retry_backoff",
+    type=float,
+    default=30,
+    help="Seconds to wait before the first retry, doubled for every next one (default: 30).",
+)
+parser.add_argument(
+    "--manifest",
+    type=str,
+    default="pipeline_manifest.sqlite",
+    help="Build manifest shared by all pipeline stages (default: pipeline_manifest.sqlite).",
+)
+
+parser.add_argument(
+    "--chunk_duration",
+    type=float,
+    default=0,
+    help="Align recordings longer than 1.5 times this many seconds as overlapping windows of "
+    "about this length, in parallel over all slots, e.g. 1200 (default: 0, off).",
+)
+parser.add_argument(
+    "--chunk_overlap",
+    type=float,
+    default=60,
+    help="Seconds of audio the windows of a long recording overlap on either side (default: 60).",
+)
+parser.add_argument(
+    "--keep_duplicates",
+    action="store_true",
+    help=f"Also align the recordings {index_filename} (written by ingest.py) marks as a copy of another one.",
+)
+parser.add_argument(
+    "--metrics",
+    type=str,
+    default="pipeline_metrics.jsonl",
+    help="JSON lines file the timings of every recording and of the run are appended to (default: pipeline_metrics.jsonl).",
+)
+parser.add_argument(
+    "--prometheus",
+    type=str,
+    default=None,
+    help="Also write the run summary in Prometheus text format to this file.",
+)
 
 # Parse the command-line arguments
 args = parser.parse_args()
@@ -37,88 +135,423 @@ args = parser.parse_args()
 directory = args.directory
 engine = args.engine
 output_directory = os.path.join(args.output_directory, engine)
+devices = args.devices.split(",")
+slots_per_device = args.slots_per_device
+backend = args.backend
+server_urls = args.server_urls.split(",") if args.server_urls else None
+timeout_base = args.timeout_base
+timeout_factor = args.timeout_factor
+retries = args.retries
+retry_backoff = args.retry_backoff
+chunk_duration = args.chunk_duration
+chunk_overlap = args.chunk_overlap
+# Times a window whose audio misses its first or last sentence is widened, see process_window
+max_widenings = 3
+
+log_directory = os.path.join(output_directory, "logs")
+chunk_directory = os.path.join(output_directory, "chunks")
+summary_path = os.path.join(output_directory, "align_summary.json")
+
+manifest = BuildManifest(args.manifest)
+
+# Timings of every alignment attempt and recording
+metrics = Metrics("align")
 
 os.makedirs(output_directory, exist_ok=True)
 
 
-def process_file(args):
-    filename, worker_id = args
+def echogarden_flags():
+    flags = []
+
+    flags.append("--language=nl-NL")
+    flags.append("--crop=true")
+    flags.append(f"--engine={engine}")
+
+    if engine == "dtw-ra":
+        flags.append("--dtw.phoneAlignmentMethod=interpolation")
+        flags.append("--recognition.engine=whisper.cpp")
+        flags.append("--recognition.whisperCpp.model=large-v2")
+        flags.append("--recognition.whisperCpp.build=cublas-12.4.0")
+        flags.append("--recognition.whisperCpp.enableGPU=true")
+        flags.append("--recognition.whisperCpp.repetitionThreshold=2")
+    if engine == "whisper":
+        flags.append("--whisper.model=small")
+        flags.append("--whisper.encoderProvider=cpu")
+        flags.append("--whisper.decoderProvider=cpu")
+
+    return flags
+
+
+def alignment_inputs(filename):
+    name, extension = os.path.splitext(filename)
+    return [os.path.join(directory, filename), os.path.join(directory, f"{name}.txt")]
+
+
+def is_chunked(duration):
+    return chunk_duration > 0 and duration > 1.5 * chunk_duration
+
+
+def alignment_params(duration):
+    params = {"flags": echogarden_flags()}
+    if is_chunked(duration):
+        params["chunks"] = {"duration": chunk_duration, "overlap": chunk_overlap}
+    return params
+
 
+def is_aligned(filename, duration):
+    """
+    True when the alignment json was built from the current wav and transcript.
+    """
+    name, extension = os.path.splitext(filename)
+    return manifest.is_fresh(
+        "align",
+        os.path.join(output_directory, f"{name}.json"),
+        alignment_inputs(filename),
+        alignment_params(duration),
+    )
+
+
+async def align_with_retries(label, audio_path, transcript_path, srt_path, json_path, log_path,
+                             duration, aligner):
+    """
+    Aligns one recording or window, retrying failures and timeouts with exponential backoff.
+    Returns (status, attempts).
+    """
+    # Long recordings get proportionally more time before we consider them stuck
+    timeout = timeout_base + timeout_factor * duration
+
+    for attempt in range(1, retries + 2):
+        print(f"Processing {label} with {aligner.__class__.__name__} (attempt {attempt})...")
+
+        with open(log_path, "a", encoding="utf8") as log:
+            log.write(f"--- {time.strftime('%Y-%m-%d %H:%M:%S')} attempt {attempt}, "
+                      f"timeout {timeout:.0f} s\n")
+            log.flush()
+
+            try:
+                with metrics.section("align", duration):
+                    await asyncio.wait_for(
+                        aligner.align(audio_path, transcript_path, srt_path, json_path, log),
+                        timeout,
+                    )
+                status = "succeeded"
+            except asyncio.TimeoutError:
+                status = "timed_out"
+                log.write(f"Timed out after {timeout:.0f} s\n")
+            except Exception as e:
+                status = "failed"
+                log.write(f"{e.__class__.__name__}: {e}\n")
+
+        if status == "succeeded":
+            break
+
+        print(f"FAIL! {label}: {status.replace('_', ' ')}, see {log_path}")
+
+        # A partial output must not count as done on the next run
+        if os.path.exists(json_path):
+            os.remove(json_path)
+
+        if status == "timed_out":
+            try:
+                await aligner.reset()
+            except Exception as e:
+                # The slot goes on with the CLI, see ServerAligner.dead
+                print(f"Could not restart the echogarden server, using the CLI: {e}")
+                with open(log_path, "a", encoding="utf8") as log:
+                    log.write(f"Server restart failed, using the CLI: {e.__class__.__name__}: {e}\n")
+
+        if attempt <= retries:
+            await asyncio.sleep(retry_backoff * 2 ** (attempt - 1))
+
+    return status, attempt
+
+
+def record_outcome(filename, duration, status, attempts, elapsed, log_path, summary):
+    summary[status].append({
+        "file": filename,
+        "duration": duration,
+        "attempts": attempts,
+        "elapsed": round(elapsed, 1),
+        "log": log_path,
+    })
+
+    # Retries and backoff included, so the real-time factor shows what a recording really costs
+    metrics.add("process_file", elapsed, duration)
+    if status == "succeeded":
+        metrics.add_audio(duration)
+    metrics.write_event(args.metrics, "recording", recording=filename, status=status,
+                        attempts=attempts, seconds=elapsed, audio_seconds=duration,
+                        rtf=elapsed / duration if duration else None)
+
+
+async def process_file(filename, duration, aligner, summary):
     # split the filename into name and extension
     name, extension = os.path.splitext(filename)
 
     output_json_path = os.path.join(output_directory, f"{name}.json")
     output_srt_path = os.path.join(output_directory, f"{name}.srt")
+    log_path = os.path.join(log_directory, f"{name}.log")
 
-    if os.path.exists(output_json_path):
+    # check if we have both .wav and .txt for the same filename
+    if not (extension == ".wav" and os.path.exists(os.path.join(directory, f"{name}.txt"))):
         return
 
-    # check if we have both .wav and .txt for the same filename
-    if extension == ".wav" and os.path.exists(os.path.join(directory, f"{name}.txt")):
-        print(f"Processing {filename}...")
-
-        # construct the command to run echogarden
-        cmd = ["echogarden align"]
-
-        # modify the command with the actual file names
-        cmd.append('"' + os.path.join(directory, filename) + '"')
-        cmd.append('"' + os.path.join(directory, f"{name}.txt") + '"')
-
-        cmd.append('"' + output_srt_path + '"')
-        cmd.append('"' + output_json_path + '"')
-
-        cmd.append("--language=nl-NL")
-        cmd.append("--crop=true")
-        cmd.append(f"--engine={engine}")
-
-        gpu_id = worker_id % 2  # Assign GPU ID 0 or 1 based on worker ID
-        if engine == "dtw-ra":
-            cmd.append("--dtw.phoneAlignmentMethod=interpolation")
-            cmd.append("--recognition.engine=whisper.cpp")
-            cmd.append("--recognition.whisperCpp.model=large-v2")
-            cmd.append("--recognition.whisperCpp.build=cublas-12.4.0")
-            cmd.append("--recognition.whisperCpp.enableGPU=true")
-            cmd.append("--recognition.whisperCpp.repetitionThreshold=2")
-        if engine == "whisper":
-            cmd.append("--whisper.model=small")
-            cmd.append("--whisper.encoderProvider=cpu")
-            cmd.append("--whisper.decoderProvider=cpu")
-
-        cmd = " ".join(cmd)
-        cmd = f"set CUDA_VISIBLE_DEVICES={
-            gpu_id} & set DML_VISIBLE_DEVICES={gpu_id} & {cmd}"
-
-        print(f"{cmd}")
-
-        # run the command using subprocess
-        try:
-            subprocess.run(
-                cmd, shell=True, stdout=subprocess.DEVNULL, capture_output=False
-            )
-        except:
-            print("FAIL!")
+    started = time.monotonic()
 
+    status, attempts = await align_with_retries(
+        filename,
+        os.path.join(directory, filename),
+        os.path.join(directory, f"{name}.txt"),
+        output_srt_path,
+        output_json_path,
+        log_path,
+        duration,
+        aligner,
+    )
 
-def initializer(counter):
-    global process_counter
-    process_counter = counter
+    if status == "succeeded":
+        manifest.record("align", output_json_path, alignment_inputs(filename), alignment_params(duration))
 
+    record_outcome(filename, duration, status, attempts, time.monotonic() - started, log_path, summary)
 
-def worker_id():
-    global process_counter
-    return process_counter.get_and_increment()
 
+def split_recording(filename, duration):
+    """
+    Cuts a long recording and its transcript into overlapping windows, see
+    chunked_alignment.plan_windows. Returns the recording's state, shared by the jobs of
+    its windows.
+    """
+    name, extension = os.path.splitext(filename)
 
-class Counter:
-    def __init__(self, initial=0):
-        self.value = multiprocessing.Value("i", initial)
-        self.lock = multiprocessing.Lock()
+    with open(os.path.join(directory, f"{name}.txt"), "r", encoding="utf8") as f:
+        sentences = split_sentences(f.read())
+
+    audio_path = os.path.join(directory, filename)
+    windows = plan_windows(MappedWav(audio_path), sentences, chunk_duration, chunk_overlap)
+    paths = write_windows(audio_path, sentences, windows, os.path.join(chunk_directory, name))
+
+    return {
+        "filename": filename,
+        "duration": duration,
+        "sentences": sentences,
+        "windows": windows,
+        "paths": paths,
+        "statuses": {},
+        "attempts": 0,
+        "started": None,
+    }
+
+
+async def process_window(recording, window, aligner, summary):
+    """
+    Aligns one window of a long recording. A window whose first or last sentence ends up
+    squeezed onto its edge is widened on that side by the overlap and aligned again, up
+    to max_widenings times. The window that finishes last stitches the timelines of all
+    windows into the recording's alignment, and aligns the recording as a whole when that
+    does not cover its transcript.
+    """
+    name, extension = os.path.splitext(recording["filename"])
+    wav_path, txt_path = recording["paths"][window["index"]]
+    json_path = os.path.splitext(wav_path)[0] + ".json"
+
+    if recording["started"] is None:
+        recording["started"] = time.monotonic()
+
+    for widening in range(max_widenings + 1):
+        status, attempts = await align_with_retries(
+            f"{recording['filename']} window {window['index'] + 1}/{len(recording['windows'])}",
+            wav_path,
+            txt_path,
+            os.path.splitext(wav_path)[0] + ".srt",
+            json_path,
+            os.path.join(log_directory, f"{name}.{window['index']}.log"),
+            window["end"] - window["start"],
+            aligner,
+        )
+        if status != "succeeded" or widening == max_widenings:
+            break
+
+        with open(json_path, "r", encoding="utf8") as f:
+            widened = widen_window(window, *misfit_edges(json.load(f)), chunk_overlap, recording["duration"])
+        if widened == window:
+            break
+
+        print(f"Widening window {window['index'] + 1} of {recording['filename']} to "
+              f"{widened['start']:.0f}-{widened['end']:.0f}s, its audio missed sentences")
+        # In place, stitch_timelines reads the window bounds from recording["windows"]
+        window.update(widened)
+        write_windows(os.path.join(directory, recording["filename"]), recording["sentences"], [window],
+                      os.path.join(chunk_directory, name))
+
+    recording["statuses"][window["index"]] = status
+    recording["attempts"] = max(recording["attempts"], attempts)
+
+    if len(recording["statuses"]) == len(recording["windows"]) and not finish_recording(recording, summary):
+        # The windows missed part of the transcript, see finish_recording
+        await process_file(recording["filename"], recording["duration"], aligner, summary)
+
+
+def finish_recording(recording, summary):
+    """
+    Stitches the windows of a recording that all succeeded and records its outcome.
+    Returns False, recording nothing, when the stitched timeline lost or doubled
+    sentences, which happens when the speech rate drifts so far from the estimate of
+    plan_windows that sentences end up in a window without their audio.
+    """
+    filename, duration = recording["filename"], recording["duration"]
+    name, extension = os.path.splitext(filename)
 
-    def get_and_increment(self):
-        with self.lock:
-            current_value = self.value.value
-            self.value.value += 1
-        return current_value
+    output_json_path = os.path.join(output_directory, f"{name}.json")
+    statuses = recording["statuses"].values()
+
+    # The recording fails with its first failing window
+    status = next((status for status in statuses if status != "succeeded"), "succeeded")
+
+    if status == "succeeded":
+        timelines = []
+        for wav_path, _ in recording["paths"]:
+            with open(os.path.splitext(wav_path)[0] + ".json", "r", encoding="utf8") as f:
+                timelines.append(json.load(f))
+
+        timeline = stitch_timelines(recording["windows"], timelines)
+
+        if not covers_transcript(recording["sentences"], timeline):
+            print(f"FAIL! {filename}: the windows do not cover the transcript, aligning it as a whole")
+            with open(os.path.join(log_directory, f"{name}.log"), "a", encoding="utf8") as log:
+                log.write("Stitched windows do not match the transcript, aligning the whole recording\n")
+            shutil.rmtree(os.path.join(chunk_directory, name), ignore_errors=True)
+            return False
+
+        with open(os.path.join(output_directory, f"{name}.srt"), "w", encoding="utf8") as f:
+            f.write(timeline_to_srt(timeline))
+
+        # Written last, its existence marks the file as done
+        with open(output_json_path, "w", encoding="utf8") as f:
+            json.dump(timeline, f)
+
+        manifest.record("align", output_json_path, alignment_inputs(filename), alignment_params(duration))
+        shutil.rmtree(os.path.join(chunk_directory, name), ignore_errors=True)
+
+    record_outcome(filename, duration, status, recording["attempts"],
+                   time.monotonic() - recording["started"],
+                   os.path.join(log_directory, f"{name}.*.log"), summary)
+    return True
+
+
+def expand_jobs(jobs):
+    """
+    Replaces every long recording by the jobs of its windows when --chunk_duration is
+    set. Jobs are (filename, duration, window), where window is None for a whole
+    recording and (recording, window) for a window of a long one.
+    """
+    expanded = []
+    for filename, duration in jobs:
+        if not is_chunked(duration):
+            expanded.append((filename, duration, None))
+            continue
+
+        recording = split_recording(filename, duration)
+        print(f"Aligning {filename} as {len(recording['windows'])} windows")
+        expanded += [(filename, window["end"] - window["start"], (recording, window))
+                     for window in recording["windows"]]
+
+    # Longest first, so the long recordings do not end up as a straggler tail
+    return sorted(expanded, key=lambda job: job[1], reverse=True)
+
+
+def start_servers():
+    """
+    Returns the server URL to use for every device, None where the CLI fallback is used.
+    """
+    if server_urls:
+        return {device: server_urls[index % len(server_urls)]
+                for index, device in enumerate(devices)}, []
+
+    urls = {device: None for device in devices}
+    servers = []
+
+    missing = [module for module in ("msgpack", "websockets") if importlib.util.find_spec(module) is None]
+    if missing:
+        print(f"echogarden server backend unavailable, using the CLI: {', '.join(missing)} not installed")
+        return urls, servers
+
+    for device in devices:
+        try:
+            servers.append(EchogardenServer(device).start())
+            urls[device] = servers[-1].url
+        except Exception as e:
+            print(f"Could not start echogarden server on device {device}, using the CLI: {e}")
+
+    return urls, servers
+
+
+def plan_schedule(jobs, slots):
+    """
+    Longest processing time first: every job, longest first, goes to the slot that
+    becomes free earliest. Job cost is taken to be proportional to audio duration.
+
+    Returns the projected finish time of every slot, in seconds of audio.
+    """
+    loads = [(0.0, slot) for slot in range(len(slots))]
+    finish_times = [0.0] * len(slots)
+
+    for filename, duration, *_ in jobs:
+        load, slot = heapq.heappop(loads)
+        finish_times[slot] = load + duration
+        heapq.heappush(loads, (load + duration, slot))
+
+    return finish_times
+
+
+async def run_slot(device, url, server, jobs, summary):
+    """
+    Keeps one device slot busy: takes the longest remaining job until none are left.
+    """
+    if url is None:
+        aligner = CliAligner(device, echogarden_flags())
+    else:
+        aligner = ServerAligner(url, echogarden_flags(), server=server,
+                                fallback=CliAligner(device, echogarden_flags()))
+
+    try:
+        while True:
+            try:
+                filename, duration, window = jobs.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            if window is None:
+                await process_file(filename, duration, aligner, summary)
+            else:
+                await process_window(*window, aligner, summary)
+    finally:
+        await aligner.close()
+
+
+async def run_jobs(jobs, slots, summary):
+    if backend == "server":
+        urls, servers = start_servers()
+    else:
+        urls, servers = {device: None for device in devices}, []
+
+    servers_by_device = {server.device: server for server in servers}
+
+    jobs_queue = asyncio.Queue()
+    for job in jobs:
+        jobs_queue.put_nowait(job)
+
+    try:
+        # A slot that crashes must not take the others and the summary down with it
+        results = await asyncio.gather(*[
+            run_slot(device, urls[device], servers_by_device.get(device), jobs_queue, summary)
+            for device in slots
+        ], return_exceptions=True)
+    finally:
+        for server in servers:
+            server.stop()
+
+    for device, result in zip(slots, results):
+        if isinstance(result, Exception):
+            print(f"Slot on device {device} stopped: {result.__class__.__name__}: {result}")
 
 
 if __name__ == "__main__":
@@ -133,15 +566,59 @@ if __name__ == "__main__":
         and os.path.exists(os.path.join(directory, f"{os.path.splitext(file)[0]}.txt"))
     ]
 
-    random.shuffle(files_to_process)
-
-    # Initialize the counter
-    process_counter = Counter()
-
-    # Use ProcessPoolExecutor to process files concurrently
-    with ProcessPoolExecutor(
-        max_workers=2, initializer=initializer, initargs=(process_counter,)
-    ) as executor:
-        executor.map(process_file, [(file, worker_id()) for file in files_to_process])
+    # Copies of another recording would end up in the dataset twice
+    skipped_duplicates = []
+    index_path = os.path.join(directory, index_filename)
+    if not args.keep_duplicates and os.path.exists(index_path):
+        dedup_index = DedupIndex.load(index_path)
+        skipped_duplicates = [
+            {"file": file, "duplicate_of": dedup_index.duplicate_of(os.path.splitext(file)[0])}
+            for file in files_to_process
+            if dedup_index.duplicate_of(os.path.splitext(file)[0]) is not None
+        ]
+        files_to_process = [
+            file for file in files_to_process if dedup_index.duplicate_of(os.path.splitext(file)[0]) is None
+        ]
+        for skipped in skipped_duplicates:
+            print(f"Skipping {skipped['file']}, a duplicate of {skipped['duplicate_of']}")
+
+    durations = [
+        (file, manifest.duration(os.path.join(directory, file)) or wav_duration(os.path.join(directory, file)))
+        for file in files_to_process
+    ]
 
-    print("Done!")
+    # Long recordings become one job per window, all longest first
+    jobs = expand_jobs([(file, duration) for file, duration in durations if not is_aligned(file, duration)])
+
+    slots = [device for device in devices for _ in range(slots_per_device)]
+
+    finish_times = plan_schedule(jobs, slots)
+    total_duration = sum(job[1] for job in jobs)
+
+    print(
+        f"{len(jobs)} jobs, {total_duration / 3600:.2f} h of audio on {len(slots)} slots. "
+        f"Projected makespan: {max(finish_times, default=0) / 3600:.2f} h of audio "
+        f"(ideal {total_duration / max(len(slots), 1) / 3600:.2f} h)"
+    )
+
+    os.makedirs(log_directory, exist_ok=True)
+
+    started = time.monotonic()
+    summary = {"succeeded": [], "failed": [], "timed_out": [], "skipped_duplicates": skipped_duplicates}
+
+    # Filled in as the files finish, so an interrupted run still reports what it did
+    try:
+        asyncio.run(run_jobs(jobs, slots, summary))
+    finally:
+        with open(summary_path, "w", encoding="utf8") as f:
+            json.dump({
+                "elapsed": round(time.monotonic() - started, 1),
+                **{f"{status}_count": len(entries) for status, entries in summary.items()},
+                **summary,
+            }, f, indent=2)
+
+        print(
+            f"Done! {len(summary['succeeded'])} succeeded, {len(summary['failed'])} failed, "
+            f"{len(summary['timed_out'])} timed out. Summary written to {summary_path}"
+        )
+        print(metrics.write_summary(args.metrics, args.prometheus))
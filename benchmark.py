@@ -0,0 +1,313 @@
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import pandas as pd
+
+from metrics import Metrics, summary_table
+from synthetic_corpus import stub_transcriber, write_corpus
+
+
+repo_directory = os.path.dirname(os.path.abspath(__file__))
+
+stages = ["align", "split", "combine", "filter"]
+
+
+def load_stage(script, argv):
+    """
+    Runs a stage script as a module with the given command line. Its __main__ block is
+    skipped, so its functions can be called and its globals (e.g. the transcribers)
+    replaced before anything runs. combine.py does all its work while loading.
+    """
+    name = os.path.splitext(script)[0].replace("-", "_")
+    spec = importlib.util.spec_from_file_location(name, os.path.join(repo_directory, script))
+    module = importlib.util.module_from_spec(spec)
+
+    saved_argv = sys.argv
+    sys.argv = [script] + argv
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        sys.argv = saved_argv
+    return module
+
+
+@contextlib.contextmanager
+def quiet(verbose):
+    """
+    Hides the progress bars and prints of the stages, they would dominate the output.
+    """
+    if verbose:
+        yield
+        return
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), \
+            contextlib.redirect_stderr(devnull):
+        yield
+
+
+def use_stub_transcribers(stage):
+    for tier in stage.verification_tiers:
+        stage.transcribers[tier["name"]] = stub_transcriber(args.transcribe_latency, args.error_rate)
+
+
+def last_summary(metrics_path, stage):
+    """
+    Sections of the last run summary a stage appended to the metrics file.
+    """
+    sections = {}
+    with open(metrics_path, "r", encoding="utf8") as f:
+        for line in f:
+            record = json.loads(line)
+            if record["stage"] == stage and record["event"] == "summary":
+                sections = record["sections"]
+    return sections
+
+
+def run_align(paths):
+    """
+    align.py against the stub echogarden server, which answers after --align-latency
+    seconds. Its timelines go to a directory of their own, the later stages keep using the
+    exact timelines of the synthetic corpus.
+    """
+    # Only needed for this stage
+    from websockets.sync.server import serve
+    from echogarden_stub import handler
+
+    with serve(handler(args.align_latency), "127.0.0.1", 0, max_size=None) as server:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        port = server.socket.getsockname()[1]
+
+        subprocess.run([
+            sys.executable, os.path.join(repo_directory, "align.py"), paths["corpus"],
+            "--output_directory", os.path.join(paths["run"], "aligned"),
+            "--server_urls", f"ws://127.0.0.1:{port}",
+            "--devices", ",".join(str(slot) for slot in range(args.workers)),
+            "--slots_per_device", "1",
+            "--manifest", paths["manifest"],
+            "--metrics", paths["metrics"],
+        ], check=True, capture_output=not args.verbose)
+
+    return last_summary(paths["metrics"], "align")
+
+
+def run_split(paths, names):
+    """
+    process_file of split-wavs.py for every recording in turn, with stub transcribers in
+    place of the Whisper servers.
+    """
+    stage = load_stage("split-wavs.py", [
+        "--directory", paths["corpus"],
+        "--input-directory", paths["timelines"],
+        "--output-directory", paths["segments"],
+        "--cache-directory", os.path.join(paths["run"], "split_cache"),
+        "--manifest", paths["manifest"],
+        "--metrics", paths["metrics"],
+        "--batch-size", str(args.batch_size),
+    ] + args.split_options.split())
+    use_stub_transcribers(stage)
+
+    # process_file resets the stage's metrics for every recording, as in a pool worker
+    metrics = Metrics("split")
+    for name in names:
+        result = stage.process_file(f"{name}.json")
+        metrics.merge(result["metrics"])
+
+    return metrics.snapshot()["sections"]
+
+
+def run_combine(paths):
+    stage = load_stage("combine.py", [
+        paths["segments"],
+        "--workers", str(args.workers),
+        "--manifest", paths["manifest"],
+        "--metrics", paths["metrics"],
+    ])
+    return stage.metrics.snapshot()["sections"]
+
+
+def run_filter(paths):
+    """
+    filter_by_wer of filter-segments.py on the segments split-wavs.py kept, with stub
+    transcribers. It has a transcription cache of its own, so it transcribes every segment
+    again instead of finding them cached by split-wavs.py.
+    """
+    # combine.py rewrites the paths for WSL, the filter gets the segments as written
+    merged_path = os.path.join(paths["run"], "segments_to_filter.csv")
+    segment_csvs = [os.path.join(entry.path, "segments.csv") for entry in os.scandir(paths["segments"])
+                    if os.path.exists(os.path.join(entry.path, "segments.csv"))]
+    merged = pd.concat([pd.read_csv(path) for path in sorted(segment_csvs)], ignore_index=True)
+    merged.rename(columns={"filename": "audio"})[["audio", "sentence"]].to_csv(merged_path, index=False)
+
+    stage = load_stage("filter-segments.py", [
+        "--dataset_output_directory", os.path.join(paths["run"], "filtered"),
+        "--csv_path", merged_path,
+        "--cache_directory", os.path.join(paths["run"], "filter_cache"),
+        "--workers", str(args.workers),
+        "--batch_size", str(args.batch_size),
+        "--manifest", paths["manifest"],
+        "--metrics", paths["metrics"],
+    ] + args.filter_options.split())
+    use_stub_transcribers(stage)
+
+    # The segment paths are absolute already
+    stage.audio_root = ""
+
+    # filter_by_wer writes filtered_data.csv to the working directory
+    working_directory = os.getcwd()
+    os.chdir(paths["run"])
+    try:
+        stage.filter_by_wer(merged_path)
+    finally:
+        os.chdir(working_directory)
+
+    return stage.metrics.snapshot()["sections"]
+
+
+def benchmark(recordings):
+    """
+    Generates a corpus of the given number of recordings and times the selected stages on
+    it. Returns one summary per stage, like the ones the stages write to their metrics file.
+    """
+    run_directory = tempfile.mkdtemp(prefix=f"benchmark_{recordings}_", dir=args.work_directory)
+    paths = {
+        "run": run_directory,
+        "corpus": os.path.join(run_directory, "corpus"),
+        "timelines": os.path.join(run_directory, "timelines"),
+        "segments": os.path.join(run_directory, "segments"),
+        "manifest": os.path.join(run_directory, "pipeline_manifest.sqlite"),
+        "metrics": os.path.join(run_directory, "pipeline_metrics.jsonl"),
+    }
+
+    start_time = time.perf_counter()
+    names, audio_seconds = write_corpus(
+        paths["corpus"], paths["timelines"], recordings, args.duration, seed=args.seed,
+        words_per_second=args.words_per_second, sentence_words=args.sentence_words,
+        pause=args.pause)
+    print(f"Generated {recordings} recordings, {audio_seconds / 3600:.2f} h of audio "
+          f"in {time.perf_counter() - start_time:.1f} s")
+
+    runners = {
+        "align": lambda: run_align(paths),
+        "split": lambda: run_split(paths, names),
+        "combine": lambda: run_combine(paths),
+        "filter": lambda: run_filter(paths),
+    }
+
+    summaries = []
+    try:
+        for stage in stages:
+            if stage not in selected_stages:
+                continue
+
+            start_time = time.perf_counter()
+            with quiet(args.verbose):
+                sections = runners[stage]()
+            wall_seconds = time.perf_counter() - start_time
+
+            for section in sections.values():
+                section["rtf"] = (section["seconds"] / section["audio_seconds"]
+                                  if section["audio_seconds"] else None)
+
+            summaries.append({
+                "stage": stage,
+                "event": "benchmark",
+                "label": args.label,
+                "time": time.time(),
+                "recordings": recordings,
+                "duration": args.duration,
+                "wall_seconds": wall_seconds,
+                "audio_seconds": audio_seconds,
+                "rtf": wall_seconds / audio_seconds,
+                "audio_hours_per_hour": audio_seconds / wall_seconds,
+                "sections": sections,
+            })
+            print(summary_table(summaries[-1]))
+    finally:
+        if not args.keep:
+            shutil.rmtree(run_directory, ignore_errors=True)
+
+    return summaries
+
+
+def git_label():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=repo_directory,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Times the pipeline stages on synthetic recordings with stub models, on the CPU only.")
+    parser.add_argument("--sizes", default="1,4,16", type=str,
+                        help="Comma separated numbers of recordings to benchmark (default: 1,4,16)")
+    parser.add_argument("--duration", default=600, type=float,
+                        help="Length of every recording in seconds (default: 600)")
+    parser.add_argument("--words-per-second", default=2.5, type=float,
+                        help="Speech rate of the synthetic recordings (default: 2.5)")
+    parser.add_argument("--sentence-words", default=12, type=int,
+                        help="Average number of words per sentence (default: 12)")
+    parser.add_argument("--pause", default=0.6, type=float,
+                        help="Average silence between sentences in seconds (default: 0.6)")
+    parser.add_argument("--seed", default=0, type=int,
+                        help="Seed of the synthetic corpus (default: 0)")
+    parser.add_argument("--stages", default="split,combine,filter", type=str,
+                        help="Comma separated stages to time, of align, split, combine and filter "
+                             "(default: split,combine,filter; align needs websockets and msgpack)")
+    parser.add_argument("--transcribe-latency", default=0.0, type=float,
+                        help="Seconds the stub transcriber waits per batch, e.g. the GPU time of a batch (default: 0)")
+    parser.add_argument("--error-rate", default=0.05, type=float,
+                        help="Fraction of the words the stub transcriber gets wrong (default: 0.05)")
+    parser.add_argument("--align-latency", default=0.0, type=float,
+                        help="Seconds the stub echogarden server waits per recording (default: 0)")
+    parser.add_argument("--batch-size", default=8, type=int,
+                        help="Batch size of the verification (default: 8)")
+    parser.add_argument("--workers", default=4, type=int,
+                        help="Threads of combine.py and filter-segments.py, alignment slots of align.py (default: 4)")
+    parser.add_argument("--split-options", default="", type=str,
+                        help="Extra split-wavs.py options, e.g. \"--virtual --packing packed\"")
+    parser.add_argument("--filter-options", default="", type=str,
+                        help="Extra filter-segments.py options, e.g. \"--unit_size 64\"")
+    parser.add_argument("--output", default="benchmark_results.jsonl", type=str,
+                        help="JSON lines file the results are appended to (default: benchmark_results.jsonl)")
+    parser.add_argument("--label", default=None, type=str,
+                        help="Label of the results (default: git describe of the repository)")
+    parser.add_argument("--work-directory", default=None, type=str,
+                        help="Where the corpora are generated (default: the system temp directory)")
+    parser.add_argument("--keep", action="store_true",
+                        help="Keep the generated corpora and outputs")
+    parser.add_argument("--verbose", action="store_true",
+                        help="Show the output of the stages")
+
+    args = parser.parse_args()
+
+    selected_stages = args.stages.split(",")
+    unknown_stages = set(selected_stages) - set(stages)
+    if unknown_stages:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown_stages))}")
+    if args.label is None:
+        args.label = git_label()
+
+    results = []
+    for recordings in [int(size) for size in args.sizes.split(",")]:
+        summaries = benchmark(recordings)
+        results += summaries
+
+        with open(args.output, "a", encoding="utf8") as f:
+            for summary in summaries:
+                f.write(json.dumps(summary) + "\n")
+
+    # Scaling with the corpus size: the RTF of a stage should stay flat
+    print(f"\n{'stage':<10}{'recordings':>12}{'audio h':>10}{'wall s':>10}{'RTF':>10}{'audio h/h':>12}")
+    for summary in sorted(results, key=lambda summary: (stages.index(summary["stage"]), summary["recordings"])):
+        print(f"{summary['stage']:<10}{summary['recordings']:>12}{summary['audio_seconds'] / 3600:>10.2f}"
+              f"{summary['wall_seconds']:>10.1f}{summary['rtf']:>10.4f}{summary['audio_hours_per_hour']:>12.1f}")
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+def normalize_path(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+class BuildManifest:
+    """
+    Records which input contents and parameters every pipeline output was built from.
+
+    align.py, split-wavs.py, combine.py and filter-segments.py share one manifest. An
+    output is only considered up to date when it exists, all its inputs still hash the
+    same and it was built with the same parameters, so interrupted runs and edited
+    transcripts are rebuilt while everything else is skipped.
+
+    File hashes are cached on (size, mtime), so unchanged multi-hour recordings are not
+    read again on every run. ingest.py also records the duration of every recording, so
+    later stages do not have to probe the audio again.
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        # Several pool workers share the database, so wait for locks instead of failing
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS outputs ("
+            "stage TEXT NOT NULL, output TEXT NOT NULL, inputs TEXT NOT NULL, "
+            "params TEXT NOT NULL, built REAL NOT NULL, PRIMARY KEY (stage, output))")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS file_hashes ("
+            "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime INTEGER NOT NULL, hash TEXT NOT NULL)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS audio_durations ("
+            "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime INTEGER NOT NULL, duration REAL NOT NULL)")
+        self.connection.commit()
+
+    def file_hash(self, path):
+        """
+        Content hash of a file, or None when it does not exist.
+        """
+        path = normalize_path(path)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        row = self.connection.execute(
+            "SELECT size, mtime, hash FROM file_hashes WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO file_hashes (path, size, mtime, hash) VALUES (?, ?, ?, ?)",
+                (path, stat.st_size, stat.st_mtime_ns, digest.hexdigest()))
+
+        return digest.hexdigest()
+
+    def record_duration(self, path, duration):
+        """
+        Stores the duration in seconds of an audio file, valid until the file changes.
+        """
+        path = normalize_path(path)
+        stat = os.stat(path)
+
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO audio_durations (path, size, mtime, duration) VALUES (?, ?, ?, ?)",
+                (path, stat.st_size, stat.st_mtime_ns, duration))
+
+    def duration(self, path):
+        """
+        Recorded duration in seconds of an audio file, or None when it was not recorded
+        or the file changed since.
+        """
+        path = normalize_path(path)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        row = self.connection.execute(
+            "SELECT size, mtime, duration FROM audio_durations WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+        return None
+
+    def input_hashes(self, inputs):
+        return {normalize_path(path): self.file_hash(path) for path in inputs}
+
+    def is_fresh(self, stage, output, inputs, params):
+        """
+        True when output exists and was built from the current contents of inputs with params.
+        """
+        if not os.path.exists(output):
+            return False
+
+        row = self.connection.execute(
+            "SELECT inputs, params FROM outputs WHERE stage = ? AND output = ?",
+            (stage, normalize_path(output))).fetchone()
+
+        if row is None:
+            return False
+
+        return (row[1] == json.dumps(params, sort_keys=True)
+                and json.loads(row[0]) == self.input_hashes(inputs))
+
+    def has_record(self, stage, output):
+        """
+        True when output was ever recorded for stage, whether or not it is still fresh.
+        """
+        return self.connection.execute(
+            "SELECT 1 FROM outputs WHERE stage = ? AND output = ?",
+            (stage, normalize_path(output))).fetchone() is not None
+
+    def record(self, stage, output, inputs, params):
+        """
+        Marks output as built from the current contents of inputs with params.
+        Call this only after the output was completely written.
+        """
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO outputs (stage, output, inputs, params, built) VALUES (?, ?, ?, ?, ?)",
+                (stage, normalize_path(output), json.dumps(self.input_hashes(inputs), sort_keys=True),
+                 json.dumps(params, sort_keys=True), time.time()))
+
+    def close(self):
+        self.connection.close()
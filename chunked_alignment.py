@@ -0,0 +1,243 @@
+import difflib
+import os
+import re
+
+import numpy as np
+
+from wav_io import MappedWav, write_wav
+
+
+def split_sentences(transcript):
+    """
+    The sentences of a transcript: every line, further split after . ! and ?
+    """
+    return [sentence for sentence in re.split(r"(?<=[.!?])\s+|\s*\n\s*", transcript.strip()) if sentence]
+
+
+def quietest_time(audio, time, search=5.0, frame=0.1):
+    """
+    Middle of the quietest frame of frame seconds within search seconds of time, so a
+    window never starts or ends in the middle of a word.
+    """
+    start = max(0.0, time - search)
+    samples = audio.slice_ms(start * 1000, (time + search) * 1000).astype(np.float32)
+
+    frame_length = int(frame * audio.frame_rate)
+    frame_count = len(samples) // frame_length
+    if frame_count == 0:
+        return time
+
+    energy = (samples[:frame_count * frame_length].reshape(frame_count, -1) ** 2).mean(axis=1)
+    return start + (int(np.argmin(energy)) + 0.5) * frame
+
+
+def speech_positions(audio, fractions, frame=0.1, dynamic_range=30.0, block_frames=36000):
+    """
+    Where in the recording the given fractions (0..1) of its speech have been spoken, in
+    seconds. Frames of frame seconds within dynamic_range dB of the loudest speech count as
+    speech, so pauses and silent stretches do not move the estimate.
+    """
+    frame_length = int(frame * audio.frame_rate)
+    frame_count = len(audio.samples) // frame_length
+    if frame_count == 0:
+        return np.zeros(len(fractions))
+
+    # Read in blocks, so the memory map is never converted whole
+    energy = np.concatenate([
+        (audio.samples[start * frame_length:min(start + block_frames, frame_count) * frame_length, 0]
+         .astype(np.float32).reshape(-1, frame_length) ** 2).mean(axis=1)
+        for start in range(0, frame_count, block_frames)])
+
+    speech = energy > np.percentile(energy, 95) * 10 ** (-dynamic_range / 10)
+    spoken = np.cumsum(speech)
+    if spoken[-1] == 0:
+        return np.asarray(fractions, dtype=np.float64) * audio.duration_seconds
+
+    # The first speech frame after that much speech, not a pause before it
+    frames = np.searchsorted(spoken, np.asarray(fractions, dtype=np.float64) * spoken[-1], side="right")
+    return np.minimum(frames, frame_count - 1) * frame
+
+
+def plan_windows(audio, sentences, window_duration, overlap):
+    """
+    Splits a recording into overlapping windows of about window_duration seconds that can
+    be aligned independently.
+
+    The windows meet at anchor points: the quietest moment near every multiple of the
+    window length. Every window's audio reaches overlap seconds past its anchors, its
+    transcript (first_sentence..last_sentence, inclusive) only half as far, since the
+    alignment copes better with audio that is not in the transcript than the other way
+    round. Where a sentence is spoken is estimated from the character offset of its
+    middle in the transcript, assuming a constant speech rate while there is speech
+    (speech_positions); the middle, as a sentence right after a long pause could
+    otherwise be placed before it.
+    """
+    duration = audio.duration_seconds
+    count = max(1, round(duration / window_duration))
+
+    anchors = [0.0] + [quietest_time(audio, duration * index / count)
+                       for index in range(1, count)] + [duration]
+
+    lengths = np.array([len(sentence) + 1 for sentence in sentences], dtype=np.float64)
+    sentence_middles = speech_positions(audio, (np.cumsum(lengths) - lengths / 2) / max(lengths.sum(), 1))
+
+    windows = []
+    for index in range(count):
+        first_sentence = int(np.searchsorted(sentence_middles, anchors[index] - overlap / 2)) if index else 0
+        last_sentence = (int(np.searchsorted(sentence_middles, anchors[index + 1] + overlap / 2)) - 1
+                         if index < count - 1 else len(sentences) - 1)
+
+        windows.append({
+            "index": index,
+            "start": max(0.0, anchors[index] - overlap) if index else 0.0,
+            "end": min(duration, anchors[index + 1] + overlap),
+            "first_sentence": first_sentence,
+            "last_sentence": max(last_sentence, first_sentence),
+        })
+
+    return windows
+
+
+def write_windows(wav_file, sentences, windows, output_dir):
+    """
+    Writes the audio and transcript of every window to output_dir as <index>.wav and
+    <index>.txt. Returns their paths.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    audio = MappedWav(wav_file)
+
+    paths = []
+    for window in windows:
+        wav_path = os.path.join(output_dir, f"{window['index']}.wav")
+        txt_path = os.path.join(output_dir, f"{window['index']}.txt")
+
+        write_wav(wav_path, audio.slice_ms(window["start"] * 1000, window["end"] * 1000).tobytes(),
+                  audio.frame_rate, audio.channels, audio.sample_width)
+        with open(txt_path, "w", encoding="utf8") as f:
+            f.write("\n".join(sentences[window["first_sentence"]:window["last_sentence"] + 1]) + "\n")
+
+        paths.append((wav_path, txt_path))
+
+    return paths
+
+
+def misfit_edges(timeline, seconds_per_word=0.05):
+    """
+    Whether the first and the last sentence of an aligned window were squeezed onto its
+    edges, which echogarden does with sentences whose audio is not in the window.
+    Returns (early, late): the audio of the first sentence lies before the window, or
+    that of the last one after it.
+    """
+    sentences = [sentence for item in timeline for sentence in item.get("timeline", [])]
+    if not sentences:
+        return False, False
+
+    def squeezed(sentence):
+        words = max(len(sentence["text"].split()), 1)
+        return sentence["endTime"] - sentence["startTime"] < seconds_per_word * words
+
+    return squeezed(sentences[0]), squeezed(sentences[-1])
+
+
+def widen_window(window, early, late, amount, duration):
+    """
+    Copy of a window with its audio reaching amount seconds further on the misfit sides,
+    within the recording. The transcript stays the same.
+    """
+    return {
+        **window,
+        "start": max(0.0, window["start"] - amount) if early else window["start"],
+        "end": min(duration, window["end"] + amount) if late else window["end"],
+    }
+
+
+def shift_timeline(timeline, offset):
+    """
+    Copy of an echogarden timeline with all its times, at every level, moved by offset seconds.
+    """
+    shifted = []
+    for entry in timeline:
+        entry = dict(entry)
+        for key in ("startTime", "endTime"):
+            if key in entry:
+                entry[key] += offset
+        if "timeline" in entry:
+            entry["timeline"] = shift_timeline(entry["timeline"], offset)
+        shifted.append(entry)
+    return shifted
+
+
+def normalize(text):
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+
+def reconcile(previous, current, overlap_start, overlap_end):
+    """
+    Where to switch from the sentences of one window to those of the next within their
+    overlap. Returns (cut_previous, cut_current): the sentences before cut_previous are
+    kept from the first window, the ones from cut_current on from the second.
+
+    Sentences that both windows aligned are matched on their text; the switch is made at
+    the matched sentence whose start time the two windows agree on best, so the edges of
+    the windows, where the alignment is least reliable, are not used. Without any match
+    the windows share no sentences and all of both are kept.
+    """
+    first_previous = next((index for index, sentence in enumerate(previous)
+                           if sentence["startTime"] >= overlap_start), len(previous))
+    last_current = next((index for index, sentence in enumerate(current)
+                         if sentence["endTime"] > overlap_end), len(current))
+
+    matcher = difflib.SequenceMatcher(
+        None, [normalize(sentence["text"]) for sentence in previous[first_previous:]],
+        [normalize(sentence["text"]) for sentence in current[:last_current]], autojunk=False)
+
+    middle = (overlap_start + overlap_end) / 2
+    best = None
+    for block in matcher.get_matching_blocks():
+        for offset in range(block.size):
+            cut_previous = first_previous + block.a + offset
+            cut_current = block.b + offset
+            start = previous[cut_previous]["startTime"]
+            key = (abs(start - current[cut_current]["startTime"]), abs(start - middle))
+            if best is None or key < best[0]:
+                best = (key, cut_previous, cut_current)
+
+    if best is None:
+        return len(previous), 0
+
+    return best[1], best[2]
+
+
+def covers_transcript(sentences, timeline):
+    """
+    True when the sentences of a stitched timeline are exactly the transcript's, word for
+    word, so no sentence was lost or doubled where the windows were joined.
+    """
+    aligned = [sentence["text"] for item in timeline for sentence in item.get("timeline", [])]
+    return normalize(" ".join(aligned)) == normalize(" ".join(sentences))
+
+
+def stitch_timelines(windows, timelines):
+    """
+    Joins the timelines of the windows of a recording, aligned separately and in window
+    time, into one segment > sentence timeline in recording time, as split-wavs.py reads it.
+    """
+    sentences = []
+    for index, (window, timeline) in enumerate(zip(windows, timelines)):
+        current = [sentence for item in shift_timeline(timeline, window["start"])
+                   for sentence in item.get("timeline", [])]
+
+        if index == 0:
+            sentences = current
+            continue
+
+        cut_previous, cut_current = reconcile(sentences, current, window["start"], windows[index - 1]["end"])
+        sentences = sentences[:cut_previous] + current[cut_current:]
+
+    return [{
+        "type": "segment",
+        "text": " ".join(sentence["text"] for sentence in sentences),
+        "startTime": sentences[0]["startTime"] if sentences else 0.0,
+        "endTime": sentences[-1]["endTime"] if sentences else 0.0,
+        "timeline": sentences,
+    }]
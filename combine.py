@@ -1,8 +1,18 @@
 import os
+import sys
 import csv
+import ntpath
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from sklearn.model_selection import train_test_split
 import argparse
+from build_manifest import BuildManifest
+from dedup_index import DedupIndex, group_train_test_split, segment_recording
+from metrics import Metrics
+from dataset_shards import segment_key, write_shards
+from wav_io import read_segment_wav
 
 def windows_to_wsl_path(windows_path: str) -> str:
     """
@@ -14,13 +24,15 @@ def windows_to_wsl_path(windows_path: str) -> str:
     Returns:
     - str: The converted WSL Ubuntu file path.
     """
-    import os
+    # Anything but an absolute path on a drive, e.g. a path written on Linux, stays as it is
+    if not re.match(r'[A-Za-z]:[\\/]', windows_path):
+        return windows_path
     
-    # Normalize path to ensure consistent format
-    windows_path = os.path.normpath(windows_path)
+    # Normalize path to ensure consistent format, with Windows rules on any host
+    windows_path = ntpath.normpath(windows_path)
     
     # Split the path into drive and the rest of the path
-    drive, path = os.path.splitdrive(windows_path)
+    drive, path = ntpath.splitdrive(windows_path)
     
     # Remove the colon from the drive (e.g., 'C:' -> 'c')
     drive_letter = drive[0].lower()
@@ -34,44 +46,195 @@ def windows_to_wsl_path(windows_path: str) -> str:
     return wsl_path
 
 
+def windows_to_wsl_paths(windows_paths: pd.Series) -> pd.Series:
+    """
+    Vectorized windows_to_wsl_path for a whole column of absolute Windows paths. Values
+    that are not an absolute Windows path, e.g. paths written on Linux, are left as they are.
+    
+    Args:
+    - windows_paths (pd.Series): The Windows file paths to convert.
+    
+    Returns:
+    - pd.Series: The converted WSL Ubuntu file paths.
+    """
+    is_windows = windows_paths.str.match(r'[A-Za-z]:[\\/]', na=False)
+    paths = windows_paths[is_windows]
+    
+    # Only the few paths with '..' components need a full normpath
+    parents = paths.str.contains(r'(?:^|[\\/])\.\.(?:[\\/]|$)', regex=True)
+    paths = paths.where(~parents, paths[parents].map(ntpath.normpath))
+    
+    # Forward slashes only, without duplicate separators or '.' components
+    paths = paths.str.replace('\\', '/', regex=False)
+    paths = paths.str.replace(r'/+', '/', regex=True)
+    paths = paths.str.replace(r'/(\./)+', '/', regex=True)
+    
+    # 'C:/...' -> '/mnt/c/...'
+    wsl_paths = windows_paths.copy()
+    wsl_paths[is_windows] = '/mnt/' + paths.str[0].str.lower() + paths.str[2:]
+    return wsl_paths
+
+
+def find_segment_csvs(directory):
+    return [
+        os.path.join(subdir, 'segments.csv')
+        for subdir, _, files in os.walk(directory)
+        if 'segments.csv' in files
+    ]
+
+
+def read_segments(file_path):
+    start_time = time.perf_counter()
+    
+    # Read the CSV file into a DataFrame
+    df = pd.read_csv(file_path)
+    
+    # The durations are in milliseconds
+    audio_seconds = df['duration'].sum() / 1000
+    metrics.add('read_segments', time.perf_counter() - start_time, audio_seconds)
+    metrics.add_audio(audio_seconds)
+    
+    # Rename the 'filename' column to 'audio'
+    df = df.rename(columns={'filename': 'audio'})
+    
+    # Drop the 'duration' column
+    df = df.drop(columns=['duration'])
+    
+    df['audio'] = df['audio'].astype(str)
+    
+    return df
+
+
+def to_wsl(df):
+    return df.assign(audio=windows_to_wsl_paths(df['audio']))
+
+
+def export_shards(df, output_dir):
+    samples = [
+        {'key': segment_key(row.audio), 'audio': row.audio, 'metadata': {'sentence': row.sentence}}
+        for row in df.itertuples(index=False)
+    ]
+    with metrics.section('export_shards'):
+        shard_count = write_shards(samples, output_dir, shard_size=args.shard_size, workers=args.workers, load_audio=read_segment_wav)
+    print(f"Wrote {len(samples)} segments to {shard_count} shards in {output_dir}")
+
+
+class ParquetStreamWriter:
+    """
+    Appends DataFrames to a Parquet file one at a time. Requires pyarrow.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+    
+    def write(self, df):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table.cast(self.writer.schema))
+    
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
 # Define and parse command line arguments
 parser = argparse.ArgumentParser(description="Process engine output files from a specified directory.")
 parser.add_argument("input_directory", type=str, help="The root directory containing subdirectories")
 parser.add_argument("--engine", type=str, default="dtw-ra", choices=["dtw", "dtw-ra", "whisper"], help="The engine to use (default: dtw-ra)")
+parser.add_argument("--manifest", type=str, default="pipeline_manifest.sqlite", help="Build manifest shared by all pipeline stages (default: pipeline_manifest.sqlite)")
+parser.add_argument("--workers", type=int, default=8, help="Number of threads scanning and reading segments.csv files (default: 8)")
+parser.add_argument("--parquet", action="store_true", help="Also write the merged, train and test segments as Parquet (requires pyarrow)")
+parser.add_argument("--shards_directory", type=str, default=None, help="Also export the train and test segments with embedded audio as tar shards to this directory")
+parser.add_argument("--shard_size", type=int, default=1000, help="Number of segments per shard (default: 1000)")
+parser.add_argument("--dedup_index", type=str, default=None, help="dedup_index.json written by ingest.py; the segments of related recordings are kept on the same side of the train/test split")
+parser.add_argument("--metrics", type=str, default="pipeline_metrics.jsonl", help="JSON lines file the timings of the run are appended to (default: pipeline_metrics.jsonl)")
+parser.add_argument("--prometheus", type=str, default=None, help="Also write the run summary in Prometheus text format to this file")
 args = parser.parse_args()
 
+# Timings of the hot sections, shared by the reader threads
+metrics = Metrics("combine")
+
 # Use the parsed arguments
 main_directory = args.input_directory
 engine = args.engine
 
-# Initialize an empty DataFrame to hold all the merged data
-merged_df = pd.DataFrame()
+output_names = ['merged_segments', 'merged_segments_train', 'merged_segments_test']
+output_paths = [os.path.join(main_directory, f"{name}.csv") for name in output_names]
+if args.parquet:
+    output_paths += [os.path.join(main_directory, f"{name}.parquet") for name in output_names]
+if args.shards_directory:
+    output_paths += [os.path.join(args.shards_directory, split, 'index.jsonl') for split in ['train', 'test']]
+split_params = {"test_size": 0.10, "random_state": 42}
+combine_params = {**split_params, "shard_size": args.shard_size if args.shards_directory else None}
+# The splits depend on the grouping of the recordings too
+index_inputs = [args.dedup_index] if args.dedup_index else []
 
+with ThreadPoolExecutor(max_workers=args.workers) as executor:
+    # Find the segments.csv of every recording, one subdirectory per thread
+    subdirectories = [entry.path for entry in os.scandir(main_directory) if entry.is_dir()]
+    segment_csvs = [path for paths in executor.map(find_segment_csvs, subdirectories) for path in paths]
+    if os.path.exists(os.path.join(main_directory, 'segments.csv')):
+        segment_csvs.append(os.path.join(main_directory, 'segments.csv'))
+    segment_csvs.sort()
+    
+    manifest = BuildManifest(args.manifest)
+    
+    # Nothing to do when none of the recordings was split again since the last merge
+    if all(manifest.is_fresh("combine", path, segment_csvs + index_inputs, combine_params) for path in output_paths):
+        print("Merged segments are up to date")
+        sys.exit(0)
+    
+    merged_csv_path = os.path.join(main_directory, 'merged_segments.csv')
+    parquet_writer = ParquetStreamWriter(os.path.join(main_directory, 'merged_segments.parquet')) if args.parquet else None
+    
+    frames = []
+    
+    # The CSVs are parsed in parallel and streamed to the merged outputs in order, so the
+    # cost stays linear in the number of recordings
+    with open(merged_csv_path + '.tmp', 'w', newline='', encoding='utf-8') as merged_csv:
+        for df in executor.map(read_segments, segment_csvs):
+            with metrics.section('write_merged'):
+                wsl_df = to_wsl(df)
+                wsl_df.to_csv(merged_csv, index=False, header=not frames, quoting=csv.QUOTE_ALL)
+                if parquet_writer is not None:
+                    parquet_writer.write(wsl_df)
+            frames.append(df)
+    
+    if parquet_writer is not None:
+        parquet_writer.close()
+    os.replace(merged_csv_path + '.tmp', merged_csv_path)
 
-# Loop through each subdirectory in the main directory
-for subdir, _, files in os.walk(main_directory):
-    if 'segments.csv' in files:
-        # Construct the full path to the CSV file
-        file_path = os.path.join(subdir, 'segments.csv')
-        
-        # Read the CSV file into a DataFrame
-        df = pd.read_csv(file_path)
-        
-        # Rename the 'filename' column to 'audio'
-        df = df.rename(columns={'filename': 'audio'})
-        
-        # Drop the 'duration' column
-        df = df.drop(columns=['duration'])
-        
-        # Append the DataFrame to the merged DataFrame
-        merged_df = pd.concat([merged_df, df], ignore_index=True)
+# A single concat at the end instead of one per recording
+merged_df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['audio', 'sentence'])
+
+if args.dedup_index:
+    dedup_index = DedupIndex.load(args.dedup_index)
+    groups = [dedup_index.group(segment_recording(audio)) for audio in merged_df['audio']]
+    train_df, test_df = group_train_test_split(merged_df, groups, **split_params)
+else:
+    train_df, test_df = train_test_split(merged_df, **split_params)
 
-merged_df['audio'] = merged_df['audio'].apply(windows_to_wsl_path)
 
-train_df, test_df = train_test_split(merged_df, test_size=0.10, random_state=42)
+# Save the train and test portions
+with metrics.section('write_splits'):
+    to_wsl(train_df).to_csv(os.path.join(main_directory, 'merged_segments_train.csv'), index=False, quoting=csv.QUOTE_ALL)
+    to_wsl(test_df).to_csv(os.path.join(main_directory, 'merged_segments_test.csv'), index=False, quoting=csv.QUOTE_ALL)
+    
+    if args.parquet:
+        to_wsl(train_df).to_parquet(os.path.join(main_directory, 'merged_segments_train.parquet'), index=False)
+        to_wsl(test_df).to_parquet(os.path.join(main_directory, 'merged_segments_test.parquet'), index=False)
+
+# The shards embed the audio, read from the paths as written by split-wavs.py on this host
+if args.shards_directory:
+    export_shards(train_df, os.path.join(args.shards_directory, 'train'))
+    export_shards(test_df, os.path.join(args.shards_directory, 'test'))
 
+for path in output_paths:
+    manifest.record("combine", path, segment_csvs + index_inputs, combine_params)
 
-# Save the merged DataFrame to a new CSV file
-merged_df.to_csv(os.path.join(main_directory, 'merged_segments.csv'), index=False, quoting=csv.QUOTE_ALL)
-train_df.to_csv(os.path.join(main_directory, 'merged_segments_train.csv'), index=False, quoting=csv.QUOTE_ALL)
-test_df.to_csv(os.path.join(main_directory, 'merged_segments_test.csv'), index=False, quoting=csv.QUOTE_ALL)
+print(metrics.write_summary(args.metrics, args.prometheus))
@@ -0,0 +1,155 @@
+import io
+import json
+import os
+import tarfile
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+from wav_io import parse_segment_ref
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def wav_bytes_duration(audio):
+    """
+    Duration in seconds of an in-memory wav file.
+    """
+    with wave.open(io.BytesIO(audio), 'rb') as wav:
+        return wav.getnframes() / wav.getframerate()
+
+
+def segment_key(audio_path):
+    """
+    Host independent sample key from a segment path, e.g.
+    'C:\\out\\audio_segments_foo\\12.wav' -> 'audio_segments_foo/12', or from a virtual
+    segment reference, e.g. 'C:\\data\\foo.wav#44-960044' -> 'foo/44-960044'
+    """
+    audio_path, start_byte, end_byte = parse_segment_ref(audio_path)
+    parts = audio_path.replace('\\', '/').split('/')
+
+    if start_byte is not None:
+        return f"{os.path.splitext(parts[-1])[0]}/{start_byte}-{end_byte}"
+    return '/'.join(parts[-2:-1] + [os.path.splitext(parts[-1])[0]])
+
+
+def add_member(tar, name, data):
+    """
+    Adds data to the tar and returns the byte offset of the data in the file.
+    """
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+
+    header = info.tobuf(tar.format, tar.encoding, tar.errors)
+    data_offset = tar.offset + len(header)
+
+    tar.addfile(info, io.BytesIO(data))
+    return data_offset
+
+
+def write_shard(shard_path, samples, load_audio):
+    """
+    Writes one tar shard with a <n>.wav and a <n>.json member per sample, WebDataset style.
+    Returns the index entries: where every sample's audio lives inside the shard plus its metadata.
+    """
+    entries = []
+
+    with tarfile.open(shard_path + '.tmp', 'w', format=tarfile.USTAR_FORMAT) as tar:
+        for sample in samples:
+            audio = load_audio(sample['audio'])
+            metadata = {'key': sample['key'], 'duration': wav_bytes_duration(audio),
+                        **sample.get('metadata', {})}
+
+            # Member names must stay short and unique in the shard, the key goes in the json
+            name = f"{len(entries):06d}"
+            offset = add_member(tar, f"{name}.wav", audio)
+            add_member(tar, f"{name}.json", json.dumps(metadata, ensure_ascii=False).encode('utf-8'))
+
+            entries.append({
+                'shard': os.path.basename(shard_path),
+                'offset': offset,
+                'size': len(audio),
+                **metadata,
+            })
+
+    os.replace(shard_path + '.tmp', shard_path)
+    return entries
+
+
+def write_shards(samples, output_dir, shard_size=1000, workers=4, load_audio=read_file):
+    """
+    Packs samples into tar shards of shard_size samples, written in parallel, plus an
+    index.jsonl with the shard, byte offset and metadata of every sample.
+
+    samples is a list of dicts with 'key', 'audio' (passed to load_audio, which returns the
+    wav bytes) and optionally 'metadata' (sentence, wer, ...). Returns the number of shards.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Shards of an earlier, larger export would otherwise be left behind
+    for filename in os.listdir(output_dir):
+        if filename.startswith('shard-') and filename.endswith('.tar'):
+            os.remove(os.path.join(output_dir, filename))
+
+    shards = [samples[start:start + shard_size]
+              for start in range(0, len(samples), shard_size)]
+    shard_paths = [os.path.join(output_dir, f"shard-{index:05d}.tar")
+                   for index in range(len(shards))]
+
+    # Writing a shard is mostly file I/O, threads keep the callers' module-level scripts
+    # from being re-imported by worker processes
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        shard_entries = list(executor.map(
+            write_shard, shard_paths, shards, [load_audio] * len(shards)))
+
+    with open(os.path.join(output_dir, 'index.jsonl.tmp'), 'w', encoding='utf-8') as f:
+        for entries in shard_entries:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+    os.replace(os.path.join(output_dir, 'index.jsonl.tmp'), os.path.join(output_dir, 'index.jsonl'))
+
+    return len(shards)
+
+
+class ShardReader:
+    """
+    Random access to exported shards through their index.
+
+        reader = ShardReader('shards/train')
+        audio, metadata = reader[42]
+
+    Reading the shards front to back (iterating the reader) is a sequential bulk read.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'index.jsonl'), 'r', encoding='utf-8') as f:
+            self.index = [json.loads(line) for line in f]
+        self.files = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, index):
+        entry = self.index[index]
+
+        f = self.files.get(entry['shard'])
+        if f is None:
+            f = self.files[entry['shard']] = open(
+                os.path.join(self.directory, entry['shard']), 'rb')
+
+        f.seek(entry['offset'])
+        metadata = {key: value for key, value in entry.items()
+                    if key not in ('shard', 'offset', 'size')}
+        return f.read(entry['size']), metadata
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
@@ -0,0 +1,389 @@
+import json
+import os
+import re
+import zlib
+from collections import defaultdict
+
+import numpy as np
+
+from wav_io import MappedWav
+
+
+# Written by ingest.py next to the recordings it indexed
+index_filename = "dedup_index.json"
+
+# Hash values and MinHash permutations live below this Mersenne prime, so a * x + b fits in 64 bits
+PRIME = (1 << 31) - 1
+
+default_params = {
+    # Changes with audio_fingerprint, so the signatures cached by ingest.py are computed again
+    "fingerprint_version": 2,
+    "shingle_size": 5,
+    "num_perm": 128,
+    # Bands of the LSH tables; more bands find pairs with a lower similarity
+    "transcript_bands": 64,
+    "audio_bands": 64,
+    # Skipped as a copy of a kept recording: (nearly) the same transcript, or (nearly) all
+    # of its audio and transcript contained in the kept recording
+    "duplicate_transcript_similarity": 0.9,
+    "duplicate_audio_overlap": 0.9,
+    "duplicate_transcript_overlap": 0.9,
+    # Kept, but grouped with the other recording above either of these
+    "related_transcript_overlap": 0.3,
+    "related_audio_overlap": 0.25,
+}
+
+# Audio fingerprint: pairs of spectral peaks of a 4 kHz downsampled copy of the audio,
+# 64 ms frames every 16 ms
+FINGERPRINT_RATE = 4000
+FINGERPRINT_FRAME = 256
+FINGERPRINT_HOP = 64
+# A peak is the maximum within this many frames and frequency bins around it
+PEAK_FRAMES = 8
+PEAK_BINS = 6
+# Every peak is combined with two of the this many following peaks, at most MAX_PAIR_FRAMES later
+PAIR_FANOUT = 6
+MAX_PAIR_FRAMES = 63
+
+
+def permutations(num_perm, seed=1):
+    rng = np.random.default_rng(seed)
+    return (rng.integers(1, PRIME, num_perm, dtype=np.uint64),
+            rng.integers(0, PRIME, num_perm, dtype=np.uint64))
+
+
+def minhash(values, num_perm=128, block_size=16384):
+    """
+    MinHash signature of a set of hash values below PRIME, as num_perm uint64 values.
+    """
+    a, b = permutations(num_perm)
+    signature = np.full(num_perm, PRIME, dtype=np.uint64)
+
+    values = np.asarray(values, dtype=np.uint64)
+    for start in range(0, len(values), block_size):
+        block = values[start:start + block_size]
+        hashes = (a[:, None] * block[None, :] + b[:, None]) % PRIME
+        signature = np.minimum(signature, hashes.min(axis=1))
+
+    return signature
+
+
+def transcript_shingles(text, shingle_size=5):
+    """
+    Hashes of the word shingles of a transcript, after lowercasing and dropping punctuation.
+    """
+    words = re.findall(r"\w+", text.lower())
+    shingle_size = min(shingle_size, len(words))
+    if shingle_size == 0:
+        return np.zeros(0, dtype=np.uint64)
+
+    shingles = {" ".join(words[index:index + shingle_size])
+                for index in range(len(words) - shingle_size + 1)}
+    return np.array([zlib.crc32(shingle.encode("utf8")) % PRIME for shingle in shingles], dtype=np.uint64)
+
+
+def mix(values):
+    """
+    Spreads 64-bit keys uniformly over the hash values below PRIME (splitmix64 finalizer).
+    """
+    values = values.astype(np.uint64)
+    values ^= values >> np.uint64(31)
+    values *= np.uint64(0x7FB5D329728EA185)
+    values ^= values >> np.uint64(27)
+    values *= np.uint64(0x81DADEF4BC2DD44D)
+    values ^= values >> np.uint64(33)
+    return values % np.uint64(PRIME)
+
+
+def audio_fingerprint(wav_file, block_frames=8192):
+    """
+    Hashes of triplets of spectral peaks of a wav (frequency of the first peak, frequency
+    and time differences of the two others), in the style of landmark audio fingerprints.
+    Peaks survive re-encoding and triplets do not depend on where the recording starts,
+    so copies of a recording share a large part of them. Pairs of peaks would be more
+    robust, but there are too few distinct ones: hours of unrelated audio share most of them.
+    """
+    audio = MappedWav(wav_file)
+    decimation = max(1, audio.frame_rate // FINGERPRINT_RATE)
+
+    # Downsampled by averaging, read in chunks so the memory map is never converted whole
+    usable = audio.frame_count - audio.frame_count % decimation
+    chunk = decimation * 1024 * 1024
+    decimated = np.concatenate([np.zeros(0, dtype=np.float32)] + [
+        audio.samples[start:min(start + chunk, usable), 0].astype(np.float32).reshape(-1, decimation).mean(axis=1)
+        for start in range(0, usable, chunk)])
+
+    if len(decimated) < FINGERPRINT_FRAME + FINGERPRINT_HOP:
+        return np.zeros(0, dtype=np.uint64)
+
+    frames = np.lib.stride_tricks.sliding_window_view(decimated, FINGERPRINT_FRAME)[::FINGERPRINT_HOP]
+    window = np.hanning(FINGERPRINT_FRAME).astype(np.float32)
+
+    peak_times = []
+    peak_bins = []
+    for start in range(0, len(frames), block_frames):
+        # With the neighbouring frames, so peaks at the edges of a block are found as well
+        first = max(0, start - PEAK_FRAMES)
+        last = min(len(frames), start + block_frames + PEAK_FRAMES)
+        spectrum = np.log(np.abs(np.fft.rfft(frames[first:last] * window, axis=1)) ** 2 + 1e-6)
+
+        # A maximum filter is separable: over the bins first, then over the frames
+        padded = np.pad(spectrum, ((0, 0), (PEAK_BINS, PEAK_BINS)), constant_values=-np.inf)
+        neighbourhood = np.lib.stride_tricks.sliding_window_view(padded, 2 * PEAK_BINS + 1, axis=1).max(axis=-1)
+        padded = np.pad(neighbourhood, ((PEAK_FRAMES, PEAK_FRAMES), (0, 0)), constant_values=-np.inf)
+        neighbourhood = np.lib.stride_tricks.sliding_window_view(padded, 2 * PEAK_FRAMES + 1, axis=0).max(axis=-1)
+
+        # Only strong peaks, silence and noise have weak ones everywhere
+        times, bins = np.nonzero((spectrum == neighbourhood) & (spectrum > np.percentile(spectrum, 90)))
+        times += first
+        inside = (times >= start) & (times < start + block_frames)
+        peak_times.append(times[inside])
+        peak_bins.append(bins[inside])
+
+    times = np.concatenate(peak_times).astype(np.int64)
+    bins = np.concatenate(peak_bins).astype(np.int64)
+    order = np.lexsort((bins, times))
+    times, bins = times[order], bins[order]
+
+    keys = [np.zeros(0, dtype=np.int64)]
+    for first in range(1, PAIR_FANOUT + 1):
+        for second in range(first + 1, PAIR_FANOUT + 1):
+            count = len(times) - second
+            if count <= 0:
+                continue
+            anchor = slice(0, count)
+            first_delta = times[first:first + count] - times[anchor]
+            second_delta = times[second:second + count] - times[anchor]
+            valid = (first_delta > 0) & (second_delta > first_delta) & (second_delta <= MAX_PAIR_FRAMES)
+
+            # Time differences in steps of two frames, a shifted frame grid moves peaks by one
+            triplet_keys = ((bins[anchor] << 26)
+                            | (((bins[first:first + count] - bins[anchor] + 128) & 255) << 18)
+                            | (((bins[second:second + count] - bins[anchor] + 128) & 255) << 10)
+                            | ((first_delta // 2) << 5) | (second_delta // 2))
+            keys.append(triplet_keys[valid])
+
+    return np.unique(mix(np.concatenate(keys)))
+
+
+def recording_signature(wav_file, txt_file, params=None):
+    """
+    MinHash signatures and set sizes of the transcript shingles and the audio fingerprint
+    of a recording, as stored next to the index.
+    """
+    params = {**default_params, **(params or {})}
+
+    with open(txt_file, "r", encoding="utf8") as f:
+        shingles = transcript_shingles(f.read(), params["shingle_size"])
+    fingerprints = audio_fingerprint(wav_file)
+
+    return {
+        "transcript": minhash(shingles, params["num_perm"]),
+        "transcript_size": len(shingles),
+        "audio": minhash(fingerprints, params["num_perm"]),
+        "audio_size": len(fingerprints),
+    }
+
+
+def candidate_pairs(signatures, bands):
+    """
+    Pairs of names whose signatures are identical in at least one band (LSH).
+    """
+    pairs = set()
+    for band in range(bands):
+        buckets = defaultdict(list)
+        for name, signature in signatures.items():
+            rows = len(signature) // bands
+            buckets[signature[band * rows:(band + 1) * rows].tobytes()].append(name)
+        for names in buckets.values():
+            pairs.update((first, second) for index, first in enumerate(names) for second in names[index + 1:])
+    return {tuple(sorted(pair)) for pair in pairs}
+
+
+def similarity(first, second):
+    """
+    Estimated Jaccard similarity of two sets from their MinHash signatures.
+    """
+    return float(np.mean(first == second))
+
+
+def overlap(jaccard, first_size, second_size):
+    """
+    Estimated share of the smaller set that is in the other one, from their Jaccard similarity.
+    """
+    if min(first_size, second_size) == 0:
+        return 0.0
+    shared = jaccard * (first_size + second_size) / (1 + jaccard)
+    return min(1.0, shared / min(first_size, second_size))
+
+
+class DedupIndex:
+    """
+    Near-duplicate recordings of a corpus, as written by ingest.py to dedup_index.json.
+
+    Recordings that are a copy of another one (a re-upload, or the same session) are
+    skipped by align.py and split-wavs.py in favour of the longest copy; recordings that
+    only overlap are kept, but grouped, so combine.py and filter-segments.py can put all
+    segments of a group on the same side of the train/test split.
+    """
+
+    def __init__(self, recordings=None, pairs=None, params=None):
+        self.recordings = recordings or {}
+        self.pairs = pairs or []
+        self.params = params or dict(default_params)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf8") as f:
+            data = json.load(f)
+        return cls(data["recordings"], data["pairs"], data["params"])
+
+    def save(self, path):
+        with open(path + ".tmp", "w", encoding="utf8") as f:
+            json.dump({"params": self.params, "recordings": self.recordings, "pairs": self.pairs}, f, indent=2)
+        os.replace(path + ".tmp", path)
+
+    def duplicate_of(self, name):
+        """
+        The recording that is kept instead of this one, None when this one is kept.
+        """
+        return self.recordings.get(name, {}).get("duplicate_of")
+
+    def group(self, name):
+        """
+        The group of a recording that has duplicates or overlaps with others, else None.
+        """
+        return self.recordings.get(name, {}).get("group")
+
+    def report(self):
+        groups = {entry["group"] for entry in self.recordings.values()}
+        skipped = sum(entry["duplicate_of"] is not None for entry in self.recordings.values())
+        lines = [f"{len(groups)} groups of related recordings, {skipped} recordings skipped as duplicates"]
+        for pair in self.pairs:
+            lines.append(f"  {pair['first']} ~ {pair['second']}: {pair['decision']} "
+                         f"(transcript {pair['transcript_similarity']:.2f}/{pair['transcript_overlap']:.2f}, "
+                         f"audio {pair['audio_similarity']:.2f}/{pair['audio_overlap']:.2f})")
+        return "\n".join(lines)
+
+
+def build_index(signatures, durations, params=None):
+    """
+    Finds the duplicate and related pairs among the recordings' signatures with LSH and
+    groups them. Going from the longest recording to the shortest, a recording is skipped
+    when it is a duplicate of a recording that is kept; a duplicate of a skipped recording
+    only is kept, since what it shares with the kept one may be a small part.
+    """
+    params = {**default_params, **(params or {})}
+
+    candidates = (candidate_pairs({name: signature["transcript"] for name, signature in signatures.items()
+                                   if signature["transcript_size"]}, params["transcript_bands"])
+                  | candidate_pairs({name: signature["audio"] for name, signature in signatures.items()
+                                     if signature["audio_size"]}, params["audio_bands"]))
+
+    pairs = []
+    for first, second in sorted(candidates):
+        a, b = signatures[first], signatures[second]
+        transcript_similarity = similarity(a["transcript"], b["transcript"])
+        audio_similarity = similarity(a["audio"], b["audio"])
+        scores = {
+            "transcript_similarity": transcript_similarity,
+            "transcript_overlap": overlap(transcript_similarity, a["transcript_size"], b["transcript_size"]),
+            "audio_similarity": audio_similarity,
+            "audio_overlap": overlap(audio_similarity, a["audio_size"], b["audio_size"]),
+        }
+
+        if (scores["transcript_similarity"] >= params["duplicate_transcript_similarity"]
+                or (scores["audio_overlap"] >= params["duplicate_audio_overlap"]
+                    and scores["transcript_overlap"] >= params["duplicate_transcript_overlap"])):
+            decision = "duplicate"
+        elif (scores["transcript_overlap"] >= params["related_transcript_overlap"]
+              or scores["audio_overlap"] >= params["related_audio_overlap"]):
+            decision = "related"
+        else:
+            continue
+
+        pairs.append({"first": first, "second": second, "decision": decision, **scores})
+
+    # Union-find, once over the duplicates and once over all pairs
+    def components(edges):
+        parent = {}
+
+        def find(name):
+            parent.setdefault(name, name)
+            while parent[name] != name:
+                parent[name] = parent[parent[name]]
+                name = parent[name]
+            return name
+
+        for first, second in edges:
+            parent[find(first)] = find(second)
+
+        members = defaultdict(list)
+        for name in list(parent):
+            members[find(name)].append(name)
+        return list(members.values())
+
+    def keep_first(names):
+        return sorted(names, key=lambda name: (-durations.get(name, 0), name))
+
+    recordings = {}
+    for names in components([(pair["first"], pair["second"]) for pair in pairs]):
+        group = keep_first(names)[0]
+        for name in names:
+            recordings[name] = {"group": group, "duplicate_of": None}
+
+    duplicates = defaultdict(set)
+    for pair in pairs:
+        if pair["decision"] == "duplicate":
+            duplicates[pair["first"]].add(pair["second"])
+            duplicates[pair["second"]].add(pair["first"])
+
+    kept = set()
+    for name in keep_first(duplicates):
+        copy_of = next((other for other in keep_first(duplicates[name]) if other in kept), None)
+        if copy_of is None:
+            kept.add(name)
+        else:
+            recordings[name]["duplicate_of"] = copy_of
+
+    return DedupIndex(recordings, pairs, params)
+
+
+def segment_recording(audio):
+    """
+    Name of the recording a segment in segments.csv was cut from: the source wav of a
+    virtual segment, else the audio_segments_<name> directory of the segment wav.
+    """
+    if "#" in audio:
+        return os.path.splitext(os.path.basename(audio.split("#")[0]))[0]
+    directory = os.path.basename(os.path.dirname(audio.replace("\\", "/")))
+    return directory[len("audio_segments_"):] if directory.startswith("audio_segments_") else directory
+
+
+def group_train_test_split(df, groups, test_size=0.10, random_state=42):
+    """
+    Splits the rows of df into train and test like sklearn's train_test_split, but rows
+    with the same group, e.g. the segments of related recordings, end up on the same side.
+    Rows whose group is None are split on their own.
+    """
+    keys = [group if group is not None else ("row", index) for index, group in enumerate(groups)]
+    unique_keys = list(dict.fromkeys(keys))
+    sizes = defaultdict(int)
+    for key in keys:
+        sizes[key] += 1
+
+    rng = np.random.default_rng(random_state)
+    test_rows = int(np.ceil(test_size * len(df)))
+
+    # Groups in random order, skipping those that do not fit in what is left of the test set
+    test_keys = set()
+    count = 0
+    for index in rng.permutation(len(unique_keys)):
+        if count >= test_rows:
+            break
+        if count + sizes[unique_keys[index]] <= test_rows:
+            test_keys.add(unique_keys[index])
+            count += sizes[unique_keys[index]]
+
+    in_test = np.array([key in test_keys for key in keys], dtype=bool)
+    return df[~in_test], df[in_test]
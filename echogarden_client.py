@@ -0,0 +1,300 @@
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import time
+import uuid
+
+
+def parse_flag_value(value):
+    if value in ("true", "false"):
+        return value == "true"
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def flags_to_options(flags):
+    """
+    Converts echogarden CLI flags to the nested options object of its API, e.g.
+    "--recognition.whisperCpp.model=large-v2" -> {"recognition": {"whisperCpp": {"model": "large-v2"}}}
+    """
+    options = {}
+    for flag in flags:
+        key, _, value = flag.lstrip("-").partition("=")
+        *parents, leaf = key.split(".")
+
+        node = options
+        for parent in parents:
+            node = node.setdefault(parent, {})
+        node[leaf] = parse_flag_value(value)
+
+    return options
+
+
+def format_srt_time(seconds):
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02}:{minutes:02}:{seconds:02},{milliseconds:03}"
+
+
+def timeline_to_srt(timeline):
+    """
+    One subtitle per sentence of an echogarden segment > sentence timeline.
+    """
+    cues = [sentence for item in timeline for sentence in item.get("timeline", [])]
+
+    return "".join(
+        f"{index}\n{format_srt_time(sentence['startTime'])} --> "
+        f"{format_srt_time(sentence['endTime'])}\n{sentence['text']}\n\n"
+        for index, sentence in enumerate(cues, start=1)
+    )
+
+
+def device_environment(device):
+    """
+    Environment that pins a child process to one GPU, on Linux and Windows alike.
+    """
+    env = os.environ.copy()
+    env["CUDA_VISIBLE_DEVICES"] = device
+    env["DML_VISIBLE_DEVICES"] = device
+    return env
+
+
+async def kill_process_tree(process):
+    """
+    Kills echogarden together with the whisper.cpp / ffmpeg processes it started.
+    """
+    if os.name == "nt":
+        killer = await asyncio.create_subprocess_exec(
+            "taskkill", "/T", "/F", "/PID", str(process.pid),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        await killer.wait()
+    else:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    await process.wait()
+
+
+class CliAligner:
+    """
+    Runs one `echogarden align` process per recording. Pays Node.js startup and model
+    loading for every file, but needs nothing besides echogarden itself.
+    """
+
+    def __init__(self, device, flags):
+        self.device = device
+        self.flags = flags
+
+    def command(self, audio_path, transcript_path, srt_path, json_path):
+        return ["echogarden", "align", audio_path, transcript_path, srt_path, json_path] + self.flags
+
+    async def align(self, audio_path, transcript_path, srt_path, json_path, log):
+        """
+        Runs echogarden with its stderr written to the log file. If the coroutine is
+        cancelled (e.g. by a timeout) the echogarden process is killed.
+        """
+        cmd = self.command(audio_path, transcript_path, srt_path, json_path)
+        env = device_environment(self.device)
+
+        if os.name == "nt":
+            # Windows needs the shell to resolve echogarden.cmd
+            process = await asyncio.create_subprocess_shell(
+                subprocess.list2cmdline(cmd), stdout=subprocess.DEVNULL, stderr=log, env=env)
+        else:
+            # Own process group, so the whole tree can be killed on timeout
+            process = await asyncio.create_subprocess_exec(
+                *cmd, stdout=subprocess.DEVNULL, stderr=log, env=env, start_new_session=True)
+
+        try:
+            returncode = await process.wait()
+        except asyncio.CancelledError:
+            await kill_process_tree(process)
+            raise
+
+        if returncode != 0:
+            raise RuntimeError(f"echogarden exited with code {returncode}")
+
+    async def reset(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class ServerAligner:
+    """
+    Sends alignment requests to a running echogarden server (`echogarden serve`), which
+    keeps its engines and models loaded between files.
+
+    Messages are msgpack encoded over a WebSocket, following echogarden's client protocol.
+    Requires the `websockets` and `msgpack` packages.
+    """
+
+    def __init__(self, url, flags, server=None, fallback=None):
+        self.url = url
+        self.options = flags_to_options(flags)
+        self.server = server
+        self.connection = None
+        # Used instead once the server we started could not be restarted
+        self.fallback = fallback
+
+    @property
+    def dead(self):
+        return self.server is not None and self.server.failed and self.fallback is not None
+
+    async def connect(self):
+        import websockets
+
+        if self.connection is None:
+            # Timelines of long recordings easily exceed the default 1 MiB message limit
+            self.connection = await websockets.connect(self.url, max_size=None)
+        return self.connection
+
+    async def request(self, message):
+        import msgpack
+
+        connection = await self.connect()
+
+        request_id = uuid.uuid4().hex
+        await connection.send(msgpack.packb({"requestId": request_id, **message}))
+
+        while True:
+            response = msgpack.unpackb(await connection.recv())
+
+            if response.get("requestId") != request_id:
+                continue
+            if response.get("messageType") == "Error":
+                raise RuntimeError(response.get("error"))
+            if response.get("messageType", "").endswith("Response"):
+                return response
+
+    async def align(self, audio_path, transcript_path, srt_path, json_path, log):
+        if self.dead:
+            return await self.fallback.align(audio_path, transcript_path, srt_path, json_path, log)
+
+        with open(transcript_path, "r", encoding="utf8") as f:
+            transcript = f.read()
+
+        try:
+            response = await self.request({
+                "messageType": "AlignmentRequest",
+                "input": os.path.abspath(audio_path),
+                "transcript": transcript,
+                "options": self.options,
+            })
+        except BaseException:
+            # The answer to an abandoned request could still arrive, start over with a new connection
+            await self.close()
+            raise
+
+        timeline = response["timeline"]
+
+        with open(srt_path, "w", encoding="utf8") as f:
+            f.write(timeline_to_srt(timeline))
+
+        # Written last, its existence marks the file as done
+        with open(json_path, "w", encoding="utf8") as f:
+            json.dump(timeline, f)
+
+    async def reset(self):
+        """
+        Called after a request timed out. A server we started ourselves is restarted,
+        since it is most likely stuck on the request. Raises when it does not come back;
+        from then on the fallback aligner is used.
+        """
+        await self.close()
+        if self.server is not None and not self.server.failed:
+            await self.server.restart_async()
+
+    async def close(self):
+        if self.connection is not None:
+            connection, self.connection = self.connection, None
+            await connection.close()
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class EchogardenServer:
+    """
+    Long-lived `echogarden serve` process pinned to one device.
+    """
+
+    def __init__(self, device, port=None, command=("echogarden", "serve"), startup_timeout=120):
+        self.device = device
+        self.port = port or free_port()
+        self.command = list(command)
+        self.startup_timeout = startup_timeout
+        self.process = None
+        self.generation = 0
+        self.restart_lock = None
+        # Set when a restart failed, the server is not tried again
+        self.failed = False
+
+    @property
+    def url(self):
+        return f"ws://127.0.0.1:{self.port}"
+
+    def start(self):
+        self.process = subprocess.Popen(
+            self.command + [f"--port={self.port}"],
+            shell=os.name == "nt", stdout=subprocess.DEVNULL,
+            env=device_environment(self.device),
+        )
+
+        # Wait until the server accepts connections
+        deadline = time.monotonic() + self.startup_timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(
+                    f"echogarden server exited with code {self.process.returncode}")
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+                return self
+            except OSError:
+                time.sleep(0.5)
+
+        self.stop()
+        raise RuntimeError(f"echogarden server did not start within {self.startup_timeout} s")
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+
+    async def restart_async(self):
+        """
+        Restarts the server once, even when several slots sharing it time out together.
+        Raises when it does not start again, after which it counts as failed.
+        """
+        if self.restart_lock is None:
+            self.restart_lock = asyncio.Lock()
+
+        generation = self.generation
+        async with self.restart_lock:
+            if generation != self.generation or self.failed:
+                return
+            try:
+                await asyncio.to_thread(self.stop)
+                await asyncio.to_thread(self.start)
+            except Exception:
+                self.failed = True
+                raise
+            finally:
+                self.generation += 1
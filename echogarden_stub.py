@@ -0,0 +1,94 @@
+import argparse
+import re
+import time
+
+import msgpack
+from websockets.exceptions import ConnectionClosed
+from websockets.sync.server import serve
+
+from wav_io import wav_duration
+
+
+def canned_timeline(transcript, duration):
+    """
+    Echogarden style segment > sentence > word timeline that spreads the transcript's
+    sentences and words evenly over the recording.
+    """
+    sentences = [sentence for sentence in re.split(
+        r"(?<=[.!?])\s+", transcript.strip()) if sentence]
+    words = [sentence.split() for sentence in sentences]
+    word_count = max(sum(len(sentence_words) for sentence_words in words), 1)
+
+    word_duration = duration / word_count
+    time_offset = 0.0
+    sentence_entries = []
+
+    for sentence, sentence_words in zip(sentences, words):
+        word_entries = []
+        for word in sentence_words:
+            word_entries.append({
+                "type": "word",
+                "text": word,
+                "startTime": time_offset,
+                "endTime": time_offset + word_duration,
+            })
+            time_offset += word_duration
+
+        sentence_entries.append({
+            "type": "sentence",
+            "text": sentence,
+            "startTime": word_entries[0]["startTime"],
+            "endTime": word_entries[-1]["endTime"],
+            "timeline": word_entries,
+        })
+
+    return [{
+        "type": "segment",
+        "text": transcript.strip(),
+        "startTime": 0.0,
+        "endTime": duration,
+        "timeline": sentence_entries,
+    }]
+
+
+def handler(delay):
+    def handle(connection):
+        for message in connection:
+            request = msgpack.unpackb(message)
+
+            if request.get("messageType") != "AlignmentRequest":
+                connection.send(msgpack.packb({
+                    "requestId": request.get("requestId"),
+                    "messageType": "Error",
+                    "error": f"Unsupported message type {request.get('messageType')}",
+                }))
+                continue
+
+            time.sleep(delay)
+
+            try:
+                connection.send(msgpack.packb({
+                    "requestId": request["requestId"],
+                    "messageType": "AlignmentResponse",
+                    "timeline": canned_timeline(request["transcript"], wav_duration(request["input"])),
+                }))
+            except ConnectionClosed:
+                # The client gave up on the request (e.g. timed out)
+                return
+
+    return handle
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Stand-in for `echogarden serve` that answers alignment requests with canned timelines."
+    )
+    parser.add_argument("--port", type=int, default=45054, help="Port to listen on (default: 45054)")
+    parser.add_argument("--delay", type=float, default=0.0,
+                        help="Seconds to wait before answering every request (default: 0)")
+
+    args = parser.parse_args()
+
+    with serve(handler(args.delay), "127.0.0.1", args.port, max_size=None) as server:
+        print(f"Stub echogarden server listening on ws://127.0.0.1:{args.port}")
+        server.serve_forever()
@@ -1,12 +1,23 @@
 import csv
+import json
 import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
 from sklearn.model_selection import train_test_split
-from faster_whisper import WhisperModel
 import re
 import jiwer
 from transformers.models.whisper.english_normalizer import BasicTextNormalizer
 from tqdm import tqdm
+from transcription_cache import TranscriptionCache
+from verification_cascade import VerificationCascade
+from build_manifest import BuildManifest
+from dedup_index import DedupIndex, group_train_test_split, segment_recording
+from metrics import Metrics
+from dataset_shards import segment_key, write_shards
+from wav_io import parse_segment_ref, read_segment_pcm, read_segment_wav
+from whisper_server import WhisperClient, WhisperServer
 
 import argparse
 
@@ -31,6 +42,108 @@ parser.add_argument(
     required=True,
     help="Path to the CSV file containing merged segments",
 )
+parser.add_argument(
+    "--cache_directory",
+    type=str,
+    default=".transcription_cache",
+    help="Directory of the transcription cache shared with split-wavs.py",
+)
+parser.add_argument(
+    "--cache_size",
+    type=int,
+    default=1024,
+    help="Maximum size of the transcription cache in MB",
+)
+parser.add_argument(
+    "--devices",
+    type=str,
+    default="cuda:0",
+    help="Comma separated devices the Whisper server loads a model on",
+)
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=4,
+    help="Number of work units scored at the same time",
+)
+parser.add_argument(
+    "--unit_size",
+    type=int,
+    default=64,
+    help="Number of segments per work unit",
+)
+parser.add_argument(
+    "--batch_size",
+    type=int,
+    default=16,
+    help="Number of segments transcribed together by Whisper",
+)
+parser.add_argument(
+    "--cascade_models",
+    type=str,
+    default="",
+    help="Comma separated cheaper Whisper models that score every segment before large-v2, e.g. small",
+)
+parser.add_argument(
+    "--cascade_device",
+    type=str,
+    default="cpu",
+    help="Device the cascade models run on",
+)
+parser.add_argument(
+    "--cascade_compute_type",
+    type=str,
+    default="int8",
+    help="Compute type of the cascade models",
+)
+parser.add_argument(
+    "--wer_band",
+    type=float,
+    default=0.1,
+    help="Segments of which a cascade model's WER is within this of the WER threshold go on to the next model",
+)
+parser.add_argument(
+    "--change_band",
+    type=float,
+    default=10,
+    help="Same for the length change, in percent",
+)
+parser.add_argument(
+    "--shards_directory",
+    type=str,
+    default=None,
+    help="Also export the filtered train and test segments with embedded audio as tar shards to this directory",
+)
+parser.add_argument(
+    "--shard_size",
+    type=int,
+    default=1000,
+    help="Number of segments per shard",
+)
+parser.add_argument(
+    "--manifest",
+    type=str,
+    default="pipeline_manifest.sqlite",
+    help="Build manifest shared by all pipeline stages",
+)
+parser.add_argument(
+    "--dedup_index",
+    type=str,
+    default=None,
+    help="dedup_index.json written by ingest.py; the segments of related recordings are kept on the same side of the train/test split",
+)
+parser.add_argument(
+    "--metrics",
+    type=str,
+    default="pipeline_metrics.jsonl",
+    help="JSON lines file the timings of the run are appended to",
+)
+parser.add_argument(
+    "--prometheus",
+    type=str,
+    default=None,
+    help="Also write the run summary in Prometheus text format to this file",
+)
 
 args = parser.parse_args()
 
@@ -41,56 +154,343 @@ csv_path = args.csv_path
 
 os.makedirs(dataset_output_directory, exist_ok=True)
 
-whisper_model = WhisperModel("large-v2", device="cuda", compute_type="float16")
+whisper_model_name = "large-v2"
+whisper_compute_type = "float16"
+# Must match the decode options of split-wavs.py for cached transcripts to be shared
+whisper_decode_options = {"beam_size": 5}
+# Greedy decoding for the cheap models of the verification cascade, as in split-wavs.py
+cascade_decode_options = {"beam_size": 1}
+
+# Segments whose transcript differs more than this from the reference are dropped
+max_change_percent = 20
+max_wer = 0.3
+
+# Models that score the segments, from the cheapest to the reference model
+verification_tiers = [
+    {
+        "name": model_name,
+        "model_name": model_name,
+        "devices": [args.cascade_device],
+        "compute_type": args.cascade_compute_type,
+        "decode_options": cascade_decode_options,
+    }
+    for model_name in args.cascade_models.split(",")
+    if model_name
+] + [
+    {
+        "name": whisper_model_name,
+        "model_name": whisper_model_name,
+        "devices": args.devices.split(","),
+        "compute_type": whisper_compute_type,
+        "decode_options": whisper_decode_options,
+    }
+]
+cascade_settings = {
+    "cascade": [
+        {key: tier[key] for key in ("model_name", "compute_type", "decode_options")}
+        for tier in verification_tiers[:-1]
+    ],
+    "wer_band": args.wer_band,
+    "change_band": args.change_band,
+}
+
+# Where the segment paths in the csv are relative to, on Windows and in WSL
+audio_root = r"C:/Users/luik001c/Documents/echogarden/"
+wsl_audio_root = "/mnt/c/Users/luik001c/Documents/echogarden/"
+
+output_paths = [
+    os.path.join(dataset_output_directory, filename)
+    for filename in [
+        "filtered_segments.csv",
+        "filtered_segments_train.csv",
+        "filtered_segments_test.csv",
+    ]
+]
+if args.shards_directory:
+    output_paths += [
+        os.path.join(args.shards_directory, split, "index.jsonl")
+        for split in ["train", "test"]
+    ]
+filter_params = {
+    "model": whisper_model_name,
+    "compute_type": whisper_compute_type,
+    "decode_options": whisper_decode_options,
+    "max_change_percent": max_change_percent,
+    "max_wer": max_wer,
+    "test_size": 0.10,
+    "random_state": 42,
+    "shard_size": args.shard_size if args.shards_directory else None,
+    **cascade_settings,
+}
+# The outputs depend on the grouping of the recordings too
+filter_inputs = [csv_path] + ([args.dedup_index] if args.dedup_index else [])
+
 whisper_norm = BasicTextNormalizer()
 
+# Every scored segment, accepted or not, is appended here as soon as its work unit is done
+checkpoint_path = os.path.join(dataset_output_directory, "scored_segments.jsonl")
+checkpoint_settings_path = os.path.join(dataset_output_directory, "scored_segments.json")
+# source is the content hash of the wav a segment is read from, so a segment that was cut
+# again under the same name is scored again
+checkpoint_columns = ["audio", "sentence", "source", "transcription", "wer", "change", "tier"]
+checkpoint_key = ["audio", "sentence", "source"]
+checkpoint_settings = {
+    "key": checkpoint_key,
+    "model": whisper_model_name,
+    "compute_type": whisper_compute_type,
+    "decode_options": whisper_decode_options,
+    **cascade_settings,
+}
+
+# Timings of the hot sections, shared by the scoring threads
+metrics = Metrics("filter")
+
+# SQLite and server connections cannot be shared between threads
+thread_state = threading.local()
+
+# Tier name -> Whisper server, each started on the first cache miss of its tier, so a fully
+# cached run never loads the model
+whisper_servers = {}
+whisper_server_lock = threading.Lock()
+
+# Tier name -> transcriber shared by all threads in place of a Whisper server; anything with
+# a transcribe_batch(pcms) method works, e.g. synthetic_corpus.stub_transcriber in benchmarks
+transcribers = {}
 
-def filter_by_wer(csv_file_path):
-    # Load the CSV file
-    data = pd.read_csv(csv_file_path)
 
-    # Initialize a list to store rows that meet the criteria
-    filtered_rows = []
+def get_transcription_cache(tier):
+    if not hasattr(thread_state, "transcription_caches"):
+        thread_state.transcription_caches = {}
+    if tier["name"] not in thread_state.transcription_caches:
+        thread_state.transcription_caches[tier["name"]] = TranscriptionCache(
+            args.cache_directory,
+            tier["model_name"],
+            tier["compute_type"],
+            tier["decode_options"],
+            max_bytes=args.cache_size * 1024 * 1024,
+        )
+    return thread_state.transcription_caches[tier["name"]]
 
-    # Iterate over each row in the DataFrame
-    for index, row in tqdm(data.iterrows()):
-        audio_file = r"C:/Users/luik001c/Documents/echogarden/" + row["audio"]
-        reference_sentence = row["sentence"]
 
-        whisper_segments, whisper_info = whisper_model.transcribe(
-            audio_file, beam_size=5
+def get_transcriber(tier):
+    if tier["name"] in transcribers:
+        return transcribers[tier["name"]]
+    if not hasattr(thread_state, "transcribers"):
+        thread_state.transcribers = {}
+    if tier["name"] not in thread_state.transcribers:
+        with whisper_server_lock:
+            if tier["name"] not in whisper_servers:
+                whisper_servers[tier["name"]] = WhisperServer(
+                    devices=tier["devices"],
+                    model_name=tier["model_name"],
+                    compute_type=tier["compute_type"],
+                    decode_options=tier["decode_options"],
+                    batch_size=args.batch_size,
+                ).start()
+        whisper_server = whisper_servers[tier["name"]]
+        thread_state.transcribers[tier["name"]] = WhisperClient(
+            whisper_server.address, whisper_server.authkey
         )
-        # whisper_result = whisper_model.transcribe(segment_filename, decode_options={
-        #     'language': 'nl'
-        # })
+    return thread_state.transcribers[tier["name"]]
+
+
+def transcribe(tier, pcms):
+    """
+    Returns the transcripts of a list of segments by the model of a verification tier, from
+    the transcription cache when possible. Only the cache misses are sent to the tier's
+    Whisper server, as one batch.
+    """
+    audio_seconds = sum(len(pcm) for pcm in pcms) / 32000
+
+    with metrics.section(f"transcribe:{tier['name']}", audio_seconds):
+        transcription_cache = get_transcription_cache(tier)
+        transcriptions = [transcription_cache.get(pcm) for pcm in pcms]
+
+        missing = [index for index, transcription in enumerate(transcriptions) if transcription is None]
+        if missing:
+            # The transcription will actually run here.
+            new_transcriptions = get_transcriber(tier).transcribe_batch(
+                [pcms[index] for index in missing]
+            )
+            for index, transcription in zip(missing, new_transcriptions):
+                transcription_cache.put(pcms[index], transcription)
+                transcriptions[index] = transcription
+
+    return transcriptions
 
-        # The transcription will actually run here.
-        transcription = " ".join(map(lambda item: item.text, whisper_segments))
 
-        reference_length = len(re.findall(r"\w+", reference_sentence))
-        whisper_length = len(re.findall(r"\w+", transcription))
+def score(reference_sentence, transcription):
+    """
+    Returns the WER and the word count change in percent of a transcription.
+    """
+    reference_length = len(re.findall(r"\w+", reference_sentence))
+    whisper_length = len(re.findall(r"\w+", transcription))
 
-        # Calculate the WER
-        change_percent = ((whisper_length - reference_length) / reference_length) * 100
+    # Calculate the WER
+    change_percent = ((whisper_length - reference_length) / reference_length) * 100
 
+    with metrics.section("process_words"):
         jiwer_score = jiwer.process_words(
             whisper_norm(reference_sentence), whisper_norm(transcription)
         )
 
-        # Append the row to filtered_rows if WER is <= 30%
-        if abs(change_percent) < 20 and jiwer_score.wer < 0.3:
-            filtered_rows.append(
-                {
-                    "audio": row["audio"],
-                    "sentence": reference_sentence,
-                    "transcription": transcription,
-                    "wer": jiwer_score.wer,
-                    "change": change_percent,
-                }
-            )
+    return jiwer_score.wer, change_percent
+
+
+# Shared by the scoring threads, so its statistics cover the whole run
+cascade = VerificationCascade(
+    [(tier["name"], lambda pcms, tier=tier: transcribe(tier, pcms)) for tier in verification_tiers],
+    score,
+    max_wer,
+    max_change_percent,
+    args.wer_band,
+    args.change_band,
+)
+
+
+def score_unit(unit):
+    """
+    Transcribes and scores one work unit of the merged segments.
+    audio is a segment wav or a virtual segment reference into its source wav.
+    """
+    with metrics.section("read_audio"):
+        pcms = [read_segment_pcm(audio_root + audio) for audio in unit["audio"]]
+    audio_seconds = sum(len(pcm) for pcm in pcms) / 32000
+
+    with metrics.section("score_unit", audio_seconds):
+        results = cascade.verify(pcms, list(unit["sentence"]))
+    metrics.add_audio(audio_seconds)
+
+    rows = []
+    for audio, reference_sentence, source, result in zip(
+        unit["audio"], unit["sentence"], unit["source"], results
+    ):
+        rows.append(
+            {
+                "audio": audio,
+                "sentence": reference_sentence,
+                "source": source,
+                "transcription": result["transcription"],
+                "wer": result["wer"],
+                "change": result["change"],
+                "tier": result["tier"],
+            }
+        )
+
+    return pd.DataFrame(rows, columns=checkpoint_columns)
+
+
+def load_checkpoint():
+    """
+    Returns the segments scored by earlier runs, or an empty frame when there are none or
+    they were transcribed with other settings.
+    """
+    if os.path.exists(checkpoint_settings_path):
+        with open(checkpoint_settings_path, "r", encoding="utf8") as f:
+            settings = json.load(f)
+    else:
+        settings = None
+
+    if settings != checkpoint_settings or not os.path.exists(checkpoint_path):
+        with open(checkpoint_settings_path, "w", encoding="utf8") as f:
+            json.dump(checkpoint_settings, f)
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        return pd.DataFrame(columns=checkpoint_columns)
+
+    rows = []
+    with open(checkpoint_path, "r", encoding="utf8") as f:
+        for line in f:
+            try:
+                rows.append(json.loads(line))
+            except json.JSONDecodeError:
+                # A crash while appending leaves a broken last line behind
+                pass
+
+    # Rewritten without the broken line, so new results are appended to a clean file
+    with open(checkpoint_path + ".tmp", "w", encoding="utf8") as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    os.replace(checkpoint_path + ".tmp", checkpoint_path)
+
+    return pd.DataFrame(rows, columns=checkpoint_columns)
+
+
+def segment_sources(audio_paths):
+    """
+    Content hash of the wav every segment is read from: the segment wav, or the source
+    recording of a virtual segment, whose byte range is part of its reference already.
+    The hashes are kept in the build manifest, so only new or changed wavs are read.
+    """
+    manifest = BuildManifest(args.manifest)
+    try:
+        with metrics.section("hash_sources"):
+            return [manifest.file_hash(parse_segment_ref(audio_root + audio)[0]) for audio in audio_paths]
+    finally:
+        manifest.close()
+
+
+def score_segments(data):
+    """
+    Scores every segment of data that is not in the checkpoint yet. The rows are split
+    into work units that are transcribed by several threads at once, all sharing the
+    Whisper server's models, and appended to the checkpoint as soon as they are done.
+    data gets a source column, see segment_sources.
+    """
+    scored = load_checkpoint()
+
+    data["source"] = segment_sources(data["audio"])
+    done = set(zip(*[scored[column] for column in checkpoint_key]))
+    todo = data[[key not in done for key in zip(*[data[column] for column in checkpoint_key])]]
 
-    # Create a new DataFrame from the filtered rows
-    filtered_data = pd.DataFrame(filtered_rows)
+    print(f"{len(data) - len(todo)} of {len(data)} segments already scored")
+
+    units = [todo.iloc[start:start + args.unit_size] for start in range(0, len(todo), args.unit_size)]
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor, open(
+        checkpoint_path, "a", encoding="utf8"
+    ) as checkpoint:
+        futures = [executor.submit(score_unit, unit) for unit in units]
+        frames = [scored]
+
+        with tqdm(total=len(todo)) as progress:
+            for future in as_completed(futures):
+                unit_scores = future.result()
+                for row in unit_scores.to_dict("records"):
+                    checkpoint.write(json.dumps(row, ensure_ascii=False) + "\n")
+                checkpoint.flush()
+
+                frames.append(unit_scores)
+                progress.update(len(unit_scores))
+
+    # A single concat at the end instead of one per work unit
+    scored = pd.concat(frames, ignore_index=True)
+
+    if cascade.stats.tiers:
+        print(cascade.stats.report())
+        with open(
+            os.path.join(dataset_output_directory, "verification_stats.json"), "w", encoding="utf8"
+        ) as f:
+            json.dump(cascade.stats.tiers, f, indent=2)
+
+    print(metrics.write_summary(args.metrics, args.prometheus))
+
+    return scored
+
+
+def filter_by_wer(csv_file_path):
+    # Load the CSV file
+    data = pd.read_csv(csv_file_path)
+
+    scored = score_segments(data).drop_duplicates(subset=checkpoint_key)
+
+    # Back in the order of the merged segments, without rows that are no longer in there
+    scored = data[checkpoint_key].merge(scored, on=checkpoint_key, how="inner").drop(columns=["source"])
+
+    # Keep the rows with a WER below 30% and less than 20% change in length
+    filtered_data = scored[
+        (scored["change"].abs() < max_change_percent) & (scored["wer"] < max_wer)
+    ].reset_index(drop=True)
 
     # Save the filtered data to a new CSV file or return it
     filtered_data.to_csv("filtered_data.csv", index=False)
@@ -98,29 +498,86 @@ def filter_by_wer(csv_file_path):
     return filtered_data
 
 
-# Example usage
-filtered_df = filter_by_wer(csv_path)
+def export_shards(df, output_dir):
+    """
+    Packs the segments of df with their audio and scores into tar shards.
+    """
+    samples = [
+        {
+            "key": segment_key(row.audio),
+            "audio": audio_root + row.audio[len(wsl_audio_root):],
+            "metadata": {
+                "sentence": row.sentence,
+                "transcription": row.transcription,
+                "wer": row.wer,
+                "change": row.change,
+            },
+        }
+        for row in df.itertuples(index=False)
+    ]
+    shard_count = write_shards(
+        samples, output_dir, shard_size=args.shard_size, load_audio=read_segment_wav
+    )
+    print(f"Wrote {len(samples)} segments to {shard_count} shards in {output_dir}")
 
-filtered_df["audio"] = (
-    "/mnt/c/Users/luik001c/Documents/echogarden/" + filtered_df["audio"]
-)
 
+# The Whisper server is a spawned process that imports this script again, so everything
+# below must only run in the main process
+if __name__ == "__main__":
+    manifest = BuildManifest(args.manifest)
 
-train_df, test_df = train_test_split(filtered_df, test_size=0.10, random_state=42)
+    # Skip loading the model at all when the merged segments did not change since the last run
+    if all(
+        manifest.is_fresh("filter", path, filter_inputs, filter_params) for path in output_paths
+    ):
+        print("Filtered segments are up to date")
+        sys.exit(0)
 
+    # Example usage
+    try:
+        filtered_df = filter_by_wer(csv_path)
+    finally:
+        for whisper_server in whisper_servers.values():
+            whisper_server.stop()
 
-filtered_df.to_csv(
-    os.path.join(dataset_output_directory, "filtered_segments.csv"),
-    index=False,
-    quoting=csv.QUOTE_ALL,
-)
-train_df.to_csv(
-    os.path.join(dataset_output_directory, "filtered_segments_train.csv"),
-    index=False,
-    quoting=csv.QUOTE_ALL,
-)
-test_df.to_csv(
-    os.path.join(dataset_output_directory, "filtered_segments_test.csv"),
-    index=False,
-    quoting=csv.QUOTE_ALL,
-)
+    filtered_df["audio"] = wsl_audio_root + filtered_df["audio"]
+
+
+    if args.dedup_index:
+        dedup_index = DedupIndex.load(args.dedup_index)
+        train_df, test_df = group_train_test_split(
+            filtered_df,
+            [dedup_index.group(segment_recording(audio)) for audio in filtered_df["audio"]],
+            test_size=filter_params["test_size"],
+            random_state=filter_params["random_state"],
+        )
+    else:
+        train_df, test_df = train_test_split(
+            filtered_df,
+            test_size=filter_params["test_size"],
+            random_state=filter_params["random_state"],
+        )
+
+
+    filtered_df.to_csv(
+        os.path.join(dataset_output_directory, "filtered_segments.csv"),
+        index=False,
+        quoting=csv.QUOTE_ALL,
+    )
+    train_df.to_csv(
+        os.path.join(dataset_output_directory, "filtered_segments_train.csv"),
+        index=False,
+        quoting=csv.QUOTE_ALL,
+    )
+    test_df.to_csv(
+        os.path.join(dataset_output_directory, "filtered_segments_test.csv"),
+        index=False,
+        quoting=csv.QUOTE_ALL,
+    )
+
+    if args.shards_directory:
+        export_shards(train_df, os.path.join(args.shards_directory, "train"))
+        export_shards(test_df, os.path.join(args.shards_directory, "test"))
+
+    for path in output_paths:
+        manifest.record("filter", path, filter_inputs, filter_params)
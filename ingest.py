@@ -0,0 +1,260 @@
+import argparse
+import codecs
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import ffmpeg
+import numpy as np
+from tqdm import tqdm
+
+from build_manifest import BuildManifest
+from dedup_index import build_index, default_params as dedup_params, index_filename, recording_signature
+from wav_io import MappedWav
+
+
+# Every later stage expects -ar 16000 -ac 1 -c:a pcm_s16le wav files
+conversion_params = {"ar": 16000, "ac": 1, "c": "pcm_s16le"}
+
+audio_extensions = {".mp3", ".m4a", ".flac", ".ogg", ".opus", ".aac", ".wma"}
+
+# Opened lazily, so every pool worker gets its own database connection
+manifest_path = "pipeline_manifest.sqlite"
+manifest = None
+
+
+def get_manifest():
+    global manifest
+    if manifest is None:
+        manifest = BuildManifest(manifest_path)
+    return manifest
+
+
+def init_worker(path):
+    global manifest_path
+    manifest_path = path
+
+
+def convert_to_wav(input_file, output_file):
+    """
+    Converts an audio file to WAV format using ffmpeg with specified parameters.
+    - Sample rate: 16000 Hz
+    - Audio channels: 1 (mono)
+    - Audio codec: pcm_s16le
+    The wav is written under a temporary name first, so an interrupted conversion never
+    leaves a truncated wav behind.
+    """
+    (
+        ffmpeg
+        .input(input_file)
+        .output(output_file + ".tmp", format="wav", **conversion_params)
+        .run(overwrite_output=True, quiet=True)
+    )
+    os.replace(output_file + ".tmp", output_file)
+
+
+def matches_source(wav_file, audio_file, tolerance=1.0):
+    """
+    True when the wav is as long as its source, within tolerance seconds, so a wav whose
+    conversion was cut short is not taken for a complete one.
+    """
+    try:
+        source_duration = float(ffmpeg.probe(audio_file)["format"]["duration"])
+    except (ffmpeg.Error, OSError, KeyError, ValueError):
+        # Converted again when the source cannot be probed, e.g. without ffprobe
+        return False
+    return abs(MappedWav(wav_file).duration_seconds - source_duration) <= tolerance
+
+
+def ingest_audio(audio_file):
+    """
+    Converts a recording to a 16 kHz mono wav next to it, unless that wav is already up to
+    date, and records the hashes and the duration of the wav in the manifest.
+    Returns (wav file, status).
+    """
+    wav_file = os.path.splitext(audio_file)[0] + ".wav"
+    inputs = [audio_file]
+
+    if get_manifest().is_fresh("ingest", wav_file, inputs, conversion_params):
+        status = "up to date"
+    elif (not get_manifest().has_record("ingest", wav_file)
+          and os.path.exists(wav_file) and MappedWav(wav_file).is_whisper_format()
+          and matches_source(wav_file, audio_file)):
+        # Converted before the manifest existed, e.g. by the old make-wavs.py. Once the
+        # manifest knows the wav, a stale record means the source changed.
+        status = "already converted"
+    else:
+        try:
+            convert_to_wav(audio_file, wav_file)
+        except ffmpeg.Error as e:
+            if os.path.exists(wav_file + ".tmp"):
+                os.remove(wav_file + ".tmp")
+            return wav_file, f"failed: {e.stderr.decode('utf8', errors='replace').strip()[-200:]}"
+        status = "converted"
+
+    get_manifest().record("ingest", wav_file, inputs, conversion_params)
+    get_manifest().record_duration(wav_file, MappedWav(wav_file).duration_seconds)
+    return wav_file, status
+
+
+def ingest_wav(wav_file):
+    """
+    Records the hash and the duration of a wav without a compressed source.
+    """
+    audio = MappedWav(wav_file)
+    if not audio.is_whisper_format():
+        return wav_file, "failed: not a 16 kHz mono pcm_s16le wav and no source to convert from"
+
+    get_manifest().file_hash(wav_file)
+    get_manifest().record_duration(wav_file, audio.duration_seconds)
+    return wav_file, "indexed"
+
+
+def decode_transcript(raw):
+    """
+    Returns (text, encoding) of a transcript. UTF-8 (with or without BOM) and UTF-16 with
+    a BOM are recognized; anything else is decoded as Windows-1252, falling back to Latin-1
+    for the few bytes that Windows-1252 leaves undefined.
+    """
+    if raw.startswith(codecs.BOM_UTF8):
+        return raw[len(codecs.BOM_UTF8):].decode("utf-8"), "utf-8-sig"
+    if raw.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return raw.decode("utf-16"), "utf-16"
+
+    try:
+        return raw.decode("utf-8"), "utf-8"
+    except UnicodeDecodeError:
+        pass
+
+    try:
+        return raw.decode("cp1252"), "cp1252"
+    except UnicodeDecodeError:
+        return raw.decode("latin-1"), "latin-1"
+
+
+def ingest_transcript(txt_file):
+    """
+    Rewrites a transcript as UTF-8 (without BOM) in place when it is in any other encoding.
+    Files that are already UTF-8 are left alone, so running ingest twice is harmless.
+    Returns (txt file, status).
+    """
+    with open(txt_file, "rb") as f:
+        raw = f.read()
+
+    text, encoding = decode_transcript(raw)
+
+    if encoding != "utf-8":
+        with open(txt_file + ".tmp", "w", encoding="utf-8", newline="") as f:
+            f.write(text)
+        os.replace(txt_file + ".tmp", txt_file)
+        status = f"converted from {encoding}"
+    else:
+        status = "already utf-8"
+
+    get_manifest().file_hash(txt_file)
+    return txt_file, status
+
+
+def ingest_file(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".txt":
+        return ingest_transcript(path)
+    if extension == ".wav":
+        return ingest_wav(path)
+    return ingest_audio(path)
+
+
+def ingest_signature(wav_file):
+    """
+    The dedup signature of a recording, see dedup_index.recording_signature. Stored in
+    .dedup/<name>.npz next to the recording, so it is only computed again when the wav or
+    the transcript changed. Returns (name, signature, duration).
+    """
+    name = os.path.splitext(os.path.basename(wav_file))[0]
+    txt_file = os.path.splitext(wav_file)[0] + ".txt"
+    signature_path = os.path.join(os.path.dirname(wav_file), ".dedup", f"{name}.npz")
+    inputs = [wav_file, txt_file]
+
+    if get_manifest().is_fresh("dedup", signature_path, inputs, dedup_params):
+        with np.load(signature_path) as f:
+            signature = {key: f[key] for key in f.files}
+    else:
+        signature = recording_signature(wav_file, txt_file, dedup_params)
+
+        os.makedirs(os.path.dirname(signature_path), exist_ok=True)
+        with open(signature_path + ".tmp", "wb") as f:
+            np.savez(f, **signature)
+        os.replace(signature_path + ".tmp", signature_path)
+        get_manifest().record("dedup", signature_path, inputs, dedup_params)
+
+    signature["transcript_size"] = int(signature["transcript_size"])
+    signature["audio_size"] = int(signature["audio_size"])
+    return name, signature, get_manifest().duration(wav_file) or MappedWav(wav_file).duration_seconds
+
+
+def find_inputs(directory):
+    """
+    Every transcript and recording in the directory. A wav is only ingested on its own when
+    there is no compressed recording with the same name to convert it from.
+    """
+    filenames = os.listdir(directory)
+    sources = {os.path.splitext(filename)[0] for filename in filenames
+               if os.path.splitext(filename)[1].lower() in audio_extensions}
+
+    inputs = []
+    for filename in sorted(filenames):
+        name, extension = os.path.splitext(filename)
+        extension = extension.lower()
+
+        if (extension in audio_extensions or extension == ".txt"
+                or (extension == ".wav" and name not in sources)):
+            inputs.append(os.path.join(directory, filename))
+
+    return inputs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Converts the recordings in a directory to 16 kHz mono wav files and the '
+                    'transcripts to UTF-8, and indexes their hashes and durations')
+    parser.add_argument('directory', type=str,
+                        help='Directory containing the recordings and their transcripts')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of files processed at the same time (default: number of CPUs)')
+    parser.add_argument('--manifest', type=str, default="pipeline_manifest.sqlite",
+                        help='Build manifest shared by all pipeline stages (default: pipeline_manifest.sqlite)')
+    parser.add_argument('--no_dedup', action='store_true',
+                        help=f'Do not build the index of near-duplicate recordings ({index_filename} in the directory)')
+
+    args = parser.parse_args()
+
+    inputs = find_inputs(args.directory)
+
+    # Largest first, so a long recording does not end up as the last conversion
+    inputs.sort(key=os.path.getsize, reverse=True)
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                             initargs=(args.manifest,)) as executor:
+        for path, status in tqdm(executor.map(ingest_file, inputs), total=len(inputs)):
+            if status.startswith("failed"):
+                failed += 1
+            if status not in ("up to date", "already utf-8", "indexed"):
+                tqdm.write(f"{os.path.basename(path)}: {status}")
+
+        print(f"Ingested {len(inputs) - failed} of {len(inputs)} files")
+
+        if not args.no_dedup:
+            # Every recording with a transcript, so the later stages can skip or group copies
+            wav_files = [os.path.join(args.directory, filename) for filename in sorted(os.listdir(args.directory))
+                         if filename.endswith(".wav")
+                         and os.path.exists(os.path.join(args.directory, filename[:-4] + ".txt"))]
+
+            signatures = {}
+            durations = {}
+            for name, signature, duration in tqdm(executor.map(ingest_signature, wav_files), total=len(wav_files)):
+                signatures[name] = signature
+                durations[name] = duration
+
+            dedup_index = build_index(signatures, durations, dedup_params)
+            dedup_index.save(os.path.join(args.directory, index_filename))
+            print(dedup_index.report())
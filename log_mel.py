@@ -0,0 +1,160 @@
+import csv
+import os
+
+import numpy as np
+
+
+# Whisper's audio front end
+SAMPLE_RATE = 16000
+N_FFT = 400
+HOP_LENGTH = 160
+
+INDEX_COLUMNS = ["filename", "offset", "frames"]
+
+
+def hz_to_mel(frequencies):
+    """
+    Slaney mel scale: linear below 1 kHz, logarithmic above.
+    """
+    frequencies = np.asarray(frequencies, dtype=np.float64)
+    mels = frequencies / (200.0 / 3)
+    log_region = frequencies >= 1000.0
+    mels[log_region] = 15.0 + np.log(frequencies[log_region] / 1000.0) / (np.log(6.4) / 27.0)
+    return mels
+
+
+def mel_to_hz(mels):
+    mels = np.asarray(mels, dtype=np.float64)
+    frequencies = mels * (200.0 / 3)
+    log_region = mels >= 15.0
+    frequencies[log_region] = 1000.0 * np.exp((np.log(6.4) / 27.0) * (mels[log_region] - 15.0))
+    return frequencies
+
+
+def mel_filters(n_mels=80, sample_rate=SAMPLE_RATE, n_fft=N_FFT):
+    """
+    Slaney normalized triangular mel filterbank, the same as librosa.filters.mel, which
+    Whisper ships as mel_filters.npz.
+    """
+    fft_frequencies = np.linspace(0, sample_rate / 2, 1 + n_fft // 2)
+    mel_frequencies = mel_to_hz(np.linspace(hz_to_mel([0.0])[0], hz_to_mel([sample_rate / 2])[0], n_mels + 2))
+
+    differences = np.diff(mel_frequencies)
+    ramps = mel_frequencies[:, None] - fft_frequencies[None, :]
+
+    lower = -ramps[:-2] / differences[:-1, None]
+    upper = ramps[2:] / differences[1:, None]
+    weights = np.maximum(0, np.minimum(lower, upper))
+
+    weights *= (2.0 / (mel_frequencies[2:n_mels + 2] - mel_frequencies[:n_mels]))[:, None]
+    return weights.astype(np.float32)
+
+
+_filters = {}
+
+
+def log_mel_spectrogram(samples, n_mels=80):
+    """
+    Whisper's log-mel spectrogram of 16 kHz audio, as (frames, n_mels) float32.
+
+    samples is float32 audio or 16 kHz mono pcm_s16le bytes. Like whisper.audio computes it
+    for transcription, the audio is followed by silence, the STFT uses a periodic Hann
+    window with reflect padding and the last frame is dropped, so a segment of n samples
+    has n // 160 frames.
+    """
+    if isinstance(samples, (bytes, bytearray, memoryview)):
+        samples = np.frombuffer(samples, dtype=np.int16).astype(np.float32) / 32768.0
+
+    frame_count = len(samples) // HOP_LENGTH
+
+    # Enough silence that every frame of the segment sees the same input as in Whisper
+    audio = np.concatenate([np.asarray(samples, dtype=np.float32), np.zeros(N_FFT, dtype=np.float32)])
+    audio = np.pad(audio, N_FFT // 2, mode="reflect")
+
+    window = (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(N_FFT) / N_FFT)).astype(np.float32)
+    frames = np.lib.stride_tricks.sliding_window_view(audio, N_FFT)[::HOP_LENGTH]
+
+    power = np.abs(np.fft.rfft(frames * window, axis=1)) ** 2
+    power = power[:-1].astype(np.float32)
+
+    if n_mels not in _filters:
+        _filters[n_mels] = mel_filters(n_mels)
+    mel = power @ _filters[n_mels].T
+
+    log_spec = np.log10(np.maximum(mel, 1e-10))
+    log_spec = np.maximum(log_spec, log_spec.max() - 8.0)
+    log_spec = (log_spec + 4.0) / 4.0
+
+    return log_spec[:frame_count]
+
+
+class LogMelWriter:
+    """
+    Appends the log-mel features of a recording's segments to one float16 array file,
+    log_mel.bin, with log_mel_index.csv holding the frame offset and frame count of every
+    segment. Call close() once all segments are written.
+    """
+
+    def __init__(self, directory, n_mels=80):
+        self.directory = directory
+        self.n_mels = n_mels
+        self.offset = 0
+        self.index = []
+        self.file = open(os.path.join(directory, "log_mel.bin.tmp"), "wb")
+
+    def add(self, filename, pcm):
+        features = log_mel_spectrogram(pcm, self.n_mels).astype(np.float16)
+        self.file.write(features.tobytes())
+
+        self.index.append((filename, self.offset, len(features)))
+        self.offset += len(features)
+
+    def close(self):
+        self.file.close()
+        os.replace(os.path.join(self.directory, "log_mel.bin.tmp"),
+                   os.path.join(self.directory, "log_mel.bin"))
+
+        # The index is written last, its presence marks the features as complete
+        with open(os.path.join(self.directory, "log_mel_index.csv.tmp"), "w", newline="", encoding="utf8") as f:
+            writer = csv.writer(f)
+            writer.writerow(INDEX_COLUMNS + ["n_mels"])
+            writer.writerows(row + (self.n_mels,) for row in self.index)
+        os.replace(os.path.join(self.directory, "log_mel_index.csv.tmp"),
+                   os.path.join(self.directory, "log_mel_index.csv"))
+
+
+class LogMelCache:
+    """
+    Zero-copy access to the features LogMelWriter stored for a directory of segments.
+
+        features = LogMelCache('segments/audio_segments_foo')
+        mel = features['segments/audio_segments_foo/3.wav']  # (frames, n_mels) float16 view
+
+    Segments are looked up by the filename they have in segments.csv.
+    """
+
+    def __init__(self, directory):
+        self.index = {}
+        n_mels = 80
+
+        with open(os.path.join(directory, "log_mel_index.csv"), "r", newline="", encoding="utf8") as f:
+            for row in csv.DictReader(f):
+                self.index[row["filename"]] = (int(row["offset"]), int(row["frames"]))
+                n_mels = int(row["n_mels"])
+
+        self.n_mels = n_mels
+        path = os.path.join(directory, "log_mel.bin")
+        if os.path.getsize(path):
+            self.features = np.memmap(path, dtype=np.float16, mode="r").reshape(-1, n_mels)
+        else:
+            self.features = np.zeros((0, n_mels), dtype=np.float16)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, filename):
+        return filename in self.index
+
+    def __getitem__(self, filename):
+        offset, frames = self.index[filename]
+        return self.features[offset:offset + frames]
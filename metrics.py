@@ -0,0 +1,162 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Metrics:
+    """
+    Wall-clock timings of the hot sections of a pipeline stage, shared by all stages.
+
+        metrics = Metrics("split")
+        with metrics.section("export_segment", audio_seconds=28.5):
+            ...
+
+    Every section counts its calls, the seconds spent in it and the seconds of audio it
+    processed, from which the real-time factor (processing time per second of audio) is
+    derived. Safe to use from several threads; pool processes return snapshot() to the
+    main process, which adds them up with merge().
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.sections = {}
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.audio_seconds = 0.0
+
+    @contextmanager
+    def section(self, name, audio_seconds=0.0):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start_time, audio_seconds)
+
+    def add(self, name, seconds, audio_seconds=0.0, calls=1):
+        with self.lock:
+            section = self.sections.setdefault(
+                name, {"calls": 0, "seconds": 0.0, "audio_seconds": 0.0})
+            section["calls"] += calls
+            section["seconds"] += seconds
+            section["audio_seconds"] += audio_seconds
+
+    def add_audio(self, audio_seconds):
+        """
+        Counts audio towards the stage total, the base of the audio hours per hour figure.
+        """
+        with self.lock:
+            self.audio_seconds += audio_seconds
+
+    def snapshot(self):
+        with self.lock:
+            return {"audio_seconds": self.audio_seconds,
+                    "sections": {name: dict(section) for name, section in self.sections.items()}}
+
+    def reset(self):
+        with self.lock:
+            self.sections = {}
+            self.audio_seconds = 0.0
+
+    def merge(self, snapshot):
+        for name, section in snapshot["sections"].items():
+            self.add(name, section["seconds"], section["audio_seconds"], section["calls"])
+        self.add_audio(snapshot["audio_seconds"])
+
+    def wall_seconds(self):
+        return time.perf_counter() - self.start_time
+
+    def summary(self):
+        """
+        Totals of the run so far, as written to the metrics file at the end of a run.
+        """
+        snapshot = self.snapshot()
+        wall_seconds = self.wall_seconds()
+
+        for section in snapshot["sections"].values():
+            section["rtf"] = (section["seconds"] / section["audio_seconds"]
+                              if section["audio_seconds"] else None)
+
+        return {
+            "stage": self.stage,
+            "event": "summary",
+            "time": time.time(),
+            "wall_seconds": wall_seconds,
+            "audio_seconds": snapshot["audio_seconds"],
+            "audio_hours_per_hour": snapshot["audio_seconds"] / wall_seconds if wall_seconds else 0.0,
+            "sections": snapshot["sections"],
+        }
+
+    def write_event(self, path, event, **fields):
+        """
+        Appends one JSON line, e.g. the timings of a single recording, to the metrics file.
+        """
+        if path is None:
+            return
+
+        record = {"stage": self.stage, "event": event, "time": time.time(), **fields}
+        with self.lock, open(path, "a", encoding="utf8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def write_summary(self, path, prometheus_path=None):
+        """
+        Appends the summary to the metrics file, optionally writes it in Prometheus text
+        format as well, and returns it as a table for printing.
+        """
+        summary = self.summary()
+
+        if path is not None:
+            with self.lock, open(path, "a", encoding="utf8") as f:
+                f.write(json.dumps(summary, ensure_ascii=False) + "\n")
+
+        if prometheus_path is not None:
+            with open(prometheus_path + ".tmp", "w", encoding="utf8") as f:
+                f.write(prometheus_text(summary))
+            os.replace(prometheus_path + ".tmp", prometheus_path)
+
+        return summary_table(summary)
+
+
+def prometheus_text(summary):
+    """
+    A run summary in the Prometheus text exposition format, e.g. for the node exporter's
+    textfile collector.
+    """
+    stage = summary["stage"]
+    lines = [
+        "# HELP pipeline_wall_seconds Wall-clock duration of the stage run.",
+        "# TYPE pipeline_wall_seconds gauge",
+        f'pipeline_wall_seconds{{stage="{stage}"}} {summary["wall_seconds"]}',
+        "# HELP pipeline_audio_seconds Seconds of audio processed by the stage run.",
+        "# TYPE pipeline_audio_seconds gauge",
+        f'pipeline_audio_seconds{{stage="{stage}"}} {summary["audio_seconds"]}',
+        "# HELP pipeline_audio_hours_per_hour Hours of audio processed per wall-clock hour.",
+        "# TYPE pipeline_audio_hours_per_hour gauge",
+        f'pipeline_audio_hours_per_hour{{stage="{stage}"}} {summary["audio_hours_per_hour"]}',
+    ]
+
+    for metric, field, help_text in [
+        ("pipeline_section_calls", "calls", "Number of times the section ran."),
+        ("pipeline_section_seconds", "seconds", "Seconds spent in the section."),
+        ("pipeline_section_audio_seconds", "audio_seconds", "Seconds of audio the section processed."),
+    ]:
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} gauge")
+        for name, section in summary["sections"].items():
+            lines.append(f'{metric}{{stage="{stage}",section="{name}"}} {section[field]}')
+
+    return "\n".join(lines) + "\n"
+
+
+def summary_table(summary):
+    lines = [f"{'section':<24}{'calls':>9}{'total s':>11}{'mean ms':>11}{'audio h':>9}{'RTF':>9}"]
+    for name, section in summary["sections"].items():
+        mean_ms = 1000 * section["seconds"] / section["calls"] if section["calls"] else 0
+        rtf = f"{section['rtf']:.4f}" if section["rtf"] is not None else "-"
+        lines.append(f"{name:<24}{section['calls']:>9}{section['seconds']:>11.1f}{mean_ms:>11.1f}"
+                     f"{section['audio_seconds'] / 3600:>9.2f}{rtf:>9}")
+    lines.append(f"{summary['stage']}: {summary['audio_seconds'] / 3600:.2f} h of audio in "
+                 f"{summary['wall_seconds'] / 3600:.2f} h, "
+                 f"{summary['audio_hours_per_hour']:.1f} audio hours per hour")
+    return "\n".join(lines)
@@ -0,0 +1,184 @@
+import numpy as np
+import pandas as pd
+
+
+plan_columns = ["start_ms", "end_ms", "first_sentence", "last_sentence"]
+
+
+def sentence_bounds(starts, ends):
+    """
+    Vectorized boundaries of a recording's sentences, in milliseconds.
+    A sentence ends halfway the silence before the next sentence (its median end), its
+    duration runs from its start to that point.
+    """
+    start_ms = np.asarray(starts, dtype=np.float64) * 1000
+    end_ms = np.asarray(ends, dtype=np.float64) * 1000
+
+    next_start_ms = np.append(start_ms[1:], end_ms[-1:])
+    median_end_ms = ((next_start_ms - end_ms) // 2) + end_ms
+
+    return start_ms, median_end_ms, median_end_ms - start_ms
+
+
+def plan_segments(starts, ends, max_duration=30000):
+    """
+    Plans the segments of a recording from the start and end times (in seconds) of its
+    sentences, without touching any audio.
+
+    Sentences are added to a segment until the next one would make it reach max_duration;
+    the segment is then cut halfway the silence after its last sentence. Sentences with
+    invalid times are skipped and sentences longer than max_duration are dropped
+    together with the segment they would have been added to.
+
+    Returns (valid, plan): a boolean array marking the sentences with valid times, and a
+    DataFrame with the start_ms, end_ms and first_sentence / last_sentence (inclusive
+    indices into the valid sentences) of every segment.
+    """
+    starts = np.asarray(starts, dtype=np.float64)
+    ends = np.asarray(ends, dtype=np.float64)
+
+    valid = (starts > 0) & (ends >= starts)
+    if not valid.any():
+        return valid, pd.DataFrame(columns=plan_columns)
+
+    # The first segment starts at the first sentence, even when that one is invalid
+    segment_start = float(starts[0] * 1000)
+
+    start_ms, median_end_ms, durations = sentence_bounds(starts[valid], ends[valid])
+    too_long = durations > max_duration
+
+    # Everything above is vectorized; where a segment is cut depends on where the
+    # previous one was cut, so that is one pass over plain floats
+    median_end_ms = median_end_ms.tolist()
+    too_long = too_long.tolist()
+    durations = durations.tolist()
+
+    segments = []
+    segment_end = 0
+    first = None
+    total_duration = 0
+
+    for index in range(len(median_end_ms)):
+        if median_end_ms[index] - segment_start >= max_duration and segment_end != segment_start:
+            if first is not None:
+                segments.append((segment_start, segment_end, first, index - 1))
+            first = None
+            total_duration = 0
+            segment_start = segment_end
+
+        segment_end = median_end_ms[index]
+
+        if too_long[index]:
+            first = None
+            total_duration = 0
+            segment_start = segment_end
+        else:
+            if first is None:
+                first = index
+            total_duration += durations[index]
+
+    if total_duration > 0 and first is not None:
+        segments.append((segment_start, segment_end, first, len(median_end_ms) - 1))
+
+    return valid, pd.DataFrame(segments, columns=plan_columns)
+
+
+def pack_segments(starts, ends, max_duration=30000, padding=200):
+    """
+    Alternative to plan_segments that packs the sentences into as few segments of less
+    than max_duration as possible, so less of every 30 s Whisper window is padding.
+
+    A segment opens at most padding ms before its first sentence and closes at most
+    padding ms after its last one (never beyond the midpoint of the surrounding silence),
+    so the silence between segments is left out. Among the packings with the fewest
+    segments, dynamic programming picks the one with the most even segment lengths.
+    Sentences that do not fit in a segment on their own are dropped; unlike
+    plan_segments, the sentences around them are kept.
+
+    Returns (valid, plan) like plan_segments.
+    """
+    starts = np.asarray(starts, dtype=np.float64)
+    ends = np.asarray(ends, dtype=np.float64)
+
+    valid = (starts > 0) & (ends >= starts)
+    if not valid.any():
+        return valid, pd.DataFrame(columns=plan_columns)
+
+    start_ms, median_end_ms, _ = sentence_bounds(starts[valid], ends[valid])
+    end_ms = ends[valid] * 1000
+
+    previous_end_ms = np.append(-np.inf, median_end_ms[:-1])
+    opens = np.maximum(previous_end_ms, start_ms - padding).tolist()
+    closes = np.minimum(median_end_ms, end_ms + padding).tolist()
+    fits = [close - open < max_duration for open, close in zip(opens, closes)]
+
+    count = len(opens)
+
+    # best[k]: (segments, squared padding in s, first sentence of the last segment) of the
+    # best packing of the first k sentences
+    best = [(0, 0.0, None)] + [None] * count
+
+    for end in range(count):
+        if not fits[end]:
+            best[end + 1] = (best[end][0], best[end][1], None)
+            continue
+
+        candidate = None
+        for first in range(end, -1, -1):
+            length = closes[end] - opens[first]
+            if length >= max_duration or not fits[first]:
+                break
+
+            segments, cost, _ = best[first]
+            option = (segments + 1, cost + ((max_duration - length) / 1000) ** 2, first)
+            if candidate is None or option[:2] < candidate[:2]:
+                candidate = option
+
+        best[end + 1] = candidate
+
+    segments = []
+    end = count
+    while end > 0:
+        first = best[end][2]
+        if first is None:
+            end -= 1
+            continue
+        segments.append((opens[first], closes[end - 1], first, end - 1))
+        end = first
+
+    return valid, pd.DataFrame(segments[::-1], columns=plan_columns)
+
+
+def plan_summary(plan, max_duration=30000, bin_seconds=5):
+    """
+    Segment count, audio hours, fill ratio (audio per max_duration window) and a
+    histogram of the segment lengths of a plan.
+    """
+    lengths = (plan["end_ms"] - plan["start_ms"]).to_numpy(dtype=np.float64) / 1000
+    bins = np.arange(0, max_duration / 1000 + bin_seconds, bin_seconds)
+    histogram, _ = np.histogram(lengths, bins=bins)
+
+    return {
+        "segments": len(lengths),
+        "audio_hours": lengths.sum() / 3600,
+        "fill_ratio": lengths.sum() / (len(lengths) * max_duration / 1000) if len(lengths) else 0.0,
+        "histogram": {f"{low:g}-{low + bin_seconds:g}s": int(bin_count)
+                      for low, bin_count in zip(bins[:-1], histogram)},
+    }
+
+
+def format_summaries(summaries):
+    """
+    Side by side table of plan_summary results, e.g. {"greedy": ..., "packed": ...}.
+    """
+    names = list(summaries)
+    rows = [("segments", lambda summary: f"{summary['segments']}"),
+            ("audio hours", lambda summary: f"{summary['audio_hours']:.2f}"),
+            ("fill ratio", lambda summary: f"{summary['fill_ratio']:.1%}")]
+    rows += [(f"  {label}", lambda summary, label=label: f"{summary['histogram'][label]}")
+             for label in summaries[names[0]]["histogram"]]
+
+    lines = [f"{'':<14}" + "".join(f"{name:>12}" for name in names)]
+    for label, value in rows:
+        lines.append(f"{label:<14}" + "".join(f"{value(summaries[name]):>12}" for name in names))
+    return "\n".join(lines)
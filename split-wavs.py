@@ -1,22 +1,42 @@
 from concurrent.futures import ProcessPoolExecutor
 import os
 import json
-import time
 from pydub import AudioSegment
 import pandas as pd
-import ffmpeg
-import whisper
-from faster_whisper import WhisperModel
 import os
 import re
 import jiwer
 from transformers.models.whisper.english_normalizer import BasicTextNormalizer
-from tqdm import tqdm, trange
+from tqdm import tqdm
+from build_manifest import BuildManifest
+from log_mel import LogMelWriter
+from metrics import Metrics
+from transcription_cache import TranscriptionCache
+from segment_plan import format_summaries, pack_segments, plan_segments, plan_summary
+from timeline_gate import TimelineGate
+from timeline_io import read_timeline
+from verification_cascade import CascadeStats, VerificationCascade
+from dedup_index import DedupIndex, index_filename
+from ingest import audio_extensions
+from wav_io import MappedWav, StreamedAudio, segment_ref, write_wav
+from whisper_server import WhisperClient, WhisperServer
 
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 
-# whisper_model = whisper.load_model('large-v2')
-whisper_model = WhisperModel('large-v2', device="cuda", compute_type="float16")
+whisper_model_name = 'large-v2'
+whisper_compute_type = "float16"
+whisper_decode_options = {"beam_size": 5}
+
+# Chunks whose echogarden word timing is clearly off are dropped before they are
+# exported and transcribed, see timeline_gate.default_limits for the other limits
+timeline_gate_limits = {"max_words_per_second": 7.0, "max_gap": 5.0}
+
+# Greedy decoding for the cheap models of the verification cascade (--cascade-models)
+cascade_decode_options = {"beam_size": 1}
+
+# Segments whose transcript differs more than this from the reference are dropped
+max_change_percent = 20
+max_wer = 0.3
 whisper_norm = BasicTextNormalizer()
 
 import argparse
@@ -30,133 +50,341 @@ parser.add_argument('--output-directory', required=True, type=str,
                     help='The output directory where results will be saved')
 parser.add_argument('--engine', default="dtw-ra", type=str,
                     help='The engine used for processing (default: dtw-ra)')
+parser.add_argument('--cache-directory', default=".transcription_cache", type=str,
+                    help='Directory of the transcription cache shared with filter-segments.py and of the parsed timelines (default: .transcription_cache)')
+parser.add_argument('--cache-size', default=1024, type=int,
+                    help='Maximum size of the transcription cache in MB (default: 1024)')
+parser.add_argument('--devices', default="cuda:0", type=str,
+                    help='Comma separated devices the Whisper server loads a model on (default: cuda:0)')
+parser.add_argument('--workers', default=4, type=int,
+                    help='Number of processes slicing and exporting audio (default: 4)')
+parser.add_argument('--manifest', default="pipeline_manifest.sqlite", type=str,
+                    help='Build manifest shared by all pipeline stages (default: pipeline_manifest.sqlite)')
+parser.add_argument('--virtual', action='store_true',
+                    help='Do not write a wav per segment, reference byte ranges of the source wav in segments.csv instead')
+parser.add_argument('--batch-size', default=8, type=int,
+                    help='Number of segments transcribed together by Whisper (default: 8)')
+parser.add_argument('--stream', action='store_true',
+                    help='Decode the compressed recording (e.g. MP3) through an ffmpeg pipe instead of reading a full length 16 kHz wav')
+parser.add_argument('--log-mel', action='store_true',
+                    help='Also store the Whisper log-mel features of the kept segments in log_mel.bin, next to segments.csv')
+parser.add_argument('--n-mels', default=80, type=int,
+                    help='Number of mel bins of the stored features, 128 for large-v3 (default: 80)')
+parser.add_argument('--packing', default="greedy", choices=["greedy", "packed"],
+                    help='How sentences are grouped into segments: greedy, or packed to fill the 30 s windows as much as possible (default: greedy)')
+parser.add_argument('--metrics', default="pipeline_metrics.jsonl", type=str,
+                    help='JSON lines file the timings of every recording and of the run are appended to (default: pipeline_metrics.jsonl)')
+parser.add_argument('--prometheus', default=None, type=str,
+                    help='Also write the run summary in Prometheus text format to this file')
+parser.add_argument('--plan-only', action='store_true',
+                    help='Only plan the segments of every recording and write them to segment_plan.csv, without touching audio')
+parser.add_argument('--no-timeline-gate', action='store_true',
+                    help='Do not drop chunks with implausible echogarden word timing before transcribing them')
+parser.add_argument('--cascade-models', default="", type=str,
+                    help='Comma separated cheaper Whisper models that verify every segment before large-v2, e.g. small (default: none)')
+parser.add_argument('--cascade-device', default="cpu", type=str,
+                    help='Device the cascade models run on (default: cpu)')
+parser.add_argument('--cascade-compute-type', default="int8", type=str,
+                    help='Compute type of the cascade models (default: int8)')
+parser.add_argument('--wer-band', default=0.1, type=float,
+                    help='Segments of which a cascade model\'s WER is within this of the WER threshold go on to the next model (default: 0.1)')
+parser.add_argument('--change-band', default=10, type=float,
+                    help='Same for the length change, in percent (default: 10)')
+parser.add_argument('--keep-duplicates', action='store_true',
+                    help=f'Also split the recordings {index_filename} in --directory (written by ingest.py) marks as a copy of another one')
 
 args = parser.parse_args()
 
+if args.stream and args.virtual:
+    parser.error("--virtual segments reference the 16 kHz wav, which --stream does not use")
+
 directory = args.directory
 engine = args.engine
 input_directory = args.input_directory
 output_directory = args.output_directory
+batch_size = args.batch_size
+cache_directory = args.cache_directory
+cache_size = args.cache_size
+
+devices = args.devices.split(",")
+workers = args.workers
+
+manifest_path = args.manifest
+virtual_segments = args.virtual
+stream_audio = args.stream
+
+use_timeline_gate = not args.no_timeline_gate
+packing = args.packing
+log_mel_bins = args.n_mels if args.log_mel else None
+
+wer_band = args.wer_band
+change_band = args.change_band
+
+# Models that verify the segments, from the cheapest to the reference model
+verification_tiers = [
+    {"name": model_name, "model_name": model_name, "devices": [args.cascade_device],
+     "compute_type": args.cascade_compute_type, "decode_options": cascade_decode_options}
+    for model_name in args.cascade_models.split(",") if model_name
+] + [
+    {"name": whisper_model_name, "model_name": whisper_model_name, "devices": devices,
+     "compute_type": whisper_compute_type, "decode_options": whisper_decode_options}
+]
+
+# Opened lazily, so every pool worker gets its own database connections
+transcription_caches = {}
+manifest = None
+cascade = None
+
+# Timings of the hot sections, reset for every recording in the pool workers
+metrics = Metrics("split")
+
+# Tier name -> transcriber, set per worker by connect_transcribers; anything with a
+# transcribe_batch(pcms) method works, e.g. a whisper_server.FakeTranscriber in tests
+transcribers = {}
 
 os.makedirs(output_directory, exist_ok=True)
 
-def convert_to_wav(input_file, output_file):
-    """
-    Converts an audio file to WAV format using ffmpeg with specified parameters.
-    - Sample rate: 16000 Hz
-    - Audio channels: 1 (mono)
-    - Audio codec: pcm_s16le
-    """
-
-    print(f"{input_file} to {output_file}")
-    try:
-        (
-            ffmpeg
-            .input(input_file)
-            .output(output_file, ar=16000, ac=1, c='pcm_s16le')
-            .run(overwrite_output=True)
-        )
-        print(
-            f"Converted {input_file} to {output_file} with format -ar 16000 -ac 1 -c:a pcm_s16le")
-    except Exception as e:
-        print(f"Error converting file: {e}")
-
-
-def process_audio_segments(wav_file, timestamps, output_dir, max_duration=30000):
+def process_audio_segments(wav_file, timestamps, output_dir, max_duration=30000, words=None):
     """
     Processes the audio segments based on timestamps and saves them with increasing index filenames.
     Creates a CSV mapping the filenames to the corresponding sentences.
+    words holds the (start, end) of the words of every sentence; when given, chunks with
+    implausible word timing are rejected before they are exported.
     """
-    audio = AudioSegment.from_wav(wav_file)
+    # Where the segments go is planned up front, the loop below only slices and verifies
+    valid, plan = plan_recording(timestamps, max_duration)
+    sentences = [item[2] for item, keep in zip(timestamps, valid) if keep]
+
+    if stream_audio:
+        # Decoded on the fly, only the samples of the next segment are held in memory
+        audio = StreamedAudio(wav_file)
+    else:
+        # Memory mapped, so only the samples of the segments we export are ever read
+        audio = MappedWav(wav_file)
     data = []
-    total_duration = 0
+    pending = []
     segment_index = 0
-    total_sentence = []
-    segment_start = timestamps[0][0]*1000
-    segment_end = 0
+    features = None
 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
     csv_filename = os.path.join(output_dir, "segments.csv")
-    if os.path.exists(csv_filename):
-        return
 
     print(f"Processing {wav_file}")
 
-    timestamps = list(filter(lambda item: (
-        item[0] > 0 and item[1] >= item[0]), timestamps))
+    # Segments of an earlier, outdated or interrupted run must not end up next to the new ones
+    clear_segments(output_dir)
+
+    if log_mel_bins:
+        features = LogMelWriter(output_dir, log_mel_bins)
+
+    gate = None
+    if use_timeline_gate and words is not None:
+        gate = TimelineGate([item for item, keep in zip(words, valid) if keep],
+                            timeline_gate_limits)
 
     print(' ', end='', flush=True)
-    for index in trange(len(timestamps)):
-        start, end, sentence = timestamps[index]
+    try:
+        for segment in tqdm(plan.itertuples(index=False), total=len(plan)):
+            if gate is not None and gate.check(segment.first_sentence, segment.last_sentence,
+                                               segment.start_ms, segment.end_ms) is not None:
+                continue
+
+            export_segment(audio, segment.start_ms, segment.end_ms, segment_index,
+                           sentences[segment.first_sentence:segment.last_sentence + 1],
+                           pending, data, output_dir, features)
+            segment_index += 1
+    finally:
+        if stream_audio:
+            audio.close()
 
-        start_ms = start * 1000
-        end_ms = end * 1000
+    # Verify whatever is left over from the last, partially filled batch
+    verify_segments(pending, data, features)
 
-        next_start_ms = timestamps[index+1][0] * \
-            1000 if index+1 < len(timestamps) else end_ms
+    if features is not None:
+        features.close()
 
-        median_end_ms = ((next_start_ms - end_ms) // 2) + end_ms
+    df = pd.DataFrame(data, columns=["filename", "sentence", "duration"])
 
-        duration = median_end_ms - start_ms
-        # print(f"Duration: {duration} {sentence}")
+    # Written under a temporary name first, so an interrupted run never leaves a partial csv
+    df.to_csv(csv_filename + ".tmp", index=False)
+    os.replace(csv_filename + ".tmp", csv_filename)
+    print(f"Segments and sentences saved to {csv_filename}")
 
-        if int(median_end_ms - segment_start) >= max_duration and segment_end != segment_start:
-            export_segment(audio, segment_start, segment_end,
-                           segment_index, total_sentence, data, output_dir)
+    if packing == "packed":
+        _, greedy_plan = plan_recording(timestamps, max_duration, plan_segments)
+        print(format_summaries({"greedy": plan_summary(greedy_plan, max_duration),
+                                "packed": plan_summary(plan, max_duration)}))
+
+    if gate is not None:
+        report = {"invalid_sentences": int((~valid).sum()), **gate.report()}
+        with open(os.path.join(output_dir, "timeline_gate.json"), "w", encoding="utf8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Timeline gate rejected {report['rejected']} of {report['chunks']} chunks "
+              f"of {wav_file} {report['reasons']}, {report['invalid_sentences']} sentences had invalid times")
 
-            segment_index += 1
-            total_duration = 0
-            total_sentence = []
-            segment_start = segment_end
 
-        segment_end = median_end_ms
+def clear_segments(output_dir):
+    for filename in os.listdir(output_dir):
+        name, extension = os.path.splitext(filename)
+        if ((extension == ".wav" and name.isdigit())
+                or filename in ("segments.csv", "log_mel.bin", "log_mel_index.csv")):
+            os.remove(os.path.join(output_dir, filename))
 
-        if (duration > max_duration):
-            total_duration = 0
-            total_sentence = []
-            segment_start = segment_end
+
+def get_manifest():
+    global manifest
+    if manifest is None:
+        manifest = BuildManifest(manifest_path)
+    return manifest
+
+
+def split_params(max_duration=30000):
+    """
+    Everything besides the input files that determines the contents of segments.csv.
+    """
+    return {
+        "max_duration": max_duration,
+        "model": whisper_model_name,
+        "compute_type": whisper_compute_type,
+        "decode_options": whisper_decode_options,
+        "max_change_percent": max_change_percent,
+        "max_wer": max_wer,
+        "virtual": virtual_segments,
+        "packing": packing,
+        "log_mel_bins": log_mel_bins,
+        "timeline_gate": timeline_gate_limits if use_timeline_gate else None,
+        "cascade": [{key: tier[key] for key in ("model_name", "compute_type", "decode_options")}
+                    for tier in verification_tiers[:-1]],
+        "wer_band": wer_band,
+        "change_band": change_band,
+    }
+
+
+def get_transcription_cache(tier):
+    if tier["name"] not in transcription_caches:
+        transcription_caches[tier["name"]] = TranscriptionCache(
+            cache_directory, tier["model_name"], tier["compute_type"],
+            tier["decode_options"], max_bytes=cache_size * 1024 * 1024)
+    return transcription_caches[tier["name"]]
+
+
+def get_cascade():
+    global cascade
+    if cascade is None:
+        cascade = VerificationCascade(
+            [(tier["name"], lambda pcms, tier=tier: transcribe(tier, pcms))
+             for tier in verification_tiers],
+            score, max_wer, max_change_percent, wer_band, change_band)
+    return cascade
+
+
+def transcribe(tier, pcms):
+    """
+    Transcribes the segments with the model of a verification tier, from the transcription
+    cache when possible. Only the cache misses go to the model.
+    """
+    audio_seconds = sum(len(pcm) for pcm in pcms) / 32000
+
+    with metrics.section(f"transcribe:{tier['name']}", audio_seconds):
+        cache = get_transcription_cache(tier)
+        transcripts = [cache.get(pcm) for pcm in pcms]
+
+        missing = [index for index, transcript in enumerate(transcripts)
+                   if transcript is None]
+        if missing:
+            new_transcripts = transcribers[tier["name"]].transcribe_batch(
+                [pcms[index] for index in missing])
+            for index, transcript in zip(missing, new_transcripts):
+                cache.put(pcms[index], transcript)
+                transcripts[index] = transcript
+
+    return transcripts
+
+
+def segment_to_pcm(segment):
+    """
+    Converts a pydub AudioSegment to the 16 kHz mono pcm_s16le bytes that are written to disk,
+    so the segment can be transcribed without reading it back.
+    """
+    return segment.set_frame_rate(16000).set_channels(1).set_sample_width(2).raw_data
+
+
+def export_segment(audio, segment_start, segment_end, segment_index, total_sentence, pending, data, output_dir,
+                   features=None):
+    """
+    Writes the segment to disk (or, for virtual segments, only references its byte range in
+    the source wav) and queues its samples for verification.
+    The queue is transcribed as soon as it holds a full batch.
+    """
+    with metrics.section("export_segment", (segment_end - segment_start) / 1000):
+        samples = audio.slice_ms(segment_start, segment_end)
+        segment_filename = os.path.join(
+            output_dir, f"{segment_index+1}.wav")
+
+        if virtual_segments and isinstance(audio, MappedWav) and audio.is_whisper_format():
+            # The source already holds the exact bytes of the segment, only reference them
+            pcm = samples.tobytes()
+            segment_filename = segment_ref(
+                audio.path, *audio.byte_range_ms(segment_start, segment_end))
+        elif audio.is_whisper_format():
+            # Already -ar 16000 -ac 1 -c:a pcm_s16le, so copy the samples instead of spawning ffmpeg
+            pcm = samples.tobytes()
+            write_wav(segment_filename, pcm)
         else:
-            total_sentence.append(sentence)
-            total_duration += duration
+            segment = AudioSegment(data=samples.tobytes(), sample_width=audio.sample_width,
+                                   frame_rate=audio.frame_rate, channels=audio.channels)
+            segment.export(segment_filename, format="wav", parameters=[
+                "-ar", "16000", "-ac", "1", "-c:a", "pcm_s16le"])
+            pcm = segment_to_pcm(segment)
 
-    if total_duration > 0:
-        export_segment(audio, segment_start, segment_end,
-                       segment_index, total_sentence, data, output_dir)
+    pending.append({
+        "filename": segment_filename,
+        "sentence": " ".join(total_sentence),
+        "duration": segment_end - segment_start,
+        "pcm": pcm,
+    })
 
-    df = pd.DataFrame(data, columns=["filename", "sentence", "duration"])
-    df.to_csv(csv_filename, index=False)
-    print(f"Segments and sentences saved to {csv_filename}")
+    if len(pending) >= batch_size:
+        verify_segments(pending, data, features)
 
 
-def export_segment(audio, segment_start, segment_end, segment_index, total_sentence, data, output_dir):
-    segment = audio[segment_start:segment_end]
-    segment_filename = os.path.join(
-        output_dir, f"{segment_index+1}.wav")
-    segment.export(segment_filename, format="wav", parameters=[
-        "-ar", "16000", "-ac", "1", "-c:a", "pcm_s16le"])
+def verify_segments(pending, data, features=None):
+    """
+    Verifies the queued segments as one batch and appends the ones that pass the
+    WER / length change check to data, and their log-mel features to features when given.
+    Empties the queue.
+    """
+    if not pending:
+        return
 
-    whisper_segments, whisper_info = whisper_model.transcribe(
-        segment_filename, beam_size=5)
-    # whisper_result = whisper_model.transcribe(segment_filename, decode_options={
-    #     'language': 'nl'
-    # })
+    results = get_cascade().verify([item["pcm"] for item in pending],
+                                   [item["sentence"] for item in pending])
 
-    total_sentence = " ".join(total_sentence)
+    for item, result in zip(pending, results):
+        if result["accepted"]:
+            data.append([item["filename"], item["sentence"], item["duration"]])
+            if features is not None:
+                features.add(item["filename"], item["pcm"])
 
-    # The transcription will actually run here.
-    whisper_transcript = " ".join(
-        map(lambda item: item.text, whisper_segments))
+    pending.clear()
 
+
+def score(total_sentence, whisper_transcript):
+    """
+    Returns the WER and the word count change in percent of a Whisper transcript
+    compared to the reference sentence.
+    """
     reference_length = len(re.findall(r'\w+', total_sentence))
     whisper_length = len(re.findall(r'\w+', whisper_transcript))
 
     change_percent = (
         (whisper_length - reference_length)/reference_length) * 100
 
-    jiwer_score = jiwer.process_words(
-        whisper_norm(total_sentence), whisper_norm(whisper_transcript))
+    with metrics.section("process_words"):
+        jiwer_score = jiwer.process_words(
+            whisper_norm(total_sentence), whisper_norm(whisper_transcript))
 
     # jiwer_char_score = jiwer.process_characters(whisper_norm(total_sentence), whisper_norm(whisper_transcript))
 
@@ -166,40 +394,37 @@ def export_segment(audio, segment_start, segment_end, segment_index, total_sente
 
     # KEEP, old values for reference: if abs(change_percent) > 25 or jiwer_score.wer > 0.5:
 
-    if abs(change_percent) > 20 or jiwer_score.wer > 0.3:
-        pass
-        # print("WHISP:" + str(whisper_length) + " " + whisper_transcript)
-        # print("REF  :" + str(reference_length) + " " + total_sentence)
-        # print(f"CHANGE AT #{segment_index}: " +
-        #   str(int(change_percent)) + "%\n\n")
-    else:
+    # print("WHISP:" + str(whisper_length) + " " + whisper_transcript)
+    # print("REF  :" + str(reference_length) + " " + total_sentence)
+    # print(f"CHANGE AT #{segment_index}: " +
+    #   str(int(change_percent)) + "%\n\n")
 
-        # print(f"WER: {jiwer_score.wer}")
-        # print(f"MER: {jiwer_score.mer}")
-        # print(f"WIL: {jiwer_score.wil}")
-        # print(f"WIP: {jiwer_score.wip}")
-        # print(f"INS: {jiwer_score.insertions}")
-        # print(f"SUB: {jiwer_score.substitutions}")
-        # print(f"DEL: {jiwer_score.deletions}")
-        # print(f"HTS: {jiwer_score.hits}")
-        # print(f"CHANGE AT #{segment_index}: " +
-        #       str(int(change_percent)) + "%")
-        total_duration = segment_end - segment_start
-        data.append([segment_filename, total_sentence, total_duration])
+    # print(f"WER: {jiwer_score.wer}")
+    # print(f"MER: {jiwer_score.mer}")
+    # print(f"WIL: {jiwer_score.wil}")
+    # print(f"WIP: {jiwer_score.wip}")
+    # print(f"INS: {jiwer_score.insertions}")
+    # print(f"SUB: {jiwer_score.substitutions}")
+    # print(f"DEL: {jiwer_score.deletions}")
+    # print(f"HTS: {jiwer_score.hits}")
+    return jiwer_score.wer, change_percent
 
 
 def process_file(filename):
+    """
+    Splits one recording. Returns the verification cascade statistics and the timings of
+    the recording, or None when it was skipped.
+    """
     # split the filename into name and extension
     name, extension = os.path.splitext(filename)
 
     if (
         extension == '.json'
         and os.path.exists(os.path.join(directory, f'{name}.txt'))
-        and os.path.exists(os.path.join(directory, f'{name}.wav'))
+        and recording_file(name) is not None
     ):
 
-        mp3_file = os.path.join(directory, f'{name}.MP3')
-        wav_file = os.path.join(directory, f'{name}.wav')
+        wav_file = recording_file(name)
         json_file_path = os.path.join(
             input_directory, f"{name}.json")
 
@@ -207,26 +432,101 @@ def process_file(filename):
             print(f"JSON does not exist for {name}")
             return
 
-        # Convert the input audio file to WAV format
-        if not os.path.exists(wav_file):
-            print(f"WAV does not exist for {name} at {wav_file}")
-            convert_to_wav(mp3_file, wav_file)
+        # Output directory for audio segments
+        segments_output_dir = os.path.join(
+            output_directory, f"audio_segments_{name}")
+        csv_filename = os.path.join(segments_output_dir, "segments.csv")
 
-        with open(json_file_path, 'r', encoding="utf8") as f:
-            data = json.load(f)
+        # Skip recordings whose segments were built from the current audio and alignment
+        inputs = [wav_file, json_file_path]
+        if get_manifest().is_fresh("split", csv_filename, inputs, split_params()):
+            return
 
-            # List of timestamps (start, end, sentence)
-            timestamps = [(sentence['startTime'], sentence['endTime'], sentence['text'])
-                          for item in data
-                          for sentence in item['timeline']]
+        # Counted per recording, so the pool workers' statistics can be added up in main
+        get_cascade().stats = CascadeStats()
+        metrics.reset()
 
-            # Output directory for audio segments
-            segments_output_dir = os.path.join(
-                output_directory, f"audio_segments_{name}")
+        timestamps, words = load_timeline(json_file_path)
+        audio_seconds = max((item[1] for item in timestamps), default=0)
 
+        with metrics.section("process_file", audio_seconds):
             # Process audio segments
             process_audio_segments(
-                wav_file, timestamps, segments_output_dir)
+                wav_file, timestamps, segments_output_dir, words=words)
+
+        metrics.add_audio(audio_seconds)
+        get_manifest().record("split", csv_filename, inputs, split_params())
+
+        return {"recording": name, "cascade": get_cascade().stats.tiers,
+                "metrics": metrics.snapshot()}
+
+
+def recording_file(name):
+    """
+    The audio the segments of a recording are cut from: its 16 kHz wav, or with --stream
+    its compressed source when there is one. None when the recording has no audio.
+    """
+    if stream_audio:
+        for extension in sorted(audio_extensions):
+            for variant in (extension, extension.upper()):
+                path = os.path.join(directory, f"{name}{variant}")
+                if os.path.exists(path):
+                    return path
+
+    path = os.path.join(directory, f"{name}.wav")
+    return path if os.path.exists(path) else None
+
+
+def plan_recording(timestamps, max_duration=30000, planner=None):
+    """
+    Plans the segments of a recording with the --packing mode, see segment_plan.py.
+    """
+    if planner is None:
+        planner = pack_segments if packing == "packed" else plan_segments
+    return planner([item[0] for item in timestamps],
+                   [item[1] for item in timestamps], max_duration)
+
+
+def load_timeline(json_file_path):
+    """
+    Returns the (start, end, sentence) of every sentence of an echogarden timeline and the
+    (start, end) of the words of every sentence, for the timeline gate.
+    The json is streamed one sentence at a time and what is extracted is cached, keyed on
+    the hash of the json, so a later run does not parse it again.
+    """
+    return read_timeline(json_file_path, os.path.join(cache_directory, "timelines"),
+                         get_manifest().file_hash(json_file_path))
+
+
+def plan_corpus(files, planner=None):
+    """
+    Plans the segments of every recording without reading any audio.
+    """
+    plans = []
+    for filename in files:
+        name = os.path.splitext(filename)[0]
+        timestamps, _ = load_timeline(os.path.join(input_directory, filename))
+        if not timestamps:
+            continue
+
+        valid, plan = plan_recording(timestamps, planner=planner)
+        sentences = [item[2] for item, keep in zip(timestamps, valid) if keep]
+
+        plan.insert(0, "recording", name)
+        plan["sentence"] = [" ".join(sentences[first:last + 1])
+                            for first, last in zip(plan.first_sentence, plan.last_sentence)]
+        plans.append(plan)
+
+    return pd.concat(plans, ignore_index=True) if plans else pd.DataFrame()
+
+
+def connect_transcribers(endpoints):
+    """
+    Pool initializer, connects the worker to the Whisper server of every verification tier.
+    endpoints maps the tier name to the server's (address, authkey).
+    """
+    for name, (address, authkey) in endpoints.items():
+        transcribers[name] = WhisperClient(address, authkey)
 
 
 def main():
@@ -239,13 +539,64 @@ def main():
                         os.path.exists(os.path.join(
                             directory, f"{os.path.splitext(file)[0]}.txt"))
                         and
-                        os.path.exists(os.path.join(
-                            directory, f"{os.path.splitext(file)[0]}.wav"))
+                        recording_file(os.path.splitext(file)[0]) is not None
                         ]
 
-    # Use ProcessPoolExecutor to process files concurrently
-    with ProcessPoolExecutor(max_workers=4) as executor:
-        executor.map(process_file, files_to_process)
+    # Copies of another recording would end up in the dataset twice
+    index_path = os.path.join(directory, index_filename)
+    if not args.keep_duplicates and os.path.exists(index_path):
+        dedup_index = DedupIndex.load(index_path)
+        duplicates = [file for file in files_to_process
+                      if dedup_index.duplicate_of(os.path.splitext(file)[0]) is not None]
+        for file in duplicates:
+            print(f"Skipping {file}, a duplicate of {dedup_index.duplicate_of(os.path.splitext(file)[0])}")
+        files_to_process = [file for file in files_to_process if file not in duplicates]
+
+    if args.plan_only:
+        plan = plan_corpus(files_to_process)
+        plan.to_csv(os.path.join(output_directory, "segment_plan.csv"), index=False)
+        if len(plan):
+            print(f"Planned {len(plan)} segments, "
+                  f"{(plan.end_ms - plan.start_ms).sum() / 3600000:.1f} hours of audio")
+
+            # How much of the 30 s windows the packed plan fills, next to the greedy baseline
+            summaries = {"greedy": plan_summary(plan_corpus(files_to_process, plan_segments)),
+                         "packed": plan_summary(plan_corpus(files_to_process, pack_segments))}
+            print(format_summaries(summaries))
+            with open(os.path.join(output_directory, "segment_plan_summary.json"), "w", encoding="utf8") as f:
+                json.dump(summaries, f, indent=2)
+        return
+
+    # One process per verification tier owns its Whisper model(s), the pool workers only
+    # slice audio and send their segments to them
+    servers = [WhisperServer(devices=tier["devices"], model_name=tier["model_name"],
+                             compute_type=tier["compute_type"],
+                             decode_options=tier["decode_options"],
+                             batch_size=batch_size)
+               for tier in verification_tiers]
+    stats = CascadeStats()
+
+    try:
+        endpoints = {tier["name"]: (server.start().address, server.authkey)
+                     for tier, server in zip(verification_tiers, servers)}
+
+        # Use ProcessPoolExecutor to process files concurrently
+        with ProcessPoolExecutor(max_workers=workers, initializer=connect_transcribers,
+                                 initargs=(endpoints,)) as executor:
+            for result in executor.map(process_file, files_to_process):
+                if result is not None:
+                    stats.merge(result["cascade"])
+                    metrics.merge(result["metrics"])
+                    metrics.write_event(args.metrics, "recording",
+                                        recording=result["recording"], **result["metrics"])
+    finally:
+        for server in servers:
+            server.stop()
+
+    print(stats.report())
+    print(metrics.write_summary(args.metrics, args.prometheus))
+    with open(os.path.join(output_directory, "verification_stats.json"), "w", encoding="utf8") as f:
+        json.dump(stats.tiers, f, indent=2)
 
 
 if __name__ == "__main__":
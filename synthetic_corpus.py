@@ -0,0 +1,164 @@
+import json
+import os
+import zlib
+
+import numpy as np
+
+from wav_io import write_wav
+from whisper_server import FakeTranscriber
+
+
+SAMPLE_RATE = 16000
+
+# Every word of the vocabulary is a tone of its own frequency, so the stub transcriber can
+# read the words back from any slice of the audio
+BASE_FREQUENCY = 250.0
+FREQUENCY_STEP = 25.0
+VOCABULARY_SIZE = 256
+
+# Level below which a 10 ms frame counts as silence
+SILENCE_RMS = 0.02
+
+
+def make_vocabulary(size=VOCABULARY_SIZE):
+    syllables = [consonant + vowel for consonant in "bdfgklmnprstvz" for vowel in "aeiou"]
+    words = [first + second for first in syllables for second in syllables]
+    rng = np.random.default_rng(0)
+    return [words[index] for index in rng.choice(len(words), size, replace=False)]
+
+
+vocabulary = make_vocabulary()
+word_index = {word: index for index, word in enumerate(vocabulary)}
+
+
+def synthetic_recording(duration, seed=0, words_per_second=2.5, sentence_words=12, pause=0.6):
+    """
+    A recording of about duration seconds with its transcript and echogarden style timeline.
+
+    Sentences of on average sentence_words words are spoken at words_per_second and
+    separated by pause seconds of silence. Every word is a tone of 70% of its slot followed
+    by silence. Returns (samples, sentences): float32 audio and the text, start, end and
+    (text, start, end) of the words of every sentence, in seconds.
+    """
+    rng = np.random.default_rng(seed)
+    slot = 1 / words_per_second
+
+    sentences = []
+    time_offset = 0.5
+    while time_offset < duration - 1:
+        count = int(rng.integers(max(1, sentence_words // 2), sentence_words * 3 // 2 + 1))
+        indices = rng.integers(0, len(vocabulary), count)
+
+        words = []
+        for index in indices:
+            words.append((vocabulary[index], time_offset, time_offset + 0.7 * slot))
+            time_offset += slot
+
+        text = " ".join(word for word, _, _ in words)
+        sentences.append({"text": text[0].upper() + text[1:] + ".",
+                          "start": words[0][1], "end": words[-1][2], "words": words})
+        time_offset += pause * rng.uniform(0.5, 1.5)
+
+    samples = rng.normal(0, 0.002, int(max(time_offset, duration) * SAMPLE_RATE)).astype(np.float32)
+    for sentence in sentences:
+        for word, start, end in sentence["words"]:
+            first = int(start * SAMPLE_RATE)
+            t = np.arange(int(end * SAMPLE_RATE) - first) / SAMPLE_RATE
+            frequency = BASE_FREQUENCY + FREQUENCY_STEP * word_index[word]
+            samples[first:first + len(t)] += 0.3 * np.sin(2 * np.pi * frequency * t)
+
+    return samples, sentences
+
+
+def timeline(sentences, duration):
+    """
+    The sentences of a synthetic recording as the segment > sentence > word timeline
+    echogarden writes.
+    """
+    return [{
+        "type": "segment",
+        "text": " ".join(sentence["text"] for sentence in sentences),
+        "startTime": 0.0,
+        "endTime": duration,
+        "timeline": [{
+            "type": "sentence",
+            "text": sentence["text"],
+            "startTime": sentence["start"],
+            "endTime": sentence["end"],
+            "timeline": [{"type": "word", "text": word, "startTime": start, "endTime": end}
+                         for word, start, end in sentence["words"]],
+        } for sentence in sentences],
+    }]
+
+
+def write_corpus(directory, timeline_directory, recordings, duration, seed=0, **density):
+    """
+    Writes recordings synthetic recordings of duration seconds as 16 kHz wav files with
+    their transcripts to directory, and their timelines to timeline_directory, as if
+    align.py had aligned them. density is passed on to synthetic_recording.
+    Returns the names of the recordings and their total duration in seconds.
+    """
+    os.makedirs(directory, exist_ok=True)
+    os.makedirs(timeline_directory, exist_ok=True)
+
+    names = []
+    total_duration = 0.0
+    for number in range(recordings):
+        name = f"synthetic_{number:04d}"
+        samples, sentences = synthetic_recording(duration, seed + number, **density)
+        recording_duration = len(samples) / SAMPLE_RATE
+
+        pcm = (np.clip(samples, -1, 1) * 32767).astype(np.int16).tobytes()
+        write_wav(os.path.join(directory, f"{name}.wav"), pcm)
+
+        with open(os.path.join(directory, f"{name}.txt"), "w", encoding="utf8") as f:
+            f.write("\n".join(sentence["text"] for sentence in sentences) + "\n")
+        with open(os.path.join(timeline_directory, f"{name}.json"), "w", encoding="utf8") as f:
+            json.dump(timeline(sentences, recording_duration), f)
+
+        names.append(name)
+        total_duration += recording_duration
+
+    return names, total_duration
+
+
+def decode_words(pcm):
+    """
+    Reads the words back from 16 kHz pcm_s16le bytes of a synthetic recording: every run of
+    non-silent 10 ms frames is one word, its strongest frequency tells which.
+    """
+    samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+    frame = SAMPLE_RATE // 100
+    frame_count = len(samples) // frame
+    if frame_count == 0:
+        return []
+
+    rms = np.sqrt((samples[:frame_count * frame].reshape(frame_count, frame) ** 2).mean(axis=1))
+    active = np.concatenate([[False], rms > SILENCE_RMS, [False]])
+    edges = np.flatnonzero(active[1:] != active[:-1])
+
+    words = []
+    for start, end in zip(edges[::2] * frame, edges[1::2] * frame):
+        spectrum = np.abs(np.fft.rfft(samples[start:end]))
+        frequency = np.argmax(spectrum) * SAMPLE_RATE / (end - start)
+        index = int(round((frequency - BASE_FREQUENCY) / FREQUENCY_STEP))
+        words.append(vocabulary[min(max(index, 0), len(vocabulary) - 1)])
+    return words
+
+
+def stub_transcriber(latency=0.0, error_rate=0.0):
+    """
+    Stand-in for a Whisper tier that transcribes synthetic recordings on the CPU, waiting
+    latency seconds per batch. error_rate of the words are replaced by another word, picked
+    from a hash of the audio, so the same segment always gets the same transcript.
+    """
+    def transcribe(pcm):
+        words = decode_words(pcm)
+        if error_rate:
+            rng = np.random.default_rng(zlib.crc32(pcm))
+            errors = rng.random(len(words)) < error_rate
+            words = [vocabulary[rng.integers(len(vocabulary))] if error else word
+                     for word, error in zip(words, errors)]
+        return " ".join(words)
+
+    return FakeTranscriber(transcribe, latency)
@@ -0,0 +1,171 @@
+import numpy as np
+import pytest
+
+from chunked_alignment import (covers_transcript, misfit_edges, plan_windows, reconcile, stitch_timelines,
+                                widen_window)
+from wav_io import MappedWav, write_wav
+
+
+RATE = 8000
+
+
+def make_recording(path, rates, pause_at=None, pause=0.0, seed=0):
+    """
+    A recording of one sentence per entry of rates, spoken at that many characters per
+    second: a tone while speaking, quiet noise in the pauses between the sentences, and
+    pause extra seconds of silence before sentence pause_at. Returns the sentences and
+    their true (start, end).
+    """
+    rng = np.random.default_rng(seed)
+    sentences = []
+    times = []
+    time = 1.0
+    for index, rate in enumerate(rates):
+        if index == pause_at:
+            time += pause
+        words = [f"w{index}x{word}" for word in range(int(rng.integers(6, 14)))]
+        text = " ".join(words) + "."
+        duration = len(text) / rate
+        sentences.append(text)
+        times.append((time, time + duration))
+        time += duration + rng.uniform(0.3, 0.9)
+
+    samples = rng.normal(0, 0.002, int((time + 1.0) * RATE)).astype(np.float32)
+    for start, end in times:
+        first, last = int(start * RATE), int(end * RATE)
+        samples[first:last] += 0.3 * np.sin(2 * np.pi * 300 * np.arange(last - first) / RATE)
+
+    write_wav(str(path), (np.clip(samples, -1, 1) * 32767).astype(np.int16).tobytes(), RATE)
+    return sentences, times
+
+
+def align_window(window, sentences, times):
+    """
+    What echogarden returns for a window: the true times of its sentences in window time,
+    squeezed onto the edge of the window for the ones whose audio is not in it.
+    """
+    length = window["end"] - window["start"]
+    timeline = []
+    for index in range(window["first_sentence"], window["last_sentence"] + 1):
+        start, end = (min(max(time - window["start"], 0.0), length) for time in times[index])
+        timeline.append({"type": "sentence", "text": sentences[index], "startTime": start, "endTime": end})
+    return [{"type": "segment", "startTime": 0.0, "endTime": length, "timeline": timeline}]
+
+
+uniform = {"rates": [15.0] * 400}
+# A 3 minute pause, which the planner must not spread over the sentences around it
+pausing = {"rates": [15.0] * 400, "pause_at": 120, "pause": 180.0}
+# Slowing down from 16 to 14 characters per second, with a 3 minute pause
+drifting = {"rates": list(np.linspace(16.0, 14.0, 400)), "pause_at": 120, "pause": 180.0}
+# Twice as slow at the end, more than the overlap can absorb
+far_drifting = {"rates": list(np.linspace(20.0, 10.0, 400))}
+
+
+@pytest.mark.parametrize("speech", [uniform, pausing], ids=["uniform", "pausing"])
+def test_plan_windows_puts_sentences_with_their_audio(tmp_path, speech):
+    sentences, times = make_recording(tmp_path / "recording.wav", **speech)
+    audio = MappedWav(str(tmp_path / "recording.wav"))
+
+    windows = plan_windows(audio, sentences, window_duration=300, overlap=30)
+
+    assert len(windows) > 3
+    assert windows[0]["first_sentence"] == 0
+    assert windows[-1]["last_sentence"] == len(sentences) - 1
+    for previous, window in zip(windows, windows[1:]):
+        # Every sentence is in the transcript of at least one window
+        assert window["first_sentence"] <= previous["last_sentence"] + 1
+    for window in windows:
+        for index in range(window["first_sentence"], window["last_sentence"] + 1):
+            assert window["start"] <= times[index][0] and times[index][1] <= window["end"]
+
+
+@pytest.mark.parametrize("speech", [uniform, pausing], ids=["uniform", "pausing"])
+def test_stitch_timelines_keeps_every_sentence_once(tmp_path, speech):
+    sentences, times = make_recording(tmp_path / "recording.wav", **speech)
+    windows = plan_windows(MappedWav(str(tmp_path / "recording.wav")), sentences, 300, 30)
+
+    timeline = stitch_timelines(windows, [align_window(window, sentences, times) for window in windows])
+
+    assert covers_transcript(sentences, timeline)
+    stitched = timeline[0]["timeline"]
+    assert [sentence["text"] for sentence in stitched] == sentences
+    assert np.allclose([sentence["startTime"] for sentence in stitched], [start for start, _ in times])
+
+
+def test_stitch_timelines_loses_sentences_the_windows_missed(tmp_path):
+    sentences, times = make_recording(tmp_path / "recording.wav", **far_drifting)
+    windows = plan_windows(MappedWav(str(tmp_path / "recording.wav")), sentences, 300, 30)
+
+    timeline = stitch_timelines(windows, [align_window(window, sentences, times) for window in windows])
+
+    # align.py aligns such a recording as a whole instead
+    assert not covers_transcript(sentences, timeline)
+
+
+def test_covers_transcript_notices_a_lost_sentence():
+    sentences = ["One two.", "Three four.", "Five six."]
+    timeline = [{"timeline": [{"text": "One two."}, {"text": "Five six."}]}]
+
+    assert not covers_transcript(sentences, timeline)
+    assert covers_transcript(sentences, [{"timeline": [{"text": "one, two three"}, {"text": "four five six"}]}])
+
+
+def test_reconcile_switches_where_the_windows_agree():
+    def sentence(text, start):
+        return {"text": text, "startTime": start, "endTime": start + 1.5}
+
+    # The first window squeezed its last sentence onto its end, the second its first onto its start
+    previous = [sentence("a", 0.0), sentence("b", 2.0), sentence("c", 4.0), sentence("d", 6.0), sentence("e", 7.9)]
+    current = [sentence("b", 2.9), sentence("c", 4.1), sentence("d", 6.0), sentence("e", 8.0), sentence("f", 10.0)]
+
+    cut_previous, cut_current = reconcile(previous, current, 3.0, 8.0)
+
+    assert (cut_previous, cut_current) == (3, 2)
+    assert [item["text"] for item in previous[:cut_previous] + current[cut_current:]] == list("abcdef")
+
+
+def test_reconcile_keeps_windows_without_shared_sentences():
+    previous = [{"text": "a", "startTime": 0.0, "endTime": 1.0}]
+    current = [{"text": "b", "startTime": 1.5, "endTime": 2.5}, {"text": "c", "startTime": 3.0, "endTime": 4.0}]
+
+    assert reconcile(previous, current, 0.5, 4.0) == (1, 0)
+
+
+def align_widening(windows, sentences, times, amount, duration, max_widenings=3):
+    """
+    Aligns every window like align.py's process_window: a window whose first or last
+    sentence was squeezed onto its edge is widened on that side and aligned again.
+    """
+    timelines = []
+    for index, window in enumerate(windows):
+        timeline = align_window(window, sentences, times)
+        for _ in range(max_widenings):
+            widened = widen_window(window, *misfit_edges(timeline), amount, duration)
+            if widened == window:
+                break
+            window = windows[index] = widened
+            timeline = align_window(window, sentences, times)
+        timelines.append(timeline)
+    return timelines
+
+
+def test_misfit_edges_finds_squeezed_sentences():
+    window = {"index": 1, "start": 100.0, "end": 200.0, "first_sentence": 0, "last_sentence": 2}
+    sentences = ["a b c.", "d e f.", "g h i."]
+
+    assert misfit_edges(align_window(window, sentences, [(110, 112), (120, 122), (130, 132)])) == (False, False)
+    assert misfit_edges(align_window(window, sentences, [(90, 92), (120, 122), (210, 212)])) == (True, True)
+    assert widen_window(window, True, False, 30, 1000) == {**window, "start": 70.0}
+
+
+@pytest.mark.parametrize("speech", [uniform, drifting], ids=["uniform", "drifting"])
+def test_widened_windows_cover_the_transcript(tmp_path, speech):
+    sentences, times = make_recording(tmp_path / "recording.wav", **speech)
+    audio = MappedWav(str(tmp_path / "recording.wav"))
+    windows = plan_windows(audio, sentences, 300, 30)
+
+    timelines = align_widening(windows, sentences, times, 30, audio.duration_seconds)
+    timeline = stitch_timelines(windows, timelines)
+
+    assert covers_transcript(sentences, timeline)
+    assert np.allclose([sentence["startTime"] for sentence in timeline[0]["timeline"]], [start for start, _ in times])
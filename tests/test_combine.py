@@ -0,0 +1,33 @@
+import os
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("sklearn")
+
+from benchmark import load_stage
+
+
+def test_combine_converts_windows_paths_and_keeps_the_others(tmp_path):
+    audio = [
+        "C:\\data\\segments\\..\\audio_segments_a\\1.wav",
+        "d:/data//./audio_segments_b/2.wav",
+        "C:/data/a.wav#44-32044",
+        "/home/data/audio_segments_c/3.wav",
+        "audio_segments_d\\4.wav",
+    ]
+    os.makedirs(tmp_path / "recording")
+    pd.DataFrame({"audio": audio, "sentence": ["text"] * len(audio), "duration": [1000] * len(audio)}).to_csv(
+        tmp_path / "recording" / "segments.csv", index=False)
+
+    load_stage("combine.py", [str(tmp_path), "--manifest", str(tmp_path / "manifest.sqlite"),
+                              "--metrics", str(tmp_path / "metrics.jsonl")])
+
+    merged = pd.read_csv(tmp_path / "merged_segments.csv")
+    assert merged["audio"].tolist() == [
+        "/mnt/c/data/audio_segments_a/1.wav",
+        "/mnt/d/data/audio_segments_b/2.wav",
+        "/mnt/c/data/a.wav#44-32044",
+        "/home/data/audio_segments_c/3.wav",
+        "audio_segments_d\\4.wav",
+    ]
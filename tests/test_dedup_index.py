@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+
+from dedup_index import build_index, group_train_test_split, minhash
+
+# Enough permutations for overlap estimates within a few percent, and bands of two rows so
+# LSH finds pairs that share a third
+NUM_PERM = 512
+PARAMS = {"transcript_bands": 256, "audio_bands": 256}
+
+
+def signature(values):
+    values = np.asarray(sorted(values), dtype=np.uint64)
+    return {
+        "transcript": minhash(values, NUM_PERM),
+        "transcript_size": len(values),
+        "audio": minhash(values + 1_000_000, NUM_PERM),
+        "audio_size": len(values),
+    }
+
+
+def test_build_index_skips_copies_and_groups_overlaps():
+    signatures = {
+        "session": signature(range(0, 600)),
+        "reupload": signature(range(0, 600)),
+        # A third of it is the end of session
+        "next_session": signature(range(400, 1000)),
+        "other": signature(range(5000, 5600)),
+    }
+    durations = {"session": 600, "reupload": 590, "next_session": 600, "other": 600}
+
+    index = build_index(signatures, durations, PARAMS)
+
+    assert index.duplicate_of("reupload") == "session"
+    assert index.duplicate_of("session") is None
+    assert index.duplicate_of("next_session") is None
+    assert index.group("next_session") == index.group("session") == index.group("reupload")
+    assert index.group("other") is None
+
+
+def test_build_index_only_skips_duplicates_of_kept_recordings():
+    # A~B~C: B is contained in both A and C, but half of C is in neither A nor B
+    signatures = {
+        "a": signature(range(0, 600)),
+        "b": signature(range(0, 300)),
+        "c": signature(list(range(0, 300)) + list(range(5000, 5300))),
+    }
+    durations = {"a": 100, "b": 30, "c": 60}
+
+    index = build_index(signatures, durations, PARAMS)
+
+    decisions = {(pair["first"], pair["second"]): pair["decision"] for pair in index.pairs}
+    assert decisions == {("a", "b"): "duplicate", ("b", "c"): "duplicate", ("a", "c"): "related"}
+    assert index.duplicate_of("b") == "a"
+    assert index.duplicate_of("c") is None
+    assert index.group("a") == index.group("b") == index.group("c") == "a"
+
+
+def test_group_train_test_split_keeps_groups_together():
+    groups = ["a"] * 30 + ["b"] * 5 + [None] * 65
+    df = pd.DataFrame({"row": range(len(groups))})
+
+    train, test = group_train_test_split(df, groups, test_size=0.1, random_state=3)
+
+    assert len(train) + len(test) == len(df)
+    assert len(test) <= 10
+    for group in ("a", "b"):
+        rows = {index for index, name in enumerate(groups) if name == group}
+        assert rows <= set(train["row"]) or rows <= set(test["row"])
+    # The group of 30 never fits in a test set of 10
+    assert set(range(30)) <= set(train["row"])
@@ -0,0 +1,33 @@
+import os
+
+import pandas as pd
+import pytest
+
+# The stage's own dependencies
+for module in ("pydub", "jiwer", "transformers", "tqdm"):
+    pytest.importorskip(module)
+
+from benchmark import load_stage
+from synthetic_corpus import stub_transcriber, write_corpus
+
+
+def test_transcribers_replace_the_whisper_servers(tmp_path):
+    corpus, timelines, segments = (str(tmp_path / name) for name in ("corpus", "timelines", "segments"))
+    names, _ = write_corpus(corpus, timelines, 1, 120)
+
+    stage = load_stage("split-wavs.py", [
+        "--directory", corpus,
+        "--input-directory", timelines,
+        "--output-directory", segments,
+        "--cache-directory", str(tmp_path / "cache"),
+        "--manifest", str(tmp_path / "manifest.sqlite"),
+    ])
+    fakes = {tier["name"]: stub_transcriber() for tier in stage.verification_tiers}
+    stage.transcribers.update(fakes)
+
+    result = stage.process_file(f"{names[0]}.json")
+
+    assert result["recording"] == names[0]
+    assert sum(fake.calls for fake in fakes.values()) > 0
+    kept = pd.read_csv(os.path.join(segments, f"audio_segments_{names[0]}", "segments.csv"))
+    assert len(kept) > 0
@@ -0,0 +1,33 @@
+import json
+
+import pytest
+
+from timeline_io import iter_sentences
+
+
+def make_timeline():
+    sentences = []
+    time = 0.5
+    for index in range(40):
+        words = []
+        for word in range(7):
+            words.append({"type": "word", "text": f"w{index}_{word}", "startTime": round(time, 3),
+                          "endTime": round(time + 0.29, 3), "confidence": 1e-05 * (word + 1)})
+            time += 0.37
+        sentences.append({"type": "sentence", "text": f"Sentence {index}.", "startTime": words[0]["startTime"],
+                          "endTime": words[-1]["endTime"], "timeline": words})
+    return [{"type": "segment", "text": "...", "startTime": 0.0, "endTime": -12.97e1 * -1,
+             "timeline": sentences}]
+
+
+@pytest.mark.parametrize("read_size", [1, 2, 3, 7, 64, 1024 * 1024])
+def test_iter_sentences_any_read_size(tmp_path, read_size):
+    timeline = make_timeline()
+    path = tmp_path / "timeline.json"
+    path.write_text(json.dumps(timeline, indent=1), encoding="utf8")
+
+    expected = [(sentence["startTime"], sentence["endTime"], sentence["text"],
+                 [(word["startTime"], word["endTime"]) for word in sentence["timeline"]])
+                for sentence in timeline[0]["timeline"]]
+
+    assert list(iter_sentences(str(path), read_size)) == expected
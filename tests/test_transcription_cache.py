@@ -0,0 +1,16 @@
+import transcription_cache
+from transcription_cache import TranscriptionCache
+
+
+def test_cache_keeps_decodes_of_other_pipelines_and_versions_apart(tmp_path, monkeypatch):
+    pcm = b"\x01\x00" * 1600
+    batched = TranscriptionCache(tmp_path, "large-v2", "float16", {"beam_size": 5})
+    batched.put(pcm, "batched transcript")
+
+    sequential = TranscriptionCache(tmp_path, "large-v2", "float16", {"beam_size": 5}, pipeline="sequential")
+    monkeypatch.setattr(transcription_cache, "faster_whisper_version", lambda: "0.0.1")
+    upgraded = TranscriptionCache(tmp_path, "large-v2", "float16", {"beam_size": 5})
+
+    assert batched.get(pcm) == "batched transcript"
+    assert sequential.get(pcm) is None
+    assert upgraded.get(pcm) is None
@@ -0,0 +1,57 @@
+import shutil
+
+import numpy as np
+import pytest
+
+from wav_io import MappedFiles, MappedWav, StreamedAudio, write_wav
+
+needs_ffmpeg = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg is not installed")
+
+
+@pytest.fixture
+def recording(tmp_path):
+    rng = np.random.default_rng(0)
+    samples = (rng.normal(0, 3000, 16000 * 20)).astype(np.int16)
+    path = str(tmp_path / "recording.wav")
+    write_wav(path, samples.tobytes())
+    return path
+
+
+@needs_ffmpeg
+def test_streamed_audio_slices_like_the_wav(recording):
+    wav = MappedWav(recording)
+
+    with StreamedAudio(recording, read_size=4096) as audio:
+        for start_ms, end_ms in [(0, 1500), (1200, 4000), (9000, 12500), (2000, 3000), (19000, 25000)]:
+            assert np.array_equal(audio.slice_ms(start_ms, end_ms), wav.slice_ms(start_ms, end_ms))
+
+
+@needs_ffmpeg
+def test_streamed_audio_reports_decode_errors(tmp_path):
+    path = tmp_path / "broken.mp3"
+    path.write_bytes(b"not audio" * 1000)
+
+    with StreamedAudio(str(path)) as audio:
+        with pytest.raises(RuntimeError, match="could not decode"):
+            audio.slice_ms(0, 1000)
+
+
+def test_mapped_files_close_the_least_recently_used_map(tmp_path):
+    paths = []
+    for number in range(4):
+        path = str(tmp_path / f"{number}.wav")
+        write_wav(path, bytes([number]) * 1000)
+        paths.append(path)
+    mapped_files = MappedFiles(maxsize=2)
+
+    assert mapped_files.read(paths[0], 44, 48) == bytes([0]) * 4
+    first = mapped_files.maps[paths[0]]
+    for path in paths[1:]:
+        mapped_files.read(path, 44, 48)
+
+    assert list(mapped_files.maps) == paths[2:]
+    assert first.closed
+    assert mapped_files.read(paths[0], 1040, 1044) == bytes([0]) * 4
+
+    mapped_files.close()
+    assert not mapped_files.maps
@@ -0,0 +1,141 @@
+import multiprocessing
+import sys
+import threading
+import types
+
+import numpy as np
+import pytest
+
+import whisper_server
+from whisper_server import SAMPLE_RATE, FakeTranscriber, WhisperClient, WhisperTranscriber, serve
+
+AUTHKEY = b"test"
+
+
+def fake_faster_whisper(version, calls):
+    """
+    A faster_whisper module whose pipeline records its transcribe calls and returns one
+    segment per clip, with the index of the clip as its text.
+    """
+    class WhisperModel:
+        def __init__(self, *args, **kwargs):
+            pass
+
+    class BatchedInferencePipeline:
+        def __init__(self, model):
+            pass
+
+        def transcribe(self, audio, **options):
+            calls.append(options)
+            scale = 1 / SAMPLE_RATE if version < "1.2" else 1
+            segments = [types.SimpleNamespace(start=clip["start"] * scale, text=str(index))
+                        for index, clip in enumerate(options["clip_timestamps"])]
+            return iter(segments), None
+
+    return types.SimpleNamespace(__version__=version, WhisperModel=WhisperModel,
+                                 BatchedInferencePipeline=BatchedInferencePipeline)
+
+
+def pcm(seconds):
+    return np.zeros(int(seconds * SAMPLE_RATE), dtype=np.int16).tobytes()
+
+
+def test_transcriber_decodes_with_timestamps(monkeypatch):
+    calls = []
+    monkeypatch.setitem(sys.modules, "faster_whisper", fake_faster_whisper("1.2.0", calls))
+
+    transcriber = WhisperTranscriber(device="cpu", decode_options={"beam_size": 5})
+
+    assert transcriber.transcribe_batch([pcm(1), pcm(2.5), pcm(0.5)]) == ["0", "1", "2"]
+    assert calls[0]["without_timestamps"] is False
+    assert calls[0]["beam_size"] == 5
+    assert calls[0]["clip_timestamps"][1] == {"start": 1.0, "end": 3.5}
+
+
+def test_transcriber_passes_samples_to_faster_whisper_1_1(monkeypatch):
+    calls = []
+    monkeypatch.setitem(sys.modules, "faster_whisper", fake_faster_whisper("1.1.1", calls))
+
+    transcriber = WhisperTranscriber(device="cpu")
+
+    assert transcriber.transcribe_batch([pcm(1), pcm(2)]) == ["0", "1"]
+    assert calls[0]["clip_timestamps"][1] == {"start": SAMPLE_RATE, "end": 3 * SAMPLE_RATE}
+
+
+def fake_transcribers(monkeypatch, batches, failing=()):
+    """
+    Makes serve load FakeTranscribers that read the pcm bytes back as text and record
+    every batch. The devices in failing fail to load.
+    """
+    def load(device, batch_size=8, **options):
+        if device in failing:
+            raise RuntimeError(f"out of memory on {device}")
+        transcriber = FakeTranscriber(lambda pcm: pcm.decode(), latency=0.05)
+        transcriber.batch_size = batch_size
+        transcribe_batch = transcriber.transcribe_batch
+
+        def recording_batches(pcms):
+            batches.append(list(pcms))
+            return transcribe_batch(pcms)
+
+        transcriber.transcribe_batch = recording_batches
+        return transcriber
+
+    monkeypatch.setattr(whisper_server, "WhisperTranscriber", load)
+
+
+def start_server(devices):
+    """
+    Runs serve in a thread of this process, so it loads the fake transcribers. Returns its
+    address.
+    """
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    threading.Thread(target=serve, args=(sender, AUTHKEY, devices, {}), daemon=True).start()
+    return receiver.recv()
+
+
+def test_server_merges_requests_of_clients_and_keeps_their_order(monkeypatch):
+    batches = []
+    fake_transcribers(monkeypatch, batches)
+    address = start_server(["cpu"])
+
+    clients = 4
+    ready = threading.Barrier(clients)
+    results = {}
+
+    def run_client(number):
+        client = WhisperClient(address, AUTHKEY)
+        ready.wait()
+        results[number] = [client.transcribe_batch([f"{number}-{request}-{index}".encode() for index in range(2)])
+                           for request in range(3)]
+        client.close()
+
+    threads = [threading.Thread(target=run_client, args=(number,)) for number in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for number in range(clients):
+        assert results[number] == [[f"{number}-{request}-{index}" for index in range(2)] for request in range(3)]
+    assert any(len({pcm.split(b"-")[0] for pcm in batch}) > 1 for batch in batches)
+    assert all(len(batch) <= 8 for batch in batches)
+
+
+def test_server_leaves_requests_to_the_devices_that_loaded(monkeypatch):
+    batches = []
+    fake_transcribers(monkeypatch, batches, failing={"cuda:0"})
+    client = WhisperClient(start_server(["cuda:0", "cuda:1"]), AUTHKEY)
+
+    assert client.transcribe_batch([b"a", b"b"]) == ["a", "b"]
+    client.close()
+
+
+def test_server_fails_requests_when_no_device_loaded(monkeypatch):
+    fake_transcribers(monkeypatch, [], failing={"cuda:0", "cuda:1"})
+    client = WhisperClient(start_server(["cuda:0", "cuda:1"]), AUTHKEY)
+
+    for _ in range(2):
+        with pytest.raises(RuntimeError, match="out of memory"):
+            client.transcribe_batch([b"a"])
+    client.close()
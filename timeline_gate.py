@@ -0,0 +1,98 @@
+from collections import Counter
+
+import numpy as np
+
+
+# Conservative limits, only clearly misaligned chunks should be rejected
+default_limits = {
+    "min_words_per_second": 0.5,
+    "max_words_per_second": 7.0,
+    "min_word_duration": 0.02,
+    "max_word_duration": 3.0,
+    "max_implausible_fraction": 0.5,
+    "max_gap": 5.0,
+}
+
+
+def sentence_words(sentence):
+    """
+    (start, end) of every word of an echogarden sentence, empty when the timeline has no words.
+    """
+    return [(word["startTime"], word["endTime"])
+            for word in sentence.get("timeline", []) if word.get("type", "word") == "word"]
+
+
+class TimelineGate:
+    """
+    Scores chunks of consecutive sentences on the word timing echogarden produced for
+    them, so clearly misaligned chunks can be dropped before they are exported and
+    transcribed.
+
+    words holds the (start, end) of the words of every sentence, in seconds. All word
+    statistics are computed once for the whole recording; checking a chunk only looks
+    up prefix sums and a slice of the gaps.
+    """
+
+    def __init__(self, words, limits=None):
+        self.limits = {**default_limits, **(limits or {})}
+        self.counts = Counter()
+        self.chunks = 0
+
+        counts = np.array([len(sentence) for sentence in words], dtype=np.int64)
+        times = np.array([word for sentence in words for word in sentence],
+                         dtype=np.float64).reshape(-1, 2)
+
+        # Word index range of every sentence
+        self.word_offsets = np.concatenate([[0], np.cumsum(counts)])
+
+        durations = times[:, 1] - times[:, 0]
+        implausible = ((durations < self.limits["min_word_duration"])
+                       | (durations > self.limits["max_word_duration"]))
+        self.implausible = np.concatenate([[0], np.cumsum(implausible)])
+
+        # Silence between a word and the next one
+        self.gaps = times[1:, 0] - times[:-1, 1]
+
+    def check(self, first_sentence, last_sentence, start_ms, end_ms):
+        """
+        Returns the reason to reject the chunk of sentences first_sentence..last_sentence
+        spanning start_ms..end_ms, or None when it looks plausible. Counts the outcome.
+        """
+        self.chunks += 1
+        reason = self.reject_reason(first_sentence, last_sentence, start_ms, end_ms)
+        if reason is not None:
+            self.counts[reason] += 1
+        return reason
+
+    def reject_reason(self, first_sentence, last_sentence, start_ms, end_ms):
+        first_word = self.word_offsets[first_sentence]
+        end_word = self.word_offsets[last_sentence + 1]
+        word_count = end_word - first_word
+
+        # Without word timing there is nothing to judge the chunk on
+        if word_count == 0:
+            return None
+
+        duration = (end_ms - start_ms) / 1000
+        words_per_second = word_count / duration if duration > 0 else np.inf
+
+        if words_per_second < self.limits["min_words_per_second"]:
+            return "speech_rate_low"
+        if words_per_second > self.limits["max_words_per_second"]:
+            return "speech_rate_high"
+
+        implausible = self.implausible[end_word] - self.implausible[first_word]
+        if implausible / word_count > self.limits["max_implausible_fraction"]:
+            return "implausible_word_durations"
+
+        if word_count > 1 and self.gaps[first_word:end_word - 1].max() > self.limits["max_gap"]:
+            return "long_gap"
+
+        return None
+
+    def report(self):
+        """
+        Chunk and reject counts per reason, e.g. for a per recording json report.
+        """
+        return {"chunks": self.chunks, "rejected": sum(self.counts.values()),
+                "reasons": dict(self.counts)}
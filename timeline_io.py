@@ -0,0 +1,193 @@
+import json
+import os
+import zipfile
+
+import numpy as np
+
+from timeline_gate import sentence_words
+
+
+# Bump when the cached arrays change
+CACHE_VERSION = 1
+
+_decoder = json.JSONDecoder()
+_whitespace = " \t\n\r"
+# What can follow the part of a number decoded so far, "" being the end of the buffer
+_number_continuations = ("", ".", "e", "E", "+", "-", "0", "1", "2", "3", "4", "5", "6", "7", "8", "9")
+
+
+class JsonStream:
+    """
+    Reads a JSON document piecewise: the caller walks the containers it is interested in
+    token by token and decodes the values inside them one at a time with the C decoder,
+    so only the value being decoded is ever held in memory.
+    """
+
+    def __init__(self, f, read_size=1024 * 1024):
+        self.file = f
+        self.read_size = read_size
+        self.buffer = ""
+        self.position = 0
+        self.at_end = False
+
+    def fill(self):
+        """
+        Reads the next block, dropping what was consumed already. False at the end of the file.
+        """
+        if self.at_end:
+            return False
+        block = self.file.read(self.read_size)
+        self.buffer = self.buffer[self.position:] + block
+        self.position = 0
+        self.at_end = not block
+        return bool(block)
+
+    def peek(self):
+        """
+        The next non-whitespace character, "" at the end of the document.
+        """
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in _whitespace:
+                self.position += 1
+            if self.position < len(self.buffer) or not self.fill():
+                return self.buffer[self.position:self.position + 1]
+
+    def accept(self, token):
+        if self.peek() == token:
+            self.position += 1
+            return True
+        return False
+
+    def expect(self, token):
+        if not self.accept(token):
+            raise ValueError(f"Expected {token!r} in JSON, found {self.peek()!r}")
+
+    def value(self):
+        """
+        Decodes the next complete value, reading more of the file until it is complete.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+
+            # A number cut off at the end of the block still decodes, e.g. "12." as 12
+            if (isinstance(value, (int, float)) and not isinstance(value, bool)
+                    and self.buffer[end:end + 1] in _number_continuations and self.fill()):
+                continue
+
+            self.position = end
+            return value
+
+
+def iter_sentences(json_file_path, read_size=1024 * 1024):
+    """
+    Yields the (start, end, text, words) of every sentence of an echogarden timeline,
+    words being the (start, end) of its words, without loading the whole file.
+
+    Only one sentence, with its word and phone timelines, is decoded at a time; the rest
+    of the segment objects is skipped over.
+    """
+    with open(json_file_path, "r", encoding="utf8") as f:
+        stream = JsonStream(f, read_size)
+
+        stream.expect("[")
+        while not stream.accept("]"):
+            stream.expect("{")
+            while not stream.accept("}"):
+                key = stream.value()
+                stream.expect(":")
+
+                if key == "timeline":
+                    stream.expect("[")
+                    while not stream.accept("]"):
+                        sentence = stream.value()
+                        yield (sentence["startTime"], sentence["endTime"], sentence["text"],
+                               sentence_words(sentence))
+                        stream.accept(",")
+                else:
+                    stream.value()
+
+                stream.accept(",")
+            stream.accept(",")
+
+
+def save_timeline_cache(cache_path, timestamps, words):
+    """
+    Stores the sentences and word times of a timeline as flat arrays in an .npz file.
+    """
+    texts = [item[2].encode("utf8") for item in timestamps]
+    text_offsets = np.cumsum([0] + [len(text) for text in texts])
+    word_offsets = np.cumsum([0] + [len(sentence) for sentence in words])
+
+    os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+
+    # Written under a temporary name first, so a reader never sees a partial cache file
+    with open(cache_path + ".tmp", "wb") as f:
+        np.savez(
+            f,
+            version=np.array(CACHE_VERSION),
+            starts=np.array([item[0] for item in timestamps], dtype=np.float64),
+            ends=np.array([item[1] for item in timestamps], dtype=np.float64),
+            text=np.frombuffer(b"".join(texts), dtype=np.uint8),
+            text_offsets=text_offsets.astype(np.int64),
+            word_times=np.array([word for sentence in words for word in sentence],
+                                dtype=np.float64).reshape(-1, 2),
+            word_offsets=word_offsets.astype(np.int64),
+        )
+    os.replace(cache_path + ".tmp", cache_path)
+
+
+def load_timeline_cache(cache_path):
+    """
+    Reads what save_timeline_cache stored. None when there is no usable cache file.
+    """
+    try:
+        with np.load(cache_path, allow_pickle=False) as cache:
+            if int(cache["version"]) != CACHE_VERSION:
+                return None
+            starts = cache["starts"].tolist()
+            ends = cache["ends"].tolist()
+            text = cache["text"].tobytes()
+            text_offsets = cache["text_offsets"].tolist()
+            word_times = [tuple(word) for word in cache["word_times"].tolist()]
+            word_offsets = cache["word_offsets"].tolist()
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        return None
+
+    timestamps = [(start, end, text[text_offsets[index]:text_offsets[index + 1]].decode("utf8"))
+                  for index, (start, end) in enumerate(zip(starts, ends))]
+    words = [word_times[word_offsets[index]:word_offsets[index + 1]] for index in range(len(timestamps))]
+    return timestamps, words
+
+
+def read_timeline(json_file_path, cache_directory=None, file_hash=None):
+    """
+    Returns the (start, end, sentence) of every sentence of an echogarden timeline and the
+    (start, end) of the words of every sentence.
+
+    With a cache_directory, the extracted arrays are cached there under the content hash
+    of the json (file_hash), so later runs, e.g. with another max_duration, do not parse
+    the json again.
+    """
+    cache_path = None
+    if cache_directory is not None and file_hash is not None:
+        cache_path = os.path.join(cache_directory, f"{file_hash}.npz")
+        cached = load_timeline_cache(cache_path)
+        if cached is not None:
+            return cached
+
+    timestamps = []
+    words = []
+    for start, end, text, word_times in iter_sentences(json_file_path):
+        timestamps.append((start, end, text))
+        words.append(word_times)
+
+    if cache_path is not None:
+        save_timeline_cache(cache_path, timestamps, words)
+
+    return timestamps, words
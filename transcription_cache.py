@@ -0,0 +1,120 @@
+import hashlib
+import importlib.metadata
+import json
+import os
+import sqlite3
+import time
+
+
+def pcm_hash(pcm):
+    """
+    Hashes raw 16 kHz mono pcm_s16le sample bytes.
+    The same audio hashes the same whether it comes from memory or from an exported wav file.
+    """
+    return hashlib.sha256(pcm).hexdigest()
+
+
+def faster_whisper_version():
+    """
+    Installed faster-whisper version, None when it is not installed (e.g. with a stub
+    transcriber).
+    """
+    try:
+        return importlib.metadata.version("faster-whisper")
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+class TranscriptionCache:
+    """
+    Persistent transcription cache shared by split-wavs.py and filter-segments.py.
+
+    Entries are keyed on the audio content hash plus the model name, compute type, decode
+    options, pipeline ("batched" for whisper_server.WhisperTranscriber, "sequential" for
+    WhisperModel.transcribe) and faster-whisper version, so a cached transcript is only
+    reused for an identical decode.
+    The cache is stored in a SQLite database and is capped at max_bytes; the least
+    recently used entries are evicted first.
+    """
+
+    def __init__(self, directory, model_name, compute_type, decode_options, max_bytes=1024 * 1024 * 1024,
+                 pipeline="batched"):
+        os.makedirs(directory, exist_ok=True)
+
+        self.max_bytes = max_bytes
+        self.settings = json.dumps({
+            "model": model_name,
+            "compute_type": compute_type,
+            "options": decode_options,
+            "pipeline": pipeline,
+            "faster_whisper": faster_whisper_version(),
+        }, sort_keys=True)
+
+        # Several pool workers share the database, so wait for locks instead of failing
+        self.connection = sqlite3.connect(
+            os.path.join(directory, "transcriptions.sqlite"), timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS transcriptions ("
+            "key TEXT PRIMARY KEY, transcript TEXT NOT NULL, "
+            "size INTEGER NOT NULL, last_used REAL NOT NULL)")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS transcriptions_last_used ON transcriptions (last_used)")
+        self.connection.commit()
+
+    def key(self, pcm):
+        return hashlib.sha256(
+            (pcm_hash(pcm) + self.settings).encode("utf-8")).hexdigest()
+
+    def get(self, pcm):
+        """
+        Returns the cached transcript for the audio, or None when it was not transcribed before.
+        """
+        key = self.key(pcm)
+        row = self.connection.execute(
+            "SELECT transcript FROM transcriptions WHERE key = ?", (key,)).fetchone()
+
+        if row is None:
+            return None
+
+        with self.connection:
+            self.connection.execute(
+                "UPDATE transcriptions SET last_used = ? WHERE key = ?", (time.time(), key))
+
+        return row[0]
+
+    def put(self, pcm, transcript):
+        key = self.key(pcm)
+        size = len(key) + len(transcript.encode("utf-8"))
+
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO transcriptions (key, transcript, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, transcript, size, time.time()))
+            self.evict()
+
+    def evict(self):
+        """
+        Drops least recently used entries until the cache fits in max_bytes again.
+        """
+        total_size = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM transcriptions").fetchone()[0]
+
+        if total_size <= self.max_bytes:
+            return
+
+        rows = self.connection.execute(
+            "SELECT key, size FROM transcriptions ORDER BY last_used")
+
+        evicted = []
+        for key, size in rows:
+            if total_size <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total_size -= size
+
+        self.connection.executemany(
+            "DELETE FROM transcriptions WHERE key = ?", evicted)
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,141 @@
+import threading
+import time
+
+from whisper_server import SAMPLE_RATE
+
+
+ACCEPT = "accept"
+REJECT = "reject"
+ESCALATE = "escalate"
+
+
+class CascadeStats:
+    """
+    Per tier counts of the segments a verification cascade transcribed, how it decided on
+    them and how long the transcription took. Safe to update from several threads.
+    """
+
+    fields = ["segments", "accepted", "rejected", "escalated", "audio_seconds", "seconds"]
+
+    def __init__(self):
+        self.tiers = {}
+        self.lock = threading.Lock()
+
+    def tier(self, name):
+        return self.tiers.setdefault(name, dict.fromkeys(self.fields, 0))
+
+    def add(self, name, **counts):
+        with self.lock:
+            tier = self.tier(name)
+            for field, value in counts.items():
+                tier[field] += value
+
+    def merge(self, tiers):
+        """
+        Adds the counts of another CascadeStats' tiers, e.g. returned by a pool worker.
+        """
+        for name, counts in tiers.items():
+            self.add(name, **counts)
+
+    def report(self):
+        lines = [f"{'tier':<16}{'segments':>10}{'accepted':>10}{'rejected':>10}"
+                 f"{'escalated':>10}{'audio h':>9}{'busy s':>9}{'x realtime':>12}"]
+        for name, tier in self.tiers.items():
+            speed = tier["audio_seconds"] / tier["seconds"] if tier["seconds"] else 0
+            lines.append(
+                f"{name:<16}{tier['segments']:>10}{tier['accepted']:>10}{tier['rejected']:>10}"
+                f"{tier['escalated']:>10}{tier['audio_seconds'] / 3600:>9.2f}"
+                f"{tier['seconds']:>9.1f}{speed:>12.1f}")
+        return "\n".join(lines)
+
+
+class VerificationCascade:
+    """
+    Verifies segments with a list of models, from the cheapest to the reference model.
+
+    Every tier transcribes the segments that reach it and scores them against their
+    reference sentence. A segment whose WER and length change are clearly below (or
+    clearly above) the thresholds is accepted (or rejected) right away; only segments
+    within wer_band / change_band of a threshold go on to the next tier. The last tier
+    decides on everything that reaches it.
+
+    tiers is a list of (name, transcribe) pairs, where transcribe takes a list of 16 kHz
+    pcm_s16le buffers and returns their transcripts. score takes a reference sentence and
+    a transcript and returns (wer, change_percent).
+    """
+
+    def __init__(self, tiers, score, max_wer, max_change_percent, wer_band=0.1, change_band=10):
+        self.tiers = tiers
+        self.score = score
+        self.max_wer = max_wer
+        self.max_change_percent = max_change_percent
+        self.wer_band = wer_band
+        self.change_band = change_band
+        self.stats = CascadeStats()
+
+    def decide(self, wer, change_percent, final=False):
+        change_percent = abs(change_percent)
+
+        if final:
+            if wer > self.max_wer or change_percent > self.max_change_percent:
+                return REJECT
+            return ACCEPT
+
+        if (wer >= self.max_wer + self.wer_band
+                or change_percent >= self.max_change_percent + self.change_band):
+            return REJECT
+        if (wer < self.max_wer - self.wer_band
+                and change_percent < self.max_change_percent - self.change_band):
+            return ACCEPT
+        return ESCALATE
+
+    def verify(self, pcms, references):
+        """
+        Returns a dict with the transcription, wer, change, deciding tier and whether the
+        segment is accepted for every segment, in order.
+        """
+        results = [None] * len(pcms)
+        remaining = list(range(len(pcms)))
+
+        for level, (name, transcribe) in enumerate(self.tiers):
+            if not remaining:
+                break
+
+            final = level == len(self.tiers) - 1
+
+            start_time = time.perf_counter()
+            transcriptions = transcribe([pcms[index] for index in remaining])
+            seconds = time.perf_counter() - start_time
+
+            counts = dict.fromkeys([ACCEPT, REJECT, ESCALATE], 0)
+            escalated = []
+
+            for index, transcription in zip(remaining, transcriptions):
+                wer, change_percent = self.score(references[index], transcription)
+                decision = self.decide(wer, change_percent, final)
+                counts[decision] += 1
+
+                if decision == ESCALATE:
+                    escalated.append(index)
+                    continue
+
+                results[index] = {
+                    "transcription": transcription,
+                    "wer": wer,
+                    "change": change_percent,
+                    "tier": name,
+                    "accepted": decision == ACCEPT,
+                }
+
+            self.stats.add(
+                name,
+                segments=len(remaining),
+                accepted=counts[ACCEPT],
+                rejected=counts[REJECT],
+                escalated=counts[ESCALATE],
+                audio_seconds=sum(len(pcms[index]) for index in remaining) / (2 * SAMPLE_RATE),
+                seconds=seconds,
+            )
+            remaining = escalated
+
+        return results
@@ -0,0 +1,333 @@
+import mmap
+import os
+import re
+import struct
+import subprocess
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+SAMPLE_DTYPES = {1: np.uint8, 2: np.int16, 4: np.int32}
+
+
+class MappedWav:
+    """
+    Read-only PCM wav file backed by numpy.memmap.
+
+    Nothing is read from disk until samples are touched, and slices are views into the
+    mapping, so a worker only pays for the segments it actually uses instead of the full
+    recording. Pages are shared between processes mapping the same file.
+    """
+
+    def __init__(self, wav_file):
+        self.path = wav_file
+        self.format_tag = None
+
+        file_size = os.path.getsize(wav_file)
+
+        with open(wav_file, 'rb') as f:
+            riff, _, wave = struct.unpack('<4sI4s', f.read(12))
+            if riff != b'RIFF' or wave != b'WAVE':
+                raise ValueError(f"{wav_file} is not a RIFF/WAVE file")
+
+            # Walk the chunks until we find the data chunk; ffmpeg puts a LIST chunk in between
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    raise ValueError(f"{wav_file} has no data chunk")
+
+                chunk_id, chunk_size = struct.unpack('<4sI', header)
+
+                if chunk_id == b'fmt ':
+                    fmt = f.read(chunk_size)
+                    (self.format_tag, self.channels, self.frame_rate, _, _,
+                     bits_per_sample) = struct.unpack('<HHIIHH', fmt[:16])
+                    if self.format_tag == WAVE_FORMAT_EXTENSIBLE:
+                        self.format_tag = struct.unpack('<H', fmt[24:26])[0]
+                    self.sample_width = bits_per_sample // 8
+                    f.seek(chunk_size % 2, os.SEEK_CUR)
+                elif chunk_id == b'data':
+                    self.data_offset = f.tell()
+                    # Streamed wav files can have a placeholder size, trust the file size instead
+                    self.data_size = min(chunk_size, file_size - self.data_offset)
+                    break
+                else:
+                    f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+        if self.format_tag != WAVE_FORMAT_PCM or self.sample_width not in SAMPLE_DTYPES:
+            raise ValueError(f"{wav_file} is not integer PCM audio")
+
+        self.frame_width = self.channels * self.sample_width
+        self.frame_count = self.data_size // self.frame_width
+
+        dtype = np.dtype(SAMPLE_DTYPES[self.sample_width]).newbyteorder('<')
+
+        # Empty files cannot be mapped
+        if self.frame_count == 0:
+            self.samples = np.zeros((0, self.channels), dtype=dtype)
+        else:
+            self.samples = np.memmap(
+                wav_file, dtype=dtype, mode='r', offset=self.data_offset,
+                shape=(self.frame_count, self.channels))
+
+    def __len__(self):
+        """
+        Duration in milliseconds, like pydub's AudioSegment.
+        """
+        return round(1000 * self.frame_count / self.frame_rate)
+
+    @property
+    def duration_seconds(self):
+        return self.frame_count / self.frame_rate
+
+    def frame_at(self, ms):
+        """
+        Frame index for a position in milliseconds, truncated the same way pydub does.
+        """
+        return min(max(int(ms * self.frame_rate / 1000.0), 0), self.frame_count)
+
+    def byte_range_ms(self, start_ms, end_ms):
+        """
+        Absolute byte offsets in the file of the samples between start_ms and end_ms.
+        """
+        return (self.data_offset + self.frame_at(start_ms) * self.frame_width,
+                self.data_offset + self.frame_at(end_ms) * self.frame_width)
+
+    def slice_ms(self, start_ms, end_ms):
+        """
+        Zero-copy (frames, channels) view of the samples between start_ms and end_ms.
+        """
+        return self.samples[self.frame_at(start_ms):self.frame_at(end_ms)]
+
+    def is_whisper_format(self):
+        """
+        True when the file is already 16 kHz mono pcm_s16le, the format convert_to_wav produces.
+        """
+        return self.frame_rate == 16000 and self.channels == 1 and self.sample_width == 2
+
+
+class StreamedAudio:
+    """
+    Recording decoded to 16 kHz mono pcm_s16le through an ffmpeg pipe, so segments can be
+    cut straight from an MP3 without writing a full length wav first.
+
+    Segments have to be read in order of their start. Only the samples from the start of
+    the last requested segment up to the end of the decoded data are kept in memory.
+    """
+
+    frame_rate = 16000
+    channels = 1
+    sample_width = 2
+    frame_width = 2
+
+    def __init__(self, path, read_size=1024 * 1024):
+        # Imported here so the wav readers do not need ffmpeg-python installed
+        import ffmpeg
+
+        self.path = path
+        self.read_size = read_size
+        self.buffer = bytearray()
+        self.buffer_start = 0
+        self.eof = False
+
+        # stderr goes to a file, a pipe that is only read at the end could fill up and
+        # block ffmpeg while we wait for its stdout
+        self.errors = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(
+            ffmpeg
+            .input(path)
+            .output('pipe:', format='s16le', ac=1, ar=16000)
+            .global_args('-loglevel', 'error')
+            .compile(),
+            stdout=subprocess.PIPE, stderr=self.errors)
+
+    def frame_at(self, ms):
+        """
+        Frame index for a position in milliseconds, truncated the same way pydub does.
+        """
+        return max(int(ms * self.frame_rate / 1000.0), 0)
+
+    def decode_until(self, frame):
+        while not self.eof and self.buffer_start + len(self.buffer) // self.frame_width < frame:
+            chunk = self.process.stdout.read(self.read_size)
+            if chunk:
+                self.buffer += chunk
+                continue
+
+            self.eof = True
+            if self.process.wait() != 0:
+                self.errors.seek(0)
+                errors = self.errors.read().decode('utf8', errors='replace').strip()
+                raise RuntimeError(f"ffmpeg could not decode {self.path}: {errors}")
+
+    def read_range(self, start, end, preroll=1.0):
+        """
+        Samples of frames start..end decoded on their own, with ffmpeg seeking in the source.
+        Decoding starts preroll seconds early, as the decoder and resampler need some input
+        before their output matches what the stream gave for the same frames.
+        """
+        import ffmpeg
+
+        first = max(start - int(preroll * self.frame_rate), 0)
+        pcm, _ = (
+            ffmpeg
+            .input(self.path, ss=first / self.frame_rate)
+            .output('pipe:', format='s16le', ac=1, ar=16000, t=(end - first) / self.frame_rate)
+            .global_args('-loglevel', 'error')
+            .run(capture_stdout=True, capture_stderr=True)
+        )
+        return np.frombuffer(pcm[(start - first) * self.frame_width:(end - first) * self.frame_width],
+                             dtype='<i2').reshape(-1, 1)
+
+    def slice_ms(self, start_ms, end_ms):
+        """
+        (frames, channels) samples between start_ms and end_ms. Everything before start_ms
+        is dropped; a slice starting before what was dropped, e.g. where an echogarden
+        timeline restarts, is decoded separately with read_range.
+        """
+        start, end = self.frame_at(start_ms), self.frame_at(end_ms)
+        if start < self.buffer_start:
+            return self.read_range(start, end)
+
+        self.decode_until(end)
+
+        dropped = min((start - self.buffer_start) * self.frame_width, len(self.buffer))
+        del self.buffer[:dropped]
+        self.buffer_start += dropped // self.frame_width
+
+        size = max(min(end - self.buffer_start, len(self.buffer) // self.frame_width), 0)
+        return np.frombuffer(bytes(self.buffer[:size * self.frame_width]),
+                             dtype='<i2').reshape(-1, 1)
+
+    def is_whisper_format(self):
+        return True
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.stdout.close()
+        self.process.wait()
+        self.errors.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def segment_ref(wav_file, start_byte, end_byte):
+    """
+    Reference to a byte range of PCM data inside a 16 kHz mono source wav, used in
+    segments.csv instead of a per-segment wav file, e.g. 'C:/data/foo.wav#44-960044'.
+    """
+    return f"{wav_file}#{start_byte}-{end_byte}"
+
+
+def parse_segment_ref(ref):
+    """
+    Splits a segment reference into (wav_file, start_byte, end_byte).
+    Plain wav paths give (wav_file, None, None).
+    """
+    match = re.fullmatch(r'(.*)#(\d+)-(\d+)', ref)
+    if match is None:
+        return ref, None, None
+    return match.group(1), int(match.group(2)), int(match.group(3))
+
+
+class MappedFiles:
+    """
+    Memory maps of the most recently read source recordings, shared by the reader threads.
+    The least recently used map is closed when more than maxsize are open, so a pass over
+    many recordings does not keep every one of them mapped.
+    """
+
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self.maps = OrderedDict()
+        self.lock = threading.Lock()
+
+    def read(self, path, start_byte, end_byte):
+        # Slicing an mmap holds the GIL anyway, so reading under the lock costs no
+        # parallelism and no map is closed while it is read
+        with self.lock:
+            mapped = self.maps.pop(path, None)
+            if mapped is None:
+                with open(path, 'rb') as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[path] = mapped
+
+            while len(self.maps) > self.maxsize:
+                self.maps.popitem(last=False)[1].close()
+
+            return mapped[start_byte:end_byte]
+
+    def close(self):
+        with self.lock:
+            while self.maps:
+                self.maps.popitem()[1].close()
+
+
+mapped_files = MappedFiles()
+
+
+def read_segment_pcm(ref):
+    """
+    16 kHz mono pcm_s16le bytes of a segment, from a segment reference or a segment wav file.
+    Referenced segments are sliced out of a memory map of the source recording.
+    """
+    wav_file, start_byte, end_byte = parse_segment_ref(ref)
+
+    if start_byte is not None:
+        return mapped_files.read(wav_file, start_byte, end_byte)
+
+    audio = MappedWav(wav_file)
+    return audio.samples.tobytes()
+
+
+def read_segment_wav(ref):
+    """
+    A segment as wav file bytes, from a segment reference or a segment wav file.
+    """
+    wav_file, start_byte, end_byte = parse_segment_ref(ref)
+
+    if start_byte is not None:
+        pcm = read_segment_pcm(ref)
+        return wav_header(len(pcm)) + pcm
+
+    with open(wav_file, 'rb') as f:
+        return f.read()
+
+
+def wav_duration(wav_file):
+    """
+    Duration of a wav file in seconds, read from its header only.
+    """
+    return MappedWav(wav_file).duration_seconds
+
+
+def wav_header(data_size, frame_rate=16000, channels=1, sample_width=2):
+    """
+    Canonical 44 byte RIFF/WAVE header for data_size bytes of integer PCM.
+    """
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + data_size, b'WAVE',
+        b'fmt ', 16, WAVE_FORMAT_PCM, channels, frame_rate,
+        frame_rate * channels * sample_width, channels * sample_width, sample_width * 8,
+        b'data', data_size)
+
+
+def write_wav(wav_file, pcm, frame_rate=16000, channels=1, sample_width=2):
+    """
+    Writes raw PCM bytes to a wav file without going through ffmpeg.
+    """
+    with open(wav_file, 'wb') as f:
+        f.write(wav_header(len(pcm), frame_rate, channels, sample_width))
+        f.write(pcm)
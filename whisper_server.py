@@ -0,0 +1,260 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+
+SAMPLE_RATE = 16000
+
+
+def pcm_to_float32(pcm):
+    """
+    Converts 16 kHz mono pcm_s16le bytes to the float32 array faster-whisper expects.
+    """
+    return np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+
+
+def version_tuple(version):
+    """
+    (major, minor) of a version string such as "1.1.1".
+    """
+    return tuple(int(part) for part in version.split(".")[:2])
+
+
+def parse_device(device):
+    """
+    Splits "cuda:1" into ("cuda", 1); "cpu" becomes ("cpu", 0).
+    """
+    name, _, index = device.partition(":")
+    return name, int(index or 0)
+
+
+class WhisperTranscriber:
+    """
+    In-process batched faster-whisper transcriber that owns one model on one device.
+    """
+
+    def __init__(self, model_name="large-v2", device="cuda", compute_type="float16",
+                 decode_options=None, batch_size=8):
+        # Imported here so clients and fakes do not need faster-whisper installed
+        import faster_whisper
+        from faster_whisper import WhisperModel, BatchedInferencePipeline
+
+        device, device_index = parse_device(device)
+
+        self.model = WhisperModel(model_name, device=device,
+                                  device_index=device_index, compute_type=compute_type)
+        self.pipeline = BatchedInferencePipeline(model=self.model)
+        # The batched pipeline decodes without timestamps by default, unlike
+        # WhisperModel.transcribe that the transcripts were checked with before. It also
+        # decodes at the first temperature only, without the fallback to higher
+        # temperatures on repetitive or low probability output.
+        self.decode_options = {"without_timestamps": False, **(decode_options or {})}
+        self.batch_size = batch_size
+
+        # faster-whisper 1.2 takes the clip timestamps in seconds, 1.1 in samples
+        self.clip_samples = version_tuple(getattr(faster_whisper, "__version__", "1.2")) < (1, 2)
+
+    def transcribe_batch(self, pcms):
+        """
+        Transcribes a list of 16 kHz pcm_s16le buffers in a single batched Whisper call.
+        The buffers are concatenated and passed as clip timestamps, so every buffer is decoded
+        as its own chunk. Returns one transcript per input buffer, in order.
+        """
+        if not pcms:
+            return []
+
+        audios = [pcm_to_float32(pcm) for pcm in pcms]
+
+        lengths = np.array([len(samples) for samples in audios])
+        clip_ends = np.cumsum(lengths)
+        clip_starts = clip_ends - lengths
+
+        if self.clip_samples:
+            clip_timestamps = [{"start": int(start), "end": int(end)}
+                               for start, end in zip(clip_starts, clip_ends)]
+        else:
+            clip_timestamps = [{"start": float(start) / SAMPLE_RATE, "end": float(end) / SAMPLE_RATE}
+                               for start, end in zip(clip_starts, clip_ends)]
+
+        whisper_segments, whisper_info = self.pipeline.transcribe(
+            np.concatenate(audios), batch_size=self.batch_size,
+            clip_timestamps=clip_timestamps, **self.decode_options)
+
+        # The transcription will actually run here.
+        texts = [[] for _ in audios]
+        for whisper_segment in whisper_segments:
+            clip = np.searchsorted(
+                clip_starts, round(whisper_segment.start * SAMPLE_RATE), side="right") - 1
+            texts[max(clip, 0)].append(whisper_segment.text)
+
+        return [" ".join(text) for text in texts]
+
+
+class FakeTranscriber:
+    """
+    Stand-in for WhisperTranscriber/WhisperClient that runs in-process without a model.
+    transcribe is called with the pcm bytes of every segment and returns its transcript.
+    """
+
+    def __init__(self, transcribe=None, latency=0.0):
+        self.transcribe = transcribe or (lambda pcm: "")
+        self.latency = latency
+        self.calls = 0
+
+    def transcribe_batch(self, pcms):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return [self.transcribe(pcm) for pcm in pcms]
+
+
+class WhisperClient:
+    """
+    Connection to a WhisperServer, used by pool workers in place of a local model.
+    """
+
+    def __init__(self, address, authkey):
+        self.connection = Client(address, authkey=authkey)
+
+    def transcribe_batch(self, pcms):
+        if not pcms:
+            return []
+
+        self.connection.send(pcms)
+        result = self.connection.recv()
+
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def close(self):
+        self.connection.close()
+
+
+def handle_client(connection, requests):
+    """
+    Forwards the batches of one client to the shared request queue and sends back the results.
+    """
+    replies = queue.Queue()
+    try:
+        while True:
+            pcms = connection.recv()
+            requests.put((pcms, replies))
+            connection.send(replies.get())
+    except EOFError:
+        pass
+    finally:
+        connection.close()
+
+
+def run_device(device, requests, transcriber_options, load_failures):
+    """
+    Owns the model for one device. Requests from different clients are merged into one
+    batch, so small batches from many workers still fill the GPU.
+
+    A device that cannot load the model stops, leaving the requests to the other devices.
+    load_failures counts the failed devices of the server; the last one to fail keeps
+    answering with its error, so clients fail instead of waiting forever.
+    """
+    try:
+        transcriber = WhisperTranscriber(device=device, **transcriber_options)
+    except Exception as e:
+        print(f"Failed to load Whisper on {device}: {e}")
+        with load_failures["lock"]:
+            load_failures["count"] += 1
+            if load_failures["count"] < load_failures["devices"]:
+                return
+
+        while True:
+            _, replies = requests.get()
+            replies.put(e)
+
+    while True:
+        batch = [requests.get()]
+        size = len(batch[0][0])
+
+        while size < transcriber.batch_size:
+            try:
+                batch.append(requests.get_nowait())
+            except queue.Empty:
+                break
+            size += len(batch[-1][0])
+
+        try:
+            transcripts = transcriber.transcribe_batch(
+                [pcm for pcms, _ in batch for pcm in pcms])
+        except Exception as e:
+            for _, replies in batch:
+                replies.put(e)
+            continue
+
+        offset = 0
+        for pcms, replies in batch:
+            replies.put(transcripts[offset:offset + len(pcms)])
+            offset += len(pcms)
+
+
+def serve(connection, authkey, devices, transcriber_options):
+    requests = queue.Queue()
+    load_failures = {"lock": threading.Lock(), "count": 0, "devices": len(devices)}
+
+    for device in devices:
+        threading.Thread(target=run_device, args=(
+            device, requests, transcriber_options, load_failures), daemon=True).start()
+
+    with Listener(('127.0.0.1', 0), authkey=authkey) as listener:
+        connection.send(listener.address)
+        connection.close()
+
+        while True:
+            client = listener.accept()
+            threading.Thread(target=handle_client, args=(
+                client, requests), daemon=True).start()
+
+
+class WhisperServer:
+    """
+    Dedicated inference process that loads the model once per device and serves
+    transcription requests from any number of WhisperClient connections.
+
+        with WhisperServer(devices=["cuda:0"], model_name="large-v2") as server:
+            client = WhisperClient(server.address, server.authkey)
+    """
+
+    def __init__(self, devices=("cuda:0",), **transcriber_options):
+        self.devices = list(devices)
+        self.transcriber_options = transcriber_options
+        self.authkey = os.urandom(16)
+        self.address = None
+        self.process = None
+
+    def start(self):
+        # Spawn, so the server never inherits CUDA state from the parent
+        context = multiprocessing.get_context("spawn")
+        receiver, sender = context.Pipe(duplex=False)
+
+        self.process = context.Process(target=serve, args=(
+            sender, self.authkey, self.devices, self.transcriber_options), daemon=True)
+        self.process.start()
+        sender.close()
+
+        self.address = receiver.recv()
+        receiver.close()
+        return self
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()